@@ -2,6 +2,8 @@ from __future__ import absolute_import
 
 import functools
 
+import cherrypy
+
 from ensconce import exc
 from ensconce.dao import access
 from ensconce.webapp.util import operator_info
@@ -53,6 +55,39 @@ ACCESS_LEVEL_LABELS = ((USER_R, u'View Users'),
 
 ALL_ACCESS = reduce(lambda x,y: x|y, [val for (val,_lbl) in ACCESS_LEVEL_LABELS])
 
+def compile_perms(perms):
+    """
+    Compiles the perms into a single mask (of the perms that are all required).
+    
+    :param perms: A single (int) perm or a list of (int) perms.
+    :rtype: int
+    """
+    if isinstance(perms, (int, long, basestring)):
+        perms = [perms]
+    return reduce(lambda x,y: x|y, [int(perm) for perm in perms], 0)
+
+def access_level():
+    """
+    Gets the access level (mask) of the currently logged-in operator.
+    
+    The level is looked up once per request (and memoized on the request), so that the
+    ACL checks of a request (the decorators and the templates) share a single lookup.
+    
+    :rtype: int
+    """
+    operator_id = operator_info().user_id
+    request = cherrypy.request
+    # (Outside of a request there is only a placeholder request, shared by all threads.)
+    in_request = request.app is not None
+    if in_request:
+        memoized = getattr(request, 'ensconce_access_level', None)
+        if memoized is not None and memoized[0] == operator_id:
+            return memoized[1]
+    level = access.access_level(operator_id)
+    if in_request:
+        request.ensconce_access_level = (operator_id, level)
+    return level
+
 # XXX: This is kinda messy.  The check_acl method gets added to the individual methods,
 # so we lose the clean_errors transformations if that method raises any errors.  
 #
@@ -64,14 +99,14 @@ def require_access(perms):
     access level(s).
     :param perms: A single (int) perm or a list of (int) perms.
     """
-    if isinstance(perms, (int, basestring)):
-        perms = [perms]
+    mask = compile_perms(perms)
     def decorator(f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
             # set name_override to func.__name__
-            for perm in perms:
-                access.verify_access(operator_info().user_id, perm)
+            missing = mask & ~access_level()
+            if missing:
+                raise exc.PermissionDenied(operator_info().user_id, missing)
             return f(*args, **kwargs)
         return wrapper
     return decorator
@@ -80,6 +115,5 @@ def has_access(perms):
     """
     Check whether current operator has the specified access perms.
     """
-    if isinstance(perms, (int, basestring)):
-        perms = [perms]
-    return all([access.has_access(operator_info().user_id, perm) for perm in perms])
\ No newline at end of file
+    mask = compile_perms(perms)
+    return (access_level() & mask) == mask
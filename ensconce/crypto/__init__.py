@@ -4,6 +4,7 @@ import threading
 from collections import namedtuple
 
 from ensconce.exc import CryptoNotInitialized, IncorrectKey
+from ensconce.crypto.cache import decrypted_cache
 
 MasterKey = namedtuple('MasterKey', ['encryption_key', 'signing_key'])
 
@@ -17,34 +18,77 @@ class CombinedMasterKey(MasterKey):
             raise ValueError("Combined keys must be 64-bytes.")
         return MasterKey.__new__(cls, encryption_key=combined_key[:32], signing_key=combined_key[32:])
     
+class KeySnapshot(namedtuple('KeySnapshot', ['master_key', 'data_keys', 'contexts'])):
+    """
+    An immutable snapshot of the master key and the (unwrapped) data keys, along with
+    a prepared :class:`ensconce.crypto.engine.KeyContext` for each of the keys.
+    
+    The snapshot (and its dicts) must never be modified once it has been published by
+    the :class:`_EphemeralStore`; changes are made by publishing a new snapshot.
+    """
+    
+    @classmethod
+    def create(cls, master_key, data_keys, previous=None):
+        """
+        Creates a snapshot for the keys, preparing a context for each of them.
+        
+        :param master_key: The master key.
+        :type master_key: MasterKey
+        :param data_keys: The (unwrapped) data keys, keyed by id.
+        :type data_keys: dict
+        :param previous: A previous snapshot whose contexts can be re-used.
+        :type previous: KeySnapshot
+        """
+        # Need a runtime import since otherwise we have circular dep
+        from ensconce.crypto.engine import KeyContext
+        
+        reuse = previous.contexts if previous is not None else {}
+        contexts = {}
+        for key in [master_key] + data_keys.values():
+            contexts[key] = reuse.get(key) or KeyContext(key)
+        return cls(master_key=master_key, data_keys=dict(data_keys), contexts=contexts)
+    
+    @property
+    def active_data_key(self):
+        """ The (id, key) of the data key for new data, or None if there are no data keys. """
+        if not self.data_keys:
+            return None
+        key_id = max(self.data_keys)
+        return (key_id, self.data_keys[key_id])
+    
 class _EphemeralStore(object):
     """
     A class that is used to store sensitive key information that we need to 
     keep in memory.
+    
+    The keys are published as an immutable :class:`KeySnapshot`.  Readers just fetch
+    the current snapshot (a single, atomic attribute read) without locking, so the 
+    encrypt/decrypt hot paths are not serialized; changes (which are rare) are made
+    while holding the `key_lock` and then published by swapping in a new snapshot.
     """
-    _secret_key = None
+    _snapshot = None
     key_lock = None
     
     def __init__(self):
         self.key_lock = threading.RLock()
-            
-    # It's true that the locking here is probably overkill given implementation
-    # details of cpython, but it serves as a [maybe-useful] reminder that this
-    # app and all shared data exists in a multi-threaded context.
     
     @property
     def initialized(self):
         """ Whether the ephemeral store has been initialized. """
-        with self.key_lock:
-            return (self._secret_key is not None)
+        return (self._snapshot is not None)
+    
+    @property
+    def snapshot(self):
+        """ Get the current :class:`KeySnapshot`; will raise an exception if the key is not set. """
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise CryptoNotInitialized("secret_key has not been initialized")
+        return snapshot
     
     @property
     def secret_key(self):
         """ Get the private key; will raise an exception if the key is not set. """
-        with self.key_lock:
-            if self._secret_key is None:
-                raise CryptoNotInitialized("secret_key has not been initialized")
-            return self._secret_key 
+        return self.snapshot.master_key
         
     @secret_key.setter
     def secret_key(self, value):
@@ -52,21 +96,64 @@ class _EphemeralStore(object):
         Sets the combined encryption/signing key to the specified value, raising exception
         if the key is not 64 bytes.  Internally the key is split in half; one half used for
         encryption and the other for signing.
+        
+        The data keys (which are wrapped with this key) are also loaded from the database.
         """
         # Need a runtime import since otherwise we have circular dep
         from ensconce.crypto import util
         
         with self.key_lock:
             if value is None:
-                self._secret_key = None
+                self._snapshot = None
             else:
                 if not isinstance(value, MasterKey):
                     value = CombinedMasterKey(value)
                 if not util.validate_key(value):
                     raise IncorrectKey()
                 
-                self._secret_key = value
+                self._snapshot = KeySnapshot.create(value, util.load_data_keys(value), previous=self._snapshot)
+            
+            # Any cached cleartext is no longer valid for the new key (or lack thereof).
+            decrypted_cache.clear()
                 
+    @property
+    def data_keys(self):
+        """ Get a dict of all the (unwrapped) data keys, keyed by id. """
+        return dict(self.snapshot.data_keys)
+    
+    @property
+    def active_data_key(self):
+        """
+        Get the data key that should be used to encrypt new data, as an (id, key) tuple.
+        
+        This is None if there are no data keys (i.e. a database that has not yet been
+        migrated to data keys), in which case data is encrypted with the master key.
+        """
+        return self.snapshot.active_data_key
+    
+    def data_key(self, key_id):
+        """
+        Get the (unwrapped) data key for specified id.
+        
+        If the key is not known, the data keys are re-loaded from the database, since
+        it may have been created (e.g. by a key rotation) after this store was initialized.
+        
+        :raise KeyError: If there is no data key with specified id.
+        """
+        snapshot = self.snapshot
+        if key_id in snapshot.data_keys:
+            return snapshot.data_keys[key_id]
+        
+        # Need a runtime import since otherwise we have circular dep
+        from ensconce.crypto import util
+        
+        with self.key_lock:
+            snapshot = self.snapshot # (Another thread may have already re-loaded the keys.)
+            if key_id not in snapshot.data_keys:
+                snapshot = KeySnapshot.create(snapshot.master_key, util.load_data_keys(snapshot.master_key), previous=snapshot)
+                self._snapshot = snapshot
+            return snapshot.data_keys[key_id]
+    
     @property
     def encryption_key(self):
         """ Get just the encryption key from the combined master key. """
@@ -0,0 +1,246 @@
+"""
+The implementations of the cryptographic primitives (AES cipher, MAC hash and RNG).
+
+The engines only use the primitives through the :class:`CryptoBackend` interface, so
+the implementation can be chosen at startup: the OpenSSL backend (from the optional
+`cryptography` package) uses AES-NI where the CPU supports it, and PyCrypto is always
+available as a fallback.  All the backends implement the same (standard) algorithms,
+so the ciphertexts are identical whichever backend is used.
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import hashlib
+import binascii
+import threading
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    default_backend = None
+
+from ensconce import exc
+from ensconce.crypto.padding import padding_policy
+from ensconce.autolog import log
+
+# The FIPS-197 (appendix C.3) AES-256 known-answer test.
+_KAT_KEY = binascii.unhexlify('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f')
+_KAT_CLEARTEXT = binascii.unhexlify('00112233445566778899aabbccddeeff')
+_KAT_CIPHERTEXT = binascii.unhexlify('8ea2b7ca516745bfeafc49904b496089')
+
+# The NIST SP 800-38A (F.2.5) CBC-AES256 known-answer test (first two blocks).
+_KAT_CBC_KEY = binascii.unhexlify('603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4')
+_KAT_CBC_IV = binascii.unhexlify('000102030405060708090a0b0c0d0e0f')
+_KAT_CBC_CLEARTEXT = binascii.unhexlify('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51')
+_KAT_CBC_CIPHERTEXT = binascii.unhexlify('f58c4c04d6e5f1ba779eabfb5f7bfbd69cfc4e967edb808d679f777bc6702c7d')
+
+# The number of values (of each size) to encrypt in the startup micro-benchmark.
+BENCHMARK_COUNT = 200
+
+class CryptoBackend(object):
+    """
+    The interface for the implementations of the cryptographic primitives.
+    """
+    name = None
+
+    @classmethod
+    def available(cls):
+        """ Whether the implementation can be used (i.e. its library is installed). """
+        return True
+
+    def block_cipher(self, key):
+        """
+        Creates an AES cipher for the key.
+
+        The returned object has `encrypt(data)` and `decrypt(data)` methods (ECB mode; the
+        data must be a multiple of the block size) and a `cbc_encrypt(iv, data)` method.
+        It must be safe to share the object between threads.
+
+        :param key: The (32-byte) AES key.
+        :type key: str
+        """
+        raise NotImplementedError()
+
+    def mac_hash(self, data=''):
+        """ Creates a SHA-256 hash object (for the HMAC signatures). """
+        return hashlib.sha256(data)
+
+    def random_bytes(self, n):
+        """ Gets `n` cryptographically secure random bytes. """
+        raise NotImplementedError()
+
+    def self_test(self):
+        """
+        Checks the implementation against known-answer tests.
+
+        :raise ensconce.exc.CryptoError: If any of the tests fail.
+        """
+        cipher = self.block_cipher(_KAT_KEY)
+        if cipher.encrypt(_KAT_CLEARTEXT) != _KAT_CIPHERTEXT or cipher.decrypt(_KAT_CIPHERTEXT) != _KAT_CLEARTEXT:
+            raise exc.CryptoError("AES (ECB) known-answer test failed for {0} backend.".format(self.name))
+        if self.block_cipher(_KAT_CBC_KEY).cbc_encrypt(_KAT_CBC_IV, _KAT_CBC_CLEARTEXT) != _KAT_CBC_CIPHERTEXT:
+            raise exc.CryptoError("AES (CBC) known-answer test failed for {0} backend.".format(self.name))
+        random_bytes = self.random_bytes(32)
+        if len(random_bytes) != 32 or random_bytes == self.random_bytes(32):
+            raise exc.CryptoError("Random number generator test failed for {0} backend.".format(self.name))
+
+    def benchmark(self, sizes=None, count=BENCHMARK_COUNT):
+        """
+        Measures the average time to encrypt a value.
+
+        The fixed cost per call matters as much as the throughput for the (mostly small)
+        values that we encrypt, so this times values of each of the padded sizes.
+
+        :param sizes: The value sizes (default is the padding policy bucket sizes).
+        :type sizes: list
+        :param count: The number of values of each size to encrypt.
+        :type count: int
+        :return: The average time (seconds) per value.
+        :rtype: float
+        """
+        if sizes is None:
+            sizes = padding_policy.buckets
+        values = ['\0' * size for size in sizes] * count
+        cipher = self.block_cipher(_KAT_KEY)
+        start = time.time()
+        for value in values:
+            cipher.encrypt(value)
+        return (time.time() - start) / len(values)
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.name)
+
+class _PyCryptoBlockCipher(object):
+    """ The AES cipher for :class:`PyCryptoBackend`. """
+    def __init__(self, key):
+        self.key = key
+        # (An ECB cipher has no state, so it can be shared.)
+        self._ecb = AES.new(key, AES.MODE_ECB)
+        self.encrypt = self._ecb.encrypt
+        self.decrypt = self._ecb.decrypt
+
+    def cbc_encrypt(self, iv, data):
+        return AES.new(self.key, AES.MODE_CBC, iv).encrypt(data)
+
+class PyCryptoBackend(CryptoBackend):
+    """
+    The PyCrypto implementation (always available).
+    """
+    name = 'pycrypto'
+
+    def block_cipher(self, key):
+        return _PyCryptoBlockCipher(key)
+
+    def random_bytes(self, n):
+        return get_random_bytes(n)
+
+class _OpenSSLBlockCipher(object):
+    """ The AES cipher for :class:`OpenSSLBackend`. """
+    def __init__(self, key, backend):
+        self.key = key
+        self._backend = backend
+        self._ecb = Cipher(algorithms.AES(key), modes.ECB(), backend=backend)
+        # The OpenSSL cipher contexts are not thread-safe, so each thread gets its own.
+        # (ECB contexts can be re-used for any number of block-aligned updates.)
+        self._local = threading.local()
+
+    def encrypt(self, data):
+        try:
+            encryptor = self._local.encryptor
+        except AttributeError:
+            encryptor = self._local.encryptor = self._ecb.encryptor()
+        return encryptor.update(data)
+
+    def decrypt(self, data):
+        try:
+            decryptor = self._local.decryptor
+        except AttributeError:
+            decryptor = self._local.decryptor = self._ecb.decryptor()
+        return decryptor.update(data)
+
+    def cbc_encrypt(self, iv, data):
+        encryptor = Cipher(algorithms.AES(self.key), modes.CBC(iv), backend=self._backend).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+class OpenSSLBackend(CryptoBackend):
+    """
+    The OpenSSL implementation, from the (optional) `cryptography` package.
+
+    OpenSSL uses the AES-NI instructions when the CPU supports them.  The random bytes
+    are read from the OS (os.urandom), as the `cryptography` package recommends.
+    """
+    name = 'openssl'
+
+    def __init__(self):
+        self._backend = default_backend()
+
+    @classmethod
+    def available(cls):
+        return default_backend is not None
+
+    def block_cipher(self, key):
+        return _OpenSSLBlockCipher(key, self._backend)
+
+    def random_bytes(self, n):
+        return os.urandom(n)
+
+# The backends, in order of preference.
+BACKENDS = (OpenSSLBackend, PyCryptoBackend)
+
+def available_backends():
+    """
+    Gets the backends whose libraries are installed.
+
+    :rtype: list
+    """
+    return [cls() for cls in BACKENDS if cls.available()]
+
+class BackendSelector(object):
+    """
+    Holds the backend that is used by the crypto engines.
+    """
+    current = None
+
+    def __init__(self):
+        self.current = PyCryptoBackend()
+
+    def configure(self, name='auto'):
+        """
+        Selects the backend to use.
+
+        :param name: The name of the backend, or 'auto' to use the fastest (for the configured 
+                     padding sizes) of the available backends that pass their self-test.
+        :type name: str
+        :raise ensconce.exc.ConfigurationError: If the named backend is not available.
+        :raise ensconce.exc.CryptoError: If the named backend fails its self-test.
+        """
+        backends = available_backends()
+        if name == 'auto':
+            timings = []
+            for backend in backends:
+                try:
+                    backend.self_test()
+                except exc.CryptoError:
+                    log.exception("Crypto backend {0} failed its self-test; not using it.".format(backend.name))
+                else:
+                    timings.append((backend.benchmark(), backend))
+            # (PyCrypto always passes its tests, unless something is badly wrong.)
+            if not timings:
+                raise exc.CryptoError("None of the crypto backends passed their self-tests.")
+            (elapsed, self.current) = min(timings, key=lambda t: t[0])
+            log.info("Using crypto backend {0} ({1}).".format(self.current.name,
+                     ', '.join('{0}: {1:.1f} usec/value'.format(b.name, t * 1e6) for (t, b) in timings)))
+        else:
+            by_name = dict((b.name, b) for b in backends)
+            if name not in by_name:
+                raise exc.ConfigurationError("Crypto backend is not available: {0}".format(name))
+            by_name[name].self_test()
+            self.current = by_name[name]
+            log.info("Using crypto backend {0}.".format(self.current.name))
+
+backend_selector = BackendSelector()
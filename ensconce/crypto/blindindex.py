@@ -0,0 +1,191 @@
+"""
+A keyed ("blind") index of the encrypted resource notes, so that searching the notes does
+not need to decrypt all of them.
+
+The notes are split into (lower-case, whitespace-separated) words, and each substring of
+:data:`GRAM_SIZE` characters of each word is stored as a token: the (truncated) HMAC-SHA256
+of the substring, with a key that is derived from the index secret (see :func:`secret_key`).
+A search word can then
+only be found in the notes of the resources that have all of the word's tokens, so only
+those candidates need to be decrypted (to check the actual match).  The tokens do not
+reveal the words without the key, but they do reveal which resources share substrings.
+
+The tokens are updated whenever the notes change (by a mapper event listener that is
+registered in :mod:`ensconce.model`).  The index secret is a data key, so it stays the same
+when the master key is replaced (the data keys are just re-wrapped); the index only needs to
+be rebuilt (see :func:`ensconce.crypto.util.rebuild_notes_index`) when the secret changes.
+The key metadata holds a check value for the key that the index was built with; until it
+matches the current key the searches decrypt all of the notes.
+"""
+from __future__ import absolute_import
+
+import hmac
+import struct
+import hashlib
+
+from sqlalchemy import select, func
+
+from ensconce.crypto import state, MasterKey
+
+# The length of the indexed substrings; shorter search words cannot use the index.
+GRAM_SIZE = 3
+
+# The tokens are the first 8 bytes of the HMAC, as a (signed) 64-bit integer.  (Collisions
+# only add candidates, which are then checked.)
+_TOKEN = struct.Struct('>q')
+
+_KEY_LABEL = 'ensconce notes index'
+_CHECK_LABEL = 'ensconce notes index check'
+
+def grams(text):
+    """
+    Gets the (unique) substrings of :data:`GRAM_SIZE` characters of the words of the text.
+
+    :param text: The (decrypted) text.
+    :type text: unicode or str (UTF-8)
+    :rtype: set
+    """
+    if isinstance(text, str):
+        text = unicode(text, 'utf-8')
+    result = set()
+    for word in text.lower().split():
+        for i in xrange(len(word) - GRAM_SIZE + 1):
+            result.add(word[i:i + GRAM_SIZE])
+    return result
+
+def secret_key(master_key, data_keys):
+    """
+    Gets the secret that the index key is derived from: the first (oldest) data key, or the
+    master key if there are no data keys yet (i.e. a database that pre-dates them).
+
+    :param master_key: The master key.
+    :type master_key: ensconce.crypto.MasterKey
+    :param data_keys: The (unwrapped) data keys, keyed by id.
+    :type data_keys: dict
+    :rtype: ensconce.crypto.MasterKey
+    """
+    if not data_keys:
+        return master_key
+    return data_keys[min(data_keys)]
+
+class IndexKey(object):
+    """
+    The index key that is derived from the index secret, prepared for computing tokens.
+
+    :param secret: The index secret (see :func:`secret_key`).
+    :type secret: ensconce.crypto.MasterKey
+    """
+    def __init__(self, secret):
+        assert isinstance(secret, MasterKey)
+        self.secret = secret
+        key = hmac.new(secret.signing_key, _KEY_LABEL, hashlib.sha256).digest()
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+        self.check = self._digest(_CHECK_LABEL)
+
+    def _digest(self, data):
+        h = self._hmac.copy()
+        h.update(data)
+        return h.digest()
+
+    def tokens(self, text):
+        """
+        Gets the tokens for the :func:`grams` of the text.
+
+        :rtype: set
+        """
+        return set(_TOKEN.unpack(self._digest(g.encode('utf-8'))[:_TOKEN.size])[0] for g in grams(text))
+
+# The index key for the most recently used secret.
+_index_key = None
+
+def index_key(secret=None):
+    """
+    Gets the (prepared) index key for the index secret.
+
+    :param secret: The index secret (default is the secret for the keys in ensconce.crypto.state).
+    :type secret: ensconce.crypto.MasterKey
+    :rtype: :class:`IndexKey`
+    """
+    global _index_key
+    if secret is None:
+        snapshot = state.snapshot
+        secret = secret_key(snapshot.master_key, snapshot.data_keys)
+    key = _index_key
+    if key is None or key.secret != secret:
+        key = _index_key = IndexKey(secret)
+    return key
+
+def update(connection, resource_id, notes, key=None):
+    """
+    Replaces the tokens of a resource with the tokens of its notes.
+
+    :param connection: The connection (of the current flush/transaction).
+    :param resource_id: The id of the resource.
+    :param notes: The decrypted notes (or None).
+    :type notes: str
+    :param key: The index key (default is the key for the current keys).
+    :type key: :class:`IndexKey`
+    """
+    update_many(connection, [(resource_id, notes)], key=key)
+
+def update_many(connection, notes, key=None):
+    """
+    Replaces the tokens of the resources with the tokens of their notes (with a single
+    DELETE and INSERT).
+
+    :param connection: The connection (of the current flush/transaction).
+    :param notes: The (resource id, decrypted notes) of the resources.
+    :type notes: list
+    :param key: The index key (default is the key for the current keys).
+    :type key: :class:`IndexKey`
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    t_t = model.resource_note_tokens_table
+
+    if not notes:
+        return
+    key = key or index_key()
+    connection.execute(t_t.delete().where(t_t.c.resource_id.in_([resource_id for (resource_id, _) in notes])))
+    rows = [dict(token=token, resource_id=resource_id)
+            for (resource_id, text) in notes if text
+            for token in key.tokens(text)]
+    if rows:
+        connection.execute(t_t.insert(), rows)
+
+def is_current(session):
+    """
+    Whether the index was built with (the key for) the current index secret.
+
+    :param session: The database session.
+    :rtype: bool
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    check = session.query(model.KeyMetadata.index_check).scalar()
+    return check is not None and str(check) == index_key().check
+
+def candidates(session, searchstr):
+    """
+    Builds the query for the ids of the resources whose notes may contain all of the words
+    of the search string.
+
+    :param session: The database session.
+    :param searchstr: The search string.
+    :return: The query, or None if the index cannot be used (i.e. it is not current, or
+             none of the words is long enough), in which case all of the notes must be searched.
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    from ensconce.textsearch import split_terms
+    t_t = model.resource_note_tokens_table
+
+    key = index_key()
+    tokens = set()
+    for term in split_terms(searchstr):
+        tokens.update(key.tokens(term))
+    if not tokens or not is_current(session):
+        return None
+    return (select([t_t.c.resource_id], t_t.c.token.in_(tokens))
+            .group_by(t_t.c.resource_id)
+            .having(func.count(t_t.c.token) == len(tokens)))
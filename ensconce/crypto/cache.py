@@ -0,0 +1,125 @@
+"""
+An (opt-in) in-memory cache of decrypted values.
+
+Hot rows (e.g. passwords for automation accounts) are decrypted over and over; this
+cache keeps the cleartext for recently decrypted ciphertexts so that repeated reads
+do not need to authenticate and decrypt the data again.
+
+The cache is keyed by a digest of the ciphertext (we don't need to hold on to the
+ciphertext itself), is bounded in size and entry age, and is cleared whenever the
+key in the :class:`ensconce.crypto._EphemeralStore` changes.
+"""
+from __future__ import absolute_import
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+class DecryptedValueCache(object):
+    """
+    A thread-safe, bounded LRU cache of cleartext keyed by ciphertext digest.
+
+    The cache is disabled by default; use :meth:`configure` to enable it.
+    """
+    enabled = False
+    ttl = None
+    max_entries = None
+
+    def __init__(self, enabled=False, ttl=300, max_entries=10000):
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.configure(enabled=enabled, ttl=ttl, max_entries=max_entries)
+        self.reset_stats()
+
+    def configure(self, enabled, ttl, max_entries):
+        """
+        (Re)configure the cache; this also clears any existing entries.
+
+        :param enabled: Whether to cache decrypted values at all.
+        :type enabled: bool
+        :param ttl: The max age (seconds) of a cached value.
+        :type ttl: int
+        :param max_entries: The max number of cached values.
+        :type max_entries: int
+        """
+        if max_entries < 1:
+            raise ValueError("Cache max_entries must be a positive number.")
+        with self.lock:
+            self.enabled = enabled
+            self.ttl = ttl
+            self.max_entries = max_entries
+            self._entries.clear()
+
+    def reset_stats(self):
+        """ Resets the hit/miss/eviction counters. """
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    @property
+    def stats(self):
+        """ A dict of the current cache size and hit/miss/eviction counters. """
+        with self.lock:
+            return dict(size=len(self._entries),
+                        hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions)
+
+    def clear(self):
+        """ Removes all cached values. """
+        with self.lock:
+            self._entries.clear()
+
+    def get(self, ciphertext):
+        """
+        Looks up the cleartext for specified ciphertext.
+
+        :param ciphertext: The (encrypted) value.
+        :type ciphertext: str
+        :return: A tuple of (found, cleartext).
+        :rtype: tuple
+        """
+        if not self.enabled:
+            return (False, None)
+
+        digest = hashlib.sha256(ciphertext).digest()
+        with self.lock:
+            try:
+                (cleartext, expires) = self._entries.pop(digest)
+            except KeyError:
+                self.misses += 1
+                return (False, None)
+
+            if expires <= time.time():
+                self.misses += 1
+                return (False, None)
+
+            # Re-insert so that this is now the most-recently-used entry.
+            self._entries[digest] = (cleartext, expires)
+            self.hits += 1
+            return (True, cleartext)
+
+    def put(self, ciphertext, cleartext):
+        """
+        Stores the cleartext for specified ciphertext, evicting the least-recently-used
+        entries if the cache is full.
+
+        :param ciphertext: The (encrypted) value.
+        :type ciphertext: str
+        :param cleartext: The decrypted value.
+        :type cleartext: str
+        """
+        if not self.enabled:
+            return
+
+        digest = hashlib.sha256(ciphertext).digest()
+        with self.lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (cleartext, time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+decrypted_cache = DecryptedValueCache()
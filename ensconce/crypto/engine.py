@@ -6,14 +6,16 @@ http://code.activestate.com/recipes/576980-authenticated-encryption-with-pycrypt
 """
 from __future__ import absolute_import
 
-import hmac
+import struct
 import hashlib
 
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
+from Crypto.Util.strxor import strxor
 
 from ensconce import exc
 from ensconce.crypto import state, MasterKey
+from ensconce.crypto.cache import decrypted_cache
+from ensconce.crypto.padding import padding_policy
+from ensconce.crypto.backends import backend_selector
 from ensconce.autolog import log
 
 # All AES ciphers use a block size of 128 bits.
@@ -28,92 +30,412 @@ PADDING_BYTE = 0x00
 
 SIGNATURE_SIZE = hashlib.sha256().digest_size
 
-def encrypt(cleartext, key=None, chunksize=2048):
+# The HMAC (RFC 2104) inner and outer key pads, as translation tables for XOR-ing the key.
+_HMAC_BLOCK_SIZE = hashlib.sha256().block_size
+_HMAC_INNER_PAD = ''.join(chr(x ^ 0x36) for x in xrange(256))
+_HMAC_OUTER_PAD = ''.join(chr(x ^ 0x5C) for x in xrange(256))
+
+# The number of IVs to read from the RNG at once when encrypting batches.  (Reading
+# from the PyCrypto RNG has a high fixed cost per call.)
+IV_BATCH_SIZE = 64
+
+# Values encrypted with a data key are prefixed with a (signed) header of a format version
+# byte and the id of the data key.  The versions are:
+#
+#   0x01: AES-CBC (padded as above) + HMAC-SHA256 (the same as the headerless format).
+#   0x02: AES-CTR, with the cleartext length encrypted in the first 4 bytes and padded 
+#         with random bytes to a multiple of the chunk size, + HMAC-SHA256.  Since the
+#         padding does not need to be encrypted or decrypted, the AES work depends only
+#         on the length of the cleartext.
+#
+# Since the size of the rest of the value is always a multiple of the AES block size, 
+# the size of the value (modulo the block size) also identifies the format.
+ENVELOPE_CBC_HMAC = 0x01
+ENVELOPE_CTR_HMAC = 0x02
+ENVELOPE_HEADER = struct.Struct('>BI')
+
+# The envelope format for new values.
+ENVELOPE_VERSION = ENVELOPE_CTR_HMAC
+
+CTR_NONCE_SIZE = 12
+CTR_LENGTH = struct.Struct('>I')
+
+_ENVELOPE_SIZES = {ENVELOPE_CBC_HMAC: (ENVELOPE_HEADER.size + AES_BLOCK_SIZE + SIGNATURE_SIZE) % AES_BLOCK_SIZE,
+                   ENVELOPE_CTR_HMAC: (ENVELOPE_HEADER.size + CTR_NONCE_SIZE + SIGNATURE_SIZE) % AES_BLOCK_SIZE}
+
+# The CTR counter blocks (zero nonce + big-endian block counter), precomputed for the
+# first 16KB of a value.
+_CTR_COUNTER_BLOCK = struct.Struct('>12xI')
+_CTR_COUNTERS = ''.join(_CTR_COUNTER_BLOCK.pack(i) for i in xrange(1024))
+
+def encrypt(cleartext, key=None, chunksize=None, key_id=None, version=None):
     """
     Encrypts the specified data.
     
+    By default the data is encrypted with the active data key from the thread-safe
+    ensconce.crypto.state object and the result is prefixed with a header that identifies
+    the data key (the envelope format).  If there are no data keys yet (a database that
+    has not been migrated to data keys) the master key is used and there is no header.
+    
     :param data: The data to encrypt.  If unicode, will be converted to UTF-8.
     :type data: unicode or str
     
-    :param key: An optional explicit master key may be passed if necessary; by default
-                the key from the thread-safe ensconce.crypto.state object is used.
+    :param key: An optional explicit key may be passed if necessary (e.g. to wrap data keys
+                with the master key).  Unless `key_id` is also specified, the result will
+                not have an envelope header.
     :type key: `ensconce.crypto.MasterKey`
     
     :param chunksize: The size (bytes) of the blocks to use for encryption.  This does
                       not have any bearing on how large the cipher blocks are, only how
                       large a the blocks of encrypted data should be (e.g. sufficiently
                       large sizes will prevent leaking information about cleartext
-                      length).  
+                      length).  By default the data is padded according to the 
+                      :data:`ensconce.crypto.padding.padding_policy` size buckets.
     :type chunksize: int
     
-    :returns: The hex-encoded data (16-byte IV + ciphertext) + 32-byte HMAC signature 
+    :param key_id: The id of the (data) key specified in `key` param, for the envelope header.
+    :type key_id: int
+    
+    :param version: The envelope format to write (default is :data:`ENVELOPE_VERSION`); this
+                    can be used to write values that older versions of the application can read.
+    :type version: int
+    
+    :returns: The [5-byte envelope header +] 16-byte IV (or 12-byte nonce) + ciphertext + 32-byte HMAC signature 
     :rtype: str
     """
     if cleartext is None:
         return None
-    elif isinstance(cleartext, unicode):
-        cleartext = cleartext.encode('utf-8')
     
-    assert isinstance(cleartext, str)
+    keyring = _Keyring(key=key, key_id=key_id, version=version)
+    return keyring.encrypt(cleartext, chunksize, backend_selector.current.random_bytes(AES_BLOCK_SIZE))
+
+def decrypt(data, key=None):
+    """
+    Decrypts and authenticates the provided [header +] IV + payload + signature.
+    
+    Values in the envelope format are decrypted using the data key identified in the 
+    header; values without the header are decrypted using the master key.
+    
+    :param data: The [5-byte header +] 16-byte IV + encrypted payload + 32-byte signature. 
+    :type data: str
+    
+    :param key: An optional explicit key may be passed if necessary; by default
+                the keys from the thread-safe ensconce.crypto.state object are used.
+    :type key: ensconce.crypto.MasterKey
+    
+    :return: The cleartext as a (UTF-8) string.
+    :rtype: str or None (if the ciphertext is None)
+    """
+    if data is None or data == "":
+        return None
     
+    keyring = _Keyring(key=key)
+    
+    # The decrypted-value cache is only used with the global key, since it is 
+    # only invalidated when that key changes.
     if key is None:
-        key = state.secret_key
-    assert isinstance(key, MasterKey)
-        
-    cleartext += chr(PADDING_DELIM_BYTE) # Add the delimiter byte to the end. (This needs to be factored in now for padding calculations.)
-     
-    if len(cleartext) % chunksize != 0:
-        padlen = chunksize - (len(cleartext) % chunksize)
+        return _cached_decrypt(data, keyring)
     else:
-        padlen = 0
+        return keyring.decrypt(data)
+
+def encrypt_many(cleartexts, key=None, chunksize=None, key_id=None, version=None):
+    """
+    Encrypts each of the specified values, yielding the results in order.
+    
+    This produces exactly the same format as :func:`encrypt`, but the key is
+    resolved only once and the IVs are read from the RNG in blocks, so it should be
+    preferred for bulk operations.
+    
+    :param cleartexts: An iterable of values to encrypt (unicode, str, or None).
+    :type cleartexts: iterable
+    
+    :param key: An optional explicit key may be passed if necessary (see :func:`encrypt`).
+    :type key: `ensconce.crypto.MasterKey`
     
-    # We are going to use the AES block size here rather than the specified block size.
-    iv_bytes = get_random_bytes(AES_BLOCK_SIZE)
+    :param chunksize: The size (bytes) of the blocks to use for encryption (see :func:`encrypt`).
+    :type chunksize: int
     
-    cypher = AES.new(key.encryption_key, AES.MODE_CBC, iv_bytes)
+    :param key_id: The id of the (data) key specified in `key` param, for the envelope header.
+    :type key_id: int
     
-    ciphertext = cypher.encrypt(cleartext + (padlen * chr(PADDING_BYTE)))
-    data = iv_bytes + ciphertext
-    sig = hmac.new(key.signing_key, data, hashlib.sha256).digest()
+    :param version: The envelope format to write (see :func:`encrypt`).
+    :type version: int
     
-    return data + sig
+    :returns: A generator of encrypted values (see :func:`encrypt`).
+    :rtype: generator
+    """
+    keyring = _Keyring(key=key, key_id=key_id, version=version)
+    ivs = _random_ivs()
+    for cleartext in cleartexts:
+        if cleartext is None:
+            yield None
+        else:
+            yield keyring.encrypt(cleartext, chunksize, next(ivs))
 
-def decrypt(data, key=None):
+def decrypt_many(values, key=None):
+    """
+    Decrypts and authenticates each of the specified values, yielding the results in order.
+    
+    This is the batch equivalent of :func:`decrypt`; the keys are resolved only once.
+    
+    :param values: An iterable of [header +] IV + encrypted payload + signature values (or None).
+    :type values: iterable
+    
+    :param key: An optional explicit key may be passed if necessary; by default
+                the keys from the thread-safe ensconce.crypto.state object are used.
+    :type key: ensconce.crypto.MasterKey
+    
+    :returns: A generator of cleartext (UTF-8) strings (or None for empty values).
+    :rtype: generator
+    :raise ensconce.exc.CryptoAuthenticationFailed: If any of the values fails to authenticate.
+    """
+    keyring = _Keyring(key=key)
+    for data in values:
+        if key is None:
+            yield _cached_decrypt(data, keyring)
+        else:
+            yield keyring.decrypt(data)
+
+def parse_envelope(data):
+    """
+    Gets the envelope format version and data key id of the value.
+    
+    :param data: The encrypted value.
+    :type data: str
+    :return: A tuple of (version, key_id), or None if the value is not in the envelope 
+             format (i.e. it was encrypted directly with a master key).
+    :rtype: tuple
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    if data and _ENVELOPE_SIZES.get(ord(data[0])) == len(data) % AES_BLOCK_SIZE:
+        return ENVELOPE_HEADER.unpack_from(data)
+    return None
+
+def parse_key_id(data):
     """
-    Decrypts and authenticates the provided IV + payload + signature.
+    Gets the id of the data key that was used to encrypt the value.
     
-    :param data: The 16-byte IV + encrypted payload + 32-byte signature. 
+    :param data: The encrypted value.
     :type data: str
+    :return: The data key id, or None if the value is not in the envelope format (i.e.
+             it was encrypted directly with a master key).
+    :rtype: int
+    """
+    envelope = parse_envelope(data)
+    return envelope[1] if envelope else None
+
+class KeyContext(object):
+    """
+    A key with its precomputed HMAC key pads and AES key schedule.
     
-    :param key: An optional explicit master key may be passed if necessary; by default
-                the key from the thread-safe ensconce.crypto.state object is used.
+    A context is never modified after it has been created, so it can be shared by
+    any number of threads (e.g. in the :class:`ensconce.crypto.KeySnapshot`).
+    
+    :param key: The key to prepare.
     :type key: ensconce.crypto.MasterKey
+    :param backend: The implementation of the primitives (default is the selected backend).
+    :type backend: ensconce.crypto.backends.CryptoBackend
+    """
+    def __init__(self, key, backend=None):
+        assert isinstance(key, MasterKey)
+        self.key = key
+        if backend is None:
+            backend = backend_selector.current
+        
+        # The hash states after the inner and outer HMAC key pads; each signature 
+        # just copies these, rather than re-hashing the pads.
+        signing_key = key.signing_key
+        if len(signing_key) > _HMAC_BLOCK_SIZE:
+            signing_key = hashlib.sha256(signing_key).digest()
+        signing_key = signing_key.ljust(_HMAC_BLOCK_SIZE, chr(0))
+        self._inner = backend.mac_hash(signing_key.translate(_HMAC_INNER_PAD))
+        self._outer = backend.mac_hash(signing_key.translate(_HMAC_OUTER_PAD))
+        
+        # CBC decryption of each block only depends on the (already known) previous
+        # ciphertext block, so we can use one ECB cipher for many values and
+        # XOR the result with the shifted ciphertext.  (The ECB cipher is also used
+        # to create the CTR keystreams.)
+        self.block_cypher = backend.block_cipher(key.encryption_key)
     
-    :return: The cleartext as a (UTF-8) string.
-    :rtype: str or None (if the ciphertext is None)
+    def sign(self, data):
+        """
+        Computes the HMAC-SHA256 signature of the data.
+        
+        :rtype: str
+        """
+        inner = self._inner.copy()
+        inner.update(data)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+class _Keyring(object):
+    """
+    The keys (resolved once) for encrypting or decrypting one or more values.
+    
+    By default this uses the current :class:`ensconce.crypto.KeySnapshot` (and its
+    prepared contexts), so no locking is needed.
+    
+    :param key: An explicit key to use instead of the keys from ensconce.crypto.state.
+    :type key: ensconce.crypto.MasterKey
+    :param key_id: The data key id for the explicit key, if the envelope format should be written.
+    :type key_id: int
+    :param version: The envelope format version to write.
+    :type version: int
+    """
+    def __init__(self, key=None, key_id=None, version=None):
+        self.version = ENVELOPE_VERSION if version is None else version
+        if self.version not in _ENVELOPE_SIZES:
+            raise ValueError("Unsupported envelope version: {0!r}".format(version))
+        if key is None:
+            snapshot = state.snapshot
+            self.master_key = snapshot.master_key
+            self.data_keys = snapshot.data_keys
+            self.contexts = snapshot.contexts
+            (self.write_key_id, self.write_key) = snapshot.active_data_key or (None, self.master_key)
+        else:
+            assert isinstance(key, MasterKey)
+            self.master_key = key
+            self.data_keys = None # Any key id will be read using the explicit key.
+            self.contexts = {key: KeyContext(key)}
+            (self.write_key_id, self.write_key) = (key_id, key)
+        
+        if self.write_key_id is None:
+            self.header = ''
+        else:
+            self.header = ENVELOPE_HEADER.pack(self.version, self.write_key_id)
+    
+    def encrypt(self, cleartext, chunksize, iv_bytes):
+        """ Encrypts the value using the write key. """
+        if self.header and self.version == ENVELOPE_CTR_HMAC:
+            return _encrypt_ctr(cleartext, self.contexts[self.write_key], chunksize, iv_bytes[:CTR_NONCE_SIZE], header=self.header)
+        return _encrypt(cleartext, self.contexts[self.write_key], chunksize, iv_bytes, header=self.header)
+    
+    def decrypt(self, data):
+        """ Decrypts the value using the key identified by the envelope header (or the master key). """
+        if data is None or data == "":
+            return None
+        elif isinstance(data, unicode):
+            data = data.encode('utf-8')
+        
+        envelope = parse_envelope(data)
+        if envelope is None:
+            return _decrypt(data, self.contexts[self.master_key])
+        
+        (version, key_id) = envelope
+        
+        if self.data_keys is None:
+            key = self.master_key
+        elif key_id in self.data_keys:
+            key = self.data_keys[key_id]
+        else:
+            # This may be a data key that was created after our snapshot was taken.
+            try:
+                key = state.data_key(key_id)
+            except KeyError:
+                raise exc.CryptoAuthenticationFailed("Value is encrypted with unknown data key: {0}".format(key_id))
+            # (Copy, rather than modify, the snapshot's dicts.)
+            self.data_keys = dict(self.data_keys)
+            self.data_keys[key_id] = key
+            self.contexts = dict(self.contexts)
+            self.contexts[key] = KeyContext(key)
+        
+        if version == ENVELOPE_CTR_HMAC:
+            return _decrypt_ctr(data, self.contexts[key], header_size=ENVELOPE_HEADER.size)
+        return _decrypt(data, self.contexts[key], header_size=ENVELOPE_HEADER.size)
+
+def _random_ivs():
+    """
+    Generator that yields random IVs, reading them from the RNG IV_BATCH_SIZE at a time.
+    """
+    while True:
+        random_bytes = backend_selector.current.random_bytes(AES_BLOCK_SIZE * IV_BATCH_SIZE)
+        for i in xrange(0, len(random_bytes), AES_BLOCK_SIZE):
+            yield random_bytes[i:i + AES_BLOCK_SIZE]
+
+def _padding_length(length, chunksize=None):
+    """
+    Gets the number of padding bytes to add to data of specified length.
+    
+    :param chunksize: Pad to a multiple of this size, rather than using the padding policy.
+    :type chunksize: int
+    """
+    if chunksize is None:
+        return padding_policy.padded_size(length) - length
+    
+    assert chunksize % AES_BLOCK_SIZE == 0
+    if length % chunksize != 0:
+        return chunksize - (length % chunksize)
+    else:
+        return 0
+
+def _encrypt(cleartext, context, chunksize, iv_bytes, header=''):
+    """
+    Encrypts the specified data with an already-resolved key context and IV.
+    
+    :param context: The prepared key.
+    :type context: :class:`KeyContext`
+    :param header: The (envelope) header to prefix the data with; this is also signed.
+    :type header: str
+    :see: :func:`encrypt`
+    """
+    if cleartext is None:
+        return None
+    elif isinstance(cleartext, unicode):
+        cleartext = cleartext.encode('utf-8')
+    
+    assert isinstance(cleartext, str)
+    
+    cleartext += chr(PADDING_DELIM_BYTE) # Add the delimiter byte to the end. (This needs to be factored in now for padding calculations.)
+     
+    padlen = _padding_length(len(cleartext), chunksize)
+    
+    # (Note that the IV is the AES block size rather than the specified block size.)
+    ciphertext = context.block_cypher.cbc_encrypt(iv_bytes, cleartext + (padlen * chr(PADDING_BYTE)))
+    data = header + iv_bytes + ciphertext
+    
+    return data + context.sign(data)
+
+def _cached_decrypt(data, keyring):
+    """
+    Decrypts data using the decrypted-value cache (if it is enabled).
+    
+    :see: :meth:`_Keyring.decrypt`
     """
     if data is None or data == "":
         return None
     elif isinstance(data, unicode):
         data = data.encode('utf-8')
     
-    assert isinstance(data, str)
+    (found, cleartext) = decrypted_cache.get(data)
+    if not found:
+        cleartext = keyring.decrypt(data)
+        decrypted_cache.put(data, cleartext)
+    return cleartext
 
-    if key is None:
-        key = state.secret_key
-    assert isinstance(key, MasterKey)
+def _decrypt(data, context, header_size=0):
+    """
+    Decrypts and authenticates data with an already-resolved key context.
+    
+    :param context: The prepared key.
+    :type context: :class:`KeyContext`
+    :param header_size: The length of the (signed) header that precedes the IV.
+    :type header_size: int
+    :see: :func:`decrypt`
+    """
+    assert isinstance(data, str)
 
     sig = data[-SIGNATURE_SIZE:]
     data = data[:-SIGNATURE_SIZE]
-    if hmac.new(key.signing_key, data, hashlib.sha256).digest() != sig:
+    if context.sign(data) != sig:
         raise exc.CryptoAuthenticationFailed()
     
-    # The first block is the IV
-    iv_bytes = data[:AES_BLOCK_SIZE]
-    data = data[AES_BLOCK_SIZE:]
+    # The first block (after any header) is the IV
+    iv_bytes = data[header_size:header_size + AES_BLOCK_SIZE]
+    data = data[header_size + AES_BLOCK_SIZE:]
     
-    cypher = AES.new(key.encryption_key, AES.MODE_CBC, iv_bytes)
-    cleartext = cypher.decrypt(data)
+    cleartext = strxor(context.block_cypher.decrypt(data), iv_bytes + data[:-AES_BLOCK_SIZE])
     
     # Remove all the trailing padding bytes.
     cleartext = cleartext.rstrip(chr(PADDING_BYTE))
@@ -121,4 +443,83 @@ def decrypt(data, key=None):
     # Remove the delimiter byte
     cleartext = cleartext[:-1]
     
-    return cleartext
\ No newline at end of file
+    return cleartext
+
+def _keystream(context, nonce, length):
+    """
+    Creates (at least) `length` bytes of AES-CTR keystream for the nonce.
+    
+    The counter blocks are the 12-byte nonce + a 4-byte block counter; they are all 
+    encrypted with a single ECB cipher call.
+    """
+    blocks = -(-length // AES_BLOCK_SIZE) # (ceiling division)
+    counters = _CTR_COUNTERS[:blocks * AES_BLOCK_SIZE]
+    if len(counters) < blocks * AES_BLOCK_SIZE:
+        first = len(counters) // AES_BLOCK_SIZE
+        counters += ''.join(_CTR_COUNTER_BLOCK.pack(i) for i in xrange(first, blocks))
+    # (nonce + zeros) XOR (zeros + counter) == nonce + counter
+    nonces = (nonce + '\0' * (AES_BLOCK_SIZE - CTR_NONCE_SIZE)) * blocks
+    return context.block_cypher.encrypt(strxor(nonces, counters))
+
+def _encrypt_ctr(cleartext, context, chunksize, nonce, header):
+    """
+    Encrypts the specified data in the AES-CTR envelope format.
+    
+    :param context: The prepared key.
+    :type context: :class:`KeyContext`
+    :param nonce: The (random) 12-byte nonce.
+    :type nonce: str
+    :param header: The envelope header to prefix the data with; this is also signed.
+    :type header: str
+    :see: :func:`encrypt`
+    """
+    if cleartext is None:
+        return None
+    elif isinstance(cleartext, unicode):
+        cleartext = cleartext.encode('utf-8')
+    
+    assert isinstance(cleartext, str)
+    
+    cleartext = CTR_LENGTH.pack(len(cleartext)) + cleartext
+    
+    padlen = _padding_length(len(cleartext), chunksize)
+    
+    ciphertext = strxor(cleartext, _keystream(context, nonce, len(cleartext))[:len(cleartext)])
+    
+    # (Random padding is indistinguishable from the ciphertext, so it does not need to be encrypted.)
+    data = header + nonce + ciphertext + (backend_selector.current.random_bytes(padlen) if padlen else '')
+    
+    return data + context.sign(data)
+
+def _decrypt_ctr(data, context, header_size):
+    """
+    Decrypts and authenticates data in the AES-CTR envelope format.
+    
+    Only the (length-prefixed) cleartext is decrypted, not the padding.
+    
+    :param context: The prepared key.
+    :type context: :class:`KeyContext`
+    :param header_size: The length of the (signed) header that precedes the nonce.
+    :type header_size: int
+    :see: :func:`decrypt`
+    """
+    assert isinstance(data, str)
+    
+    sig = data[-SIGNATURE_SIZE:]
+    data = data[:-SIGNATURE_SIZE]
+    if context.sign(data) != sig:
+        raise exc.CryptoAuthenticationFailed()
+    
+    nonce = data[header_size:header_size + CTR_NONCE_SIZE]
+    data = data[header_size + CTR_NONCE_SIZE:]
+    
+    keystream = _keystream(context, nonce, AES_BLOCK_SIZE)
+    (length,) = CTR_LENGTH.unpack(strxor(data[:CTR_LENGTH.size], keystream[:CTR_LENGTH.size]))
+    end = CTR_LENGTH.size + length
+    if end > len(data):
+        raise exc.CryptoError("Invalid cleartext length in (authenticated) data.")
+    
+    if end > len(keystream):
+        keystream = _keystream(context, nonce, end)
+    
+    return strxor(data[:end], keystream[:end])[CTR_LENGTH.size:]
@@ -5,13 +5,17 @@ It's really bad, so this module only exists to provide an upgrade path.
 """
 from __future__ import absolute_import
 
+import re
 import binascii
 import base64
 
-from Crypto.Cipher import AES
-
 from ensconce import exc
 from ensconce.autolog import log
+from ensconce.crypto.backends import backend_selector
+
+# The legacy values are the number of padding bytes ("%02d", which is at most 15) + the 
+# hex-encoded ciphertext (a multiple of the 16-byte block size).
+_LEGACY_FORMAT = re.compile(r'^(0\d|1[0-5])(?:[0-9a-f]{32})+$')
 
 def create_engine(key):
     """
@@ -23,7 +27,7 @@ def create_engine(key):
     :param key: An optional explicit key may be passed if necessary; by default
                 the key from the thread-safe ensconce.crypto.state object is used.
     :type key: str
-    :returns: A new :class:`AES` object initialized with the symmetric key.
+    :returns: A new (ECB) AES cipher initialized with the symmetric key.
     :raise ensconce.exc.CryptoNotInitialized: If no key is specified and no key
                 has yet been configured in global state.
     """
@@ -32,7 +36,7 @@ def create_engine(key):
         key = key.encode('utf-8')
     assert isinstance(key, str)
     assert len(key) == 32
-    return AES.new(key, AES.MODE_ECB)
+    return backend_selector.current.block_cipher(key)
 
 def encrypt(cleartext, key):
     """
@@ -108,4 +112,26 @@ def decrypt(ciphertext, key):
         
     cleartext = base64.b64decode(encoded)
     
-    return cleartext
\ No newline at end of file
+    return cleartext
+
+def parse_stored(data):
+    """
+    Gets the legacy ciphertext from a stored value.
+    
+    The value may be either the original (hex) string or, if the column has since been
+    converted to a native binary column, the hex-decoded bytes.
+    
+    :param data: The value as stored in the database.
+    :type data: str
+    :return: The legacy ciphertext (padding prefix + hex), or None if the value is not 
+             in the legacy format.
+    :rtype: str
+    """
+    if not data:
+        return None
+    if _LEGACY_FORMAT.match(data):
+        return data
+    hexed = binascii.hexlify(data)
+    if _LEGACY_FORMAT.match(hexed):
+        return hexed
+    return None
@@ -0,0 +1,55 @@
+"""
+The padding policy for encrypted values.
+
+Values are padded before they are stored, so that the ciphertext does not reveal the
+length of the cleartext.  Rather than padding everything to a (large) fixed chunk size,
+values are padded up to the smallest of a set of size buckets, so that only the length
+class of a value (e.g. "a password" vs. "a long note") is revealed.  Values that are
+larger than the largest bucket are padded to a multiple of the largest bucket.
+"""
+from __future__ import absolute_import
+
+# All bucket sizes must be multiples of the AES block size.
+BLOCK_SIZE = 16
+
+DEFAULT_BUCKETS = (32, 128, 512, 2048)
+
+class PaddingPolicy(object):
+    """
+    Determines the padded size of values from a list of bucket sizes.
+    """
+    buckets = None
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.configure(buckets)
+
+    def configure(self, buckets):
+        """
+        (Re)configure the bucket sizes.
+
+        :param buckets: The (positive) bucket sizes, which must be multiples of 16.
+        :type buckets: list
+        """
+        buckets = tuple(sorted(set(int(b) for b in buckets)))
+        if not buckets:
+            raise ValueError("At least one padding bucket size must be specified.")
+        for b in buckets:
+            if b <= 0 or b % BLOCK_SIZE != 0:
+                raise ValueError("Padding bucket sizes must be positive multiples of {0}: {1}".format(BLOCK_SIZE, b))
+        self.buckets = buckets
+
+    def padded_size(self, length):
+        """
+        Gets the size that a value of specified length should be padded to.
+
+        :param length: The (unpadded) length of the value.
+        :type length: int
+        :rtype: int
+        """
+        for b in self.buckets:
+            if length <= b:
+                return b
+        largest = self.buckets[-1]
+        return -(-length // largest) * largest # (ceiling division)
+
+padding_policy = PaddingPolicy()
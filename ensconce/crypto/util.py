@@ -1,19 +1,45 @@
 """
 Database crypto.
 """
+import time
 import binascii
+import multiprocessing
+from collections import namedtuple, defaultdict
 
-from sqlalchemy import func, and_
+from sqlalchemy import orm, func, and_, select, bindparam, literal, LargeBinary
+from sqlalchemy.sql.expression import type_coerce
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
+from Crypto import Random
 from Crypto.Random import get_random_bytes
 from Crypto.Protocol.KDF import PBKDF2
 
 from ensconce import model, exc
 from ensconce.model import meta
-from ensconce.crypto import engine, state, MasterKey, CombinedMasterKey
+from ensconce.crypto import engine, legacy_engine, blindindex, state, MasterKey, CombinedMasterKey
+from ensconce.crypto.padding import padding_policy
 from ensconce.autolog import log
 
+# The encrypted columns in the database.
+ENCRYPTED_COLUMNS = (model.passwords_table.c.password,
+                     model.password_history_table.c.password,
+                     model.resources_table.c.notes)
+
+class ReencryptProgress(namedtuple('ReencryptProgress', ['table', 'rows', 'total', 'elapsed', 'bytes_before', 'bytes_after'])):
+    """
+    The progress of re-encrypting a table: rows done (of total) in elapsed seconds, and
+    the stored size of those rows' values before and after.
+    """
+    @property
+    def rate(self):
+        """ The throughput in rows/second. """
+        return (self.rows / self.elapsed) if self.elapsed else 0.0
+    
+    @property
+    def bytes_saved(self):
+        """ The reduction in the stored size of the values. """
+        return self.bytes_before - self.bytes_after
+
 def configure_crypto_state(passphrase):
     """
     Convenience function to sets up the shared crypto state using the specified passphrase.
@@ -184,6 +210,49 @@ def create_key_validation_payload(key=None):
     some_bytes = get_random_bytes(256)
     return engine.encrypt(some_bytes, key=key)
 
+def create_data_key(key):
+    """
+    Creates a new (random) data key and stores it, wrapped with the specified master key.
+    
+    The new key will be used to encrypt data once the crypto state is (re)initialized.
+    
+    :param key: The master key to wrap the data key with.
+    :type key: ensconce.crypto.MasterKey
+    :return: A tuple of the (id, key) for the new data key.
+    :rtype: tuple
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    """
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    data_key = CombinedMasterKey(get_random_bytes(64))
+    dk = model.DataKey()
+    dk.wrapped_key = engine.encrypt(data_key.encryption_key + data_key.signing_key, key=key)
+    session.add(dk)
+    session.flush()
+    log.info("Created new data key: {0}".format(dk))
+    return (dk.id, data_key)
+
+def load_data_keys(key):
+    """
+    Loads and unwraps all of the data keys using the specified master key.
+    
+    :param key: The master key that the data keys are wrapped with.
+    :type key: ensconce.crypto.MasterKey
+    :return: A dict of the (unwrapped) data keys, keyed by id.
+    :rtype: dict
+    :raise ensconce.exc.CryptoAuthenticationFailed: If a data key was not wrapped with this key.
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    """
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    data_keys = session.query(model.DataKey).all()
+    unwrapped = engine.decrypt_many([dk.wrapped_key for dk in data_keys], key=key)
+    return dict((dk.id, CombinedMasterKey(k)) for (dk, k) in zip(data_keys, unwrapped))
+
 def clear_key_metadata():
     """
     This is a utility function (built for testing) that just removes any key_metadata
@@ -252,6 +321,26 @@ def initialize_key_metadata(key, salt, force_overwrite=False, nested_transaction
         km.validation = create_key_validation_payload(key=key)
         km.kdf_salt = salt
         session.add(km)
+        
+        # Any (left-over) data keys that were not wrapped with this key are useless now.
+        data_keys = {}
+        for dk in session.query(model.DataKey).all():
+            try:
+                data_keys[dk.id] = CombinedMasterKey(engine.decrypt(dk.wrapped_key, key=key))
+            except exc.CryptoAuthenticationFailed:
+                session.delete(dk)
+                log.warning("Forcibly removing existing data key: {0}".format(dk))
+        
+        if not data_keys:
+            (data_key_id, data_key) = create_data_key(key)
+            data_keys[data_key_id] = data_key
+        
+        # The notes index may have been built with another secret, so it is only known to be
+        # current if there are no notes yet.
+        r_t = model.resources_table
+        if not session.query(func.count(r_t.c.id)).filter(and_(r_t.c.notes != None, r_t.c.notes != '')).scalar():
+            km.index_check = blindindex.index_key(blindindex.secret_key(key, data_keys)).check
+        
         if not nested_transaction:
             session.commit() # We are deliberately committing early here
         else:
@@ -267,7 +356,13 @@ def initialize_key_metadata(key, salt, force_overwrite=False, nested_transaction
 def replace_key(new_key, force=False):
     """
     Replaces the database key.  If there are encrypted contents in the database, you
-    must specify force=True which will *reencrypt* the database contents with the new key.
+    must specify force=True.
+    
+    The database contents are encrypted with data keys, so this only needs to re-wrap
+    the data keys with the new key.  If the database pre-dates data keys, a data key is 
+    created and all of the contents are *reencrypted* with it; the blind index of the
+    notes (whose key is derived from the first data key, if there is one) is then rebuilt
+    with the new data key (see :func:`rebuild_notes_index`).
     
     This is dangerous.
     
@@ -299,32 +394,26 @@ def replace_key(new_key, force=False):
         try:
             key_info = session.query(model.KeyMetadata).one()
             
-            pass_t = model.passwords_table
-            
-            # Re-encrypt all of the passwords with the new key.
-            for pw in session.query(model.Password).filter(and_(pass_t.c.password != None, pass_t.c.password != '')):
-                # Important: set the *encrypted* password here (not password_decrypted)
-                pw.password = engine.encrypt(pw.password_decrypted, key=new_key)
-                
-            session.flush()
-            
-            ph_t = model.password_history_table
-            for pwh in session.query(model.PasswordHistory).filter(and_(ph_t.c.password != None, ph_t.c.password != '')):
-                # Important: set the *encrypted* password here (not password_decrypted)
-                pwh.password = engine.encrypt(pwh.password_decrypted, key=new_key) 
-            
-            session.flush()
-            
-            # Re-encrypt all of the notes fields for resources 
-            resources_t = model.resources_table
-            for rsc in session.query(model.Resource).filter(and_(resources_t.c.notes != None, resources_t.c.notes != '')):
-                # Important: set the *encrypted* password here (not password_decrypted)
-                rsc.notes = engine.encrypt(rsc.notes_decrypted, key=new_key)
+            data_keys = session.query(model.DataKey).all()
+            rebuild_index = not data_keys
+            if data_keys:
+                # Only the data keys need to be re-wrapped; the database contents are unchanged.
+                unwrapped = engine.decrypt_many([dk.wrapped_key for dk in data_keys], key=state.secret_key)
+                for (dk, wrapped_key) in zip(data_keys, engine.encrypt_many(unwrapped, key=new_key)):
+                    dk.wrapped_key = wrapped_key
+            else:
+                (data_key_id, data_key) = create_data_key(new_key)
+                _reencrypt_all(data_key, key_id=data_key_id)
                 
             session.flush()
             
             key_info.validation = create_key_validation_payload(key=new_key)
             
+            if rebuild_index:
+                # The notes index must be rebuilt for the new data key (from the start).
+                key_info.index_check = None
+                session.query(model.Checkpoint).filter_by(name=NOTES_INDEX_CHECKPOINT).delete(synchronize_session=False)
+            
             session.flush()
             
             state.secret_key = new_key
@@ -339,4 +428,561 @@ def replace_key(new_key, force=False):
             raise
         else:
             session.commit()
+    
+    if rebuild_index:
+        rebuild_notes_index()
+
+def _reencrypt_all(new_key, key_id=None):
+    """
+    Re-encrypts all of the encrypted database contents with the new key.
+    
+    :param new_key: The new encryption key.
+    :type new_key: ensconce.crypto.MasterKey
+    :param key_id: The data key id (if `new_key` is a data key).
+    :type key_id: int
+    """
+    session = meta.Session()
+    
+    pass_t = model.passwords_table
+    
+    # Re-encrypt all of the passwords with the new key.
+    # Important: set the *encrypted* password here (not password_decrypted)
+    pws = session.query(model.Password).options(orm.undefer('password')).filter(and_(pass_t.c.password != None, pass_t.c.password != '')).all()
+    _reencrypt_attribute(pws, 'password', new_key, key_id=key_id)
+        
+    session.flush()
+    
+    ph_t = model.password_history_table
+    pwhs = session.query(model.PasswordHistory).options(orm.undefer('password')).filter(and_(ph_t.c.password != None, ph_t.c.password != '')).all()
+    _reencrypt_attribute(pwhs, 'password', new_key, key_id=key_id)
+    
+    session.flush()
+    
+    # Re-encrypt all of the notes fields for resources 
+    resources_t = model.resources_table
+    rscs = session.query(model.Resource).options(orm.undefer('notes')).filter(and_(resources_t.c.notes != None, resources_t.c.notes != '')).all()
+    _reencrypt_attribute(rscs, 'notes', new_key, key_id=key_id)
+        
+    session.flush()
+
+def _reencrypt_attribute(entities, attrib, new_key, key_id=None):
+    """
+    Re-encrypts the (encrypted) attribute of all specified entities with the new key.
+    
+    This uses the batch engine functions, so the current key is only resolved once
+    for the entire list.
+    
+    :param entities: The model objects to update.
+    :type entities: list
+    :param attrib: The name of the encrypted attribute (e.g. 'password').
+    :type attrib: str
+    :param new_key: The new encryption key.
+    :type new_key: ensconce.crypto.MasterKey
+    :param key_id: The data key id (if `new_key` is a data key).
+    :type key_id: int
+    """
+    cleartexts = engine.decrypt_many(getattr(e, attrib) for e in entities)
+    for (entity, ciphertext) in zip(entities, engine.encrypt_many(cleartexts, key=new_key, key_id=key_id)):
+        setattr(entity, attrib, ciphertext)
+
+# The number of times that :func:`reencrypt_data` sweeps a table again for values that were
+# (concurrently) written with an older data key.
+REENCRYPT_SWEEPS = 5
+
+def rotate_data_key(batch_size=500, progress=None, processes=1):
+    """
+    Creates a new data key and re-encrypts the database contents with it.
+    
+    This is an online operation: the contents are re-encrypted in batches (each
+    committed separately), while readers can decrypt with either data key.
+    
+    :param batch_size: The number of rows to re-encrypt per transaction.
+    :type batch_size: int
+    :param progress: A callable that will be passed a :class:`ReencryptProgress` after each batch.
+    :type progress: callable
+    :param processes: The number of worker processes to use for the crypto work (see :func:`reencrypt_data`).
+    :type processes: int
+    :return: The number of re-encrypted values.
+    :rtype: int
+    :raise ensconce.exc.CryptoNotInitialized: If the engine has not been initialized.
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    """
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    try:
+        create_data_key(state.secret_key)
+        session.commit()
+    except:
+        session.rollback()
+        log.exception("Error creating new data key.")
+        raise
+    
+    return reencrypt_data(batch_size=batch_size, progress=progress, processes=processes)
+
+def reencrypt_data(batch_size=500, progress=None, processes=1, repad=False):
+    """
+    Re-encrypts any database contents that are not encrypted with the newest data key.
+    
+    With `repad`, all of the database contents are re-encrypted instead, and values are 
+    rewritten if the current padding policy changes their size (e.g. to shrink values
+    that were padded to the old fixed 2048-byte chunks).
+    
+    Rows are processed in id order, in batches that are each committed with a checkpoint,
+    so this can be resumed (by calling it again) if it is interrupted.  Rows that are 
+    modified concurrently are skipped for that batch.  Since other (already running) 
+    processes keep encrypting with the data key that they have loaded until they load the
+    new one, values may also be written with an older key behind the checkpoint; so once 
+    the end of a table is reached, the table is swept again from the start, until a sweep 
+    finds no values to re-encrypt.  If values are still being written with an older key 
+    after :data:`REENCRYPT_SWEEPS` sweeps, this fails (leaving the checkpoints), and can be
+    run again once those processes have been restarted.
+    
+    The decryption/encryption is CPU-bound, so with `processes` > 1 each batch is split 
+    across a pool of worker processes (that hold the keys); this process only reads the
+    batches and writes the results back.  Use a correspondingly larger `batch_size`.
+    
+    :param batch_size: The number of rows to re-encrypt per transaction.
+    :type batch_size: int
+    :param progress: A callable that will be passed a :class:`ReencryptProgress` after each batch.
+    :type progress: callable
+    :param processes: The number of worker processes to use for the crypto work.
+    :type processes: int
+    :param repad: Whether to re-encrypt all values (and rewrite those that change size).
+    :type repad: bool
+    :return: The number of re-encrypted (rewritten) values.
+    :rtype: int
+    :raise ensconce.exc.CryptoNotInitialized: If the engine has not been initialized.
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    """
+    if not state.initialized:
+        raise exc.CryptoNotInitialized()
+    
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    key_id = session.query(func.max(model.DataKey.id)).scalar()
+    if key_id is None:
+        raise exc.CryptoError("There are no data keys to re-encrypt with.")
+    state.data_key(key_id) # (Make sure that we have loaded the key.)
+    header = engine.ENVELOPE_HEADER.pack(engine.ENVELOPE_VERSION, key_id)
+    
+    keys = (MasterKey(*state.secret_key), 
+            dict((i, MasterKey(*k)) for (i, k) in state.data_keys.items()),
+            key_id)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_reencrypt_worker, initargs=(keys, padding_policy.buckets))
+    else:
+        pool = None
+    
+    operation = 'repad' if repad else 'reencrypt'
+    reencrypted = 0
+    for col in ENCRYPTED_COLUMNS:
+        table = col.table
+        name = '{0}:{1}:{2}'.format(operation, key_id, table.name)
+        try:
+            checkpoint = _load_checkpoint(session, name)
+            if checkpoint.position:
+                log.info("Resuming re-encryption of {0} after id {1}".format(table.name, checkpoint.position))
+            
+            if repad:
+                pending = and_(col != None, col != '')
+            else:
+                # (Values that are still hex-encoded never match the header, so they are re-written too.)
+                prefix = func.substr(col, 1, engine.ENVELOPE_HEADER.size, type_=LargeBinary)
+                pending = and_(col != None, col != '', prefix != literal(header, LargeBinary))
+            total = session.query(func.count(table.c.id)).filter(and_(table.c.id > checkpoint.position, pending)).scalar()
+            
+            # Only update the rows that have not been changed since we read them.  (The guard compares
+            # the raw stored value, since it may not be stored in binary yet.)
+            stored_col = type_coerce(col, LargeBinary).label('stored')
+            update = (table.update()
+                      .where(and_(table.c.id == bindparam('_id'), col == bindparam('_old', type_=LargeBinary)))
+                      .values({col.name: bindparam('_new', type_=col.type)}))
+            rows_done = 0
+            rows_written = 0
+            bytes_before = 0
+            bytes_after = 0
+            start = time.time()
+            (pass_start, pass_rows, sweeps) = (checkpoint.position, 0, 0)
+            while True:
+                rows = session.execute(select([table.c.id, stored_col])
+                                       .where(and_(table.c.id > checkpoint.position, pending))
+                                       .order_by(table.c.id)
+                                       .limit(batch_size)).fetchall()
+                if not rows:
+                    if repad or (pass_start == 0 and pass_rows == 0):
+                        break
+                    # Sweep the table again for values written (behind the checkpoint) with an older data key.
+                    if sweeps == REENCRYPT_SWEEPS:
+                        raise exc.CryptoError("Values in {0} are still being written with an older data key; restart the "
+                                              "application servers (to load data key {1}) and run this again.".format(table.name, key_id))
+                    sweeps += 1
+                    checkpoint.position = 0
+                    session.commit()
+                    (pass_start, pass_rows) = (0, 0)
+                    total = rows_done + session.query(func.count(table.c.id)).filter(pending).scalar()
+                    continue
+                
+                stored = [row['stored'] for row in rows]
+                values = [col.type.process_result_value(v, None) for v in stored]
+                if pool is not None:
+                    chunksize = -(-len(values) // processes) # (ceiling division)
+                    chunks = [values[i:i + chunksize] for i in xrange(0, len(values), chunksize)]
+                    ciphertexts = [c for chunk in pool.map(_reencrypt_values, chunks) for c in chunk]
+                else:
+                    ciphertexts = _reencrypt_values(values, keys=keys)
+                
+                params = [{'_id': row[table.c.id], '_old': old, '_new': new}
+                          for (row, old, new) in zip(rows, stored, ciphertexts)
+                          if not repad or len(new) != len(old)]
+                if params:
+                    session.execute(update, params)
+                
+                checkpoint.position = rows[-1][table.c.id]
+                session.commit()
+                
+                rows_done += len(rows)
+                rows_written += len(params)
+                pass_rows += len(rows)
+                size = sum(len(v) for v in stored)
+                bytes_before += size
+                bytes_after += size + sum(len(p['_new']) - len(p['_old']) for p in params)
+                if progress is not None:
+                    progress(ReencryptProgress(table=table.name, rows=rows_done, total=total, elapsed=time.time() - start,
+                                               bytes_before=bytes_before, bytes_after=bytes_after))
+            
+            reencrypted += rows_written
+        except:
+            session.rollback()
+            if pool is not None:
+                pool.terminate()
+            log.exception("Error re-encrypting {0}; this can be resumed from last checkpoint.".format(table.name))
+            raise
+    
+    if pool is not None:
+        pool.close()
+        pool.join()
+    
+    session.query(model.Checkpoint).filter(model.Checkpoint.name.like('{0}:{1}:%'.format(operation, key_id))).delete(synchronize_session=False)
+    session.commit()
+    
+    log.info("Re-encrypted {0} values with data key {1}".format(reencrypted, key_id))
+    return reencrypted
+
+# The (master key, data keys, new data key id) for re-encrypting values in this process.
+_reencrypt_keys = None
+
+def _init_reencrypt_worker(keys, padding_buckets):
+    """
+    Initializes the keys (and padding policy) for :func:`_reencrypt_values` in a worker process.
+    
+    The keys are passed explicitly, rather than using the crypto state, since 
+    worker processes must not use the database.
+    """
+    global _reencrypt_keys
+    Random.atfork() # (The PyCrypto RNG must be re-seeded in the child process.)
+    padding_policy.configure(padding_buckets)
+    _reencrypt_keys = keys
+
+def _reencrypt_values(values, keys=None):
+    """
+    Re-encrypts the values with the new data key.
+    
+    :param values: The encrypted values (with any data key, or the master key).
+    :type values: list
+    :param keys: The (master key, data keys, new data key id); defaults to the worker keys.
+    :type keys: tuple
+    :return: The re-encrypted values.
+    :rtype: list
+    """
+    (master_key, data_keys, key_id) = keys or _reencrypt_keys
+    
+    # Decrypt all of the values for each key as a batch.
+    indexes_by_key_id = defaultdict(list)
+    for (i, value) in enumerate(values):
+        indexes_by_key_id[engine.parse_key_id(value)].append(i)
+    
+    cleartexts = [None] * len(values)
+    for (value_key_id, indexes) in indexes_by_key_id.items():
+        if value_key_id is None:
+            key = master_key
+        elif value_key_id in data_keys:
+            key = data_keys[value_key_id]
+        else:
+            raise exc.CryptoAuthenticationFailed("Value is encrypted with unknown data key: {0}".format(value_key_id))
+        for (i, cleartext) in zip(indexes, engine.decrypt_many([values[i] for i in indexes], key=key)):
+            cleartexts[i] = cleartext
+    
+    return list(engine.encrypt_many(cleartexts, key=data_keys[key_id], key_id=key_id))
+
+def migrate_legacy_data(legacy_key, batch_size=500, progress=None):
+    """
+    Converts database contents that were encrypted with the legacy engine to the current 
+    format (encrypted with the active data key).
+    
+    The rows are streamed (with a server-side cursor, where the database supports it) 
+    on a separate connection and converted in batches, each written with a bulk UPDATE
+    and committed with a checkpoint, so this can be resumed (by calling it again) if it
+    is interrupted.  Rows that are not in the legacy format are left as they are.
+    
+    :param legacy_key: The (32-byte) legacy encryption key.
+    :type legacy_key: str
+    :param batch_size: The number of rows to convert per transaction.
+    :type batch_size: int
+    :param progress: A callable that will be passed a :class:`ReencryptProgress` after each batch.
+    :type progress: callable
+    :return: The number of converted values.
+    :rtype: int
+    :raise ensconce.exc.CryptoNotInitialized: If the engine has not been initialized.
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    :raise ensconce.exc.CryptoError: If a legacy value cannot be decrypted.
+    """
+    if not state.initialized:
+        raise exc.CryptoNotInitialized()
+    
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    converted = 0
+    for col in ENCRYPTED_COLUMNS:
+        table = col.table
+        try:
+            checkpoint = _load_checkpoint(session, 'legacy:{0}'.format(table.name))
+            if checkpoint.position:
+                log.info("Resuming legacy conversion of {0} after id {1}".format(table.name, checkpoint.position))
+            
+            pending = and_(table.c.id > checkpoint.position, col != None, col != '')
+            total = session.query(func.count(table.c.id)).filter(pending).scalar()
+            session.commit()
+            
+            # Only update the rows that have not been changed since we read them.
+            update = (table.update()
+                      .where(and_(table.c.id == bindparam('_id'), col == bindparam('_old', type_=LargeBinary)))
+                      .values({col.name: bindparam('_new', type_=col.type)}))
+            rows_done = 0
+            rows_written = 0
+            bytes_before = 0
+            bytes_after = 0
+            start = time.time()
+            query = select([table.c.id, type_coerce(col, LargeBinary).label('stored')]).where(pending).order_by(table.c.id)
+            for rows in _stream_batches(query, batch_size):
+                legacy_rows = []
+                cleartexts = []
+                for row in rows:
+                    legacy = _legacy_ciphertext(row['stored'])
+                    if legacy is not None:
+                        try:
+                            cleartexts.append(legacy_engine.decrypt(legacy, legacy_key))
+                        except (TypeError, ValueError):
+                            raise exc.CryptoError("Unable to decrypt legacy value in {0} (id {1}); is this the right key?".format(table.name, row['id']))
+                        legacy_rows.append(row)
+                
+                params = [{'_id': row['id'], '_old': row['stored'], '_new': new}
+                          for (row, new) in zip(legacy_rows, engine.encrypt_many(cleartexts))]
+                if params:
+                    session.execute(update, params)
+                
+                checkpoint.position = rows[-1]['id']
+                session.commit()
+                
+                rows_done += len(rows)
+                rows_written += len(params)
+                size = sum(len(row['stored']) for row in rows)
+                bytes_before += size
+                bytes_after += size + sum(len(p['_new']) - len(p['_old']) for p in params)
+                if progress is not None:
+                    progress(ReencryptProgress(table=table.name, rows=rows_done, total=total, elapsed=time.time() - start,
+                                               bytes_before=bytes_before, bytes_after=bytes_after))
+            
+            converted += rows_written
+        except:
+            session.rollback()
+            log.exception("Error converting legacy values in {0}; this can be resumed from last checkpoint.".format(table.name))
+            raise
+    
+    session.query(model.Checkpoint).filter(model.Checkpoint.name.like('legacy:%')).delete(synchronize_session=False)
+    session.commit()
+    
+    log.info("Converted {0} legacy values".format(converted))
+    return converted
+
+def verify_encrypted_data(batch_size=500, progress=None):
+    """
+    Checks that all of the database contents decrypt and authenticate with the current keys.
+    
+    This is read-only, so it can be run at any time (e.g. after :func:`migrate_legacy_data`).
+    
+    :param batch_size: The number of rows to read at a time.
+    :type batch_size: int
+    :param progress: A callable that will be passed a :class:`ReencryptProgress` after each batch.
+    :type progress: callable
+    :return: The (table name, id) of each value that failed to decrypt.
+    :rtype: list
+    :raise ensconce.exc.CryptoNotInitialized: If the engine has not been initialized.
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    """
+    if not state.initialized:
+        raise exc.CryptoNotInitialized()
+    
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    failures = []
+    for col in ENCRYPTED_COLUMNS:
+        table = col.table
+        pending = and_(col != None, col != '')
+        total = session.query(func.count(table.c.id)).filter(pending).scalar()
+        session.commit()
+        
+        rows_done = 0
+        size = 0
+        start = time.time()
+        query = select([table.c.id, type_coerce(col, LargeBinary).label('stored')]).where(pending).order_by(table.c.id)
+        for rows in _stream_batches(query, batch_size):
+            for row in rows:
+                try:
+                    engine.decrypt(col.type.process_result_value(row['stored'], None))
+                except exc.CryptoError:
+                    log.warning("Value in {0} (id {1}) failed to decrypt.".format(table.name, row['id']))
+                    failures.append((table.name, row['id']))
+            rows_done += len(rows)
+            size += sum(len(row['stored']) for row in rows)
+            if progress is not None:
+                progress(ReencryptProgress(table=table.name, rows=rows_done, total=total, elapsed=time.time() - start,
+                                           bytes_before=size, bytes_after=size))
+    
+    log.info("Verified encrypted values; {0} failed to decrypt".format(len(failures)))
+    return failures
+
+# The name of the checkpoint for :func:`rebuild_notes_index`.
+NOTES_INDEX_CHECKPOINT = 'notes-index'
+
+def rebuild_notes_index(batch_size=500, progress=None):
+    """
+    Rebuilds the blind index of the resource notes (see :mod:`ensconce.crypto.blindindex`) 
+    with the current index key.
+    
+    The resources are processed in id order, in batches that are each committed with a 
+    checkpoint, so this can be resumed (by calling it again) if it is interrupted.  The 
+    searches only use the index once it is complete.  (Notes that are modified meanwhile
+    are indexed by the model, but this should be run while the application is stopped, 
+    like the other rekey operations.)
+    
+    :param batch_size: The number of resources to index per transaction.
+    :type batch_size: int
+    :param progress: A callable that will be passed a :class:`ReencryptProgress` after each batch.
+    :type progress: callable
+    :return: The number of indexed resources (with notes).
+    :rtype: int
+    :raise ensconce.exc.CryptoNotInitialized: If the engine has not been initialized.
+    :raise ensconce.exc.UnconfiguredModel: If we can't create an SA session.
+    """
+    if not state.initialized:
+        raise exc.CryptoNotInitialized()
+    
+    if meta.Session is None:
+        raise exc.UnconfiguredModel()
+    
+    session = meta.Session()
+    r_t = model.resources_table
+    key = blindindex.index_key()
+    try:
+        key_info = session.query(model.KeyMetadata).one()
+        checkpoint = _load_checkpoint(session, NOTES_INDEX_CHECKPOINT)
+        if checkpoint.position:
+            log.info("Resuming notes index rebuild after id {0}".format(checkpoint.position))
+        else:
+            key_info.index_check = None
+            session.execute(model.resource_note_tokens_table.delete())
+        
+        pending = and_(r_t.c.notes != None, r_t.c.notes != '')
+        total = session.query(func.count(r_t.c.id)).filter(and_(r_t.c.id > checkpoint.position, pending)).scalar()
+        session.commit()
+        
+        rows_done = 0
+        size = 0
+        start = time.time()
+        while True:
+            rows = session.execute(select([r_t.c.id, r_t.c.notes])
+                                   .where(and_(r_t.c.id > checkpoint.position, pending))
+                                   .order_by(r_t.c.id)
+                                   .limit(batch_size)).fetchall()
+            if not rows:
+                break
+            
+            notes = engine.decrypt_many(row['notes'] for row in rows)
+            blindindex.update_many(session.connection(), zip([row['id'] for row in rows], notes), key=key)
+            
+            checkpoint.position = rows[-1]['id']
+            session.commit()
+            
+            rows_done += len(rows)
+            size += sum(len(row['notes']) for row in rows)
+            if progress is not None:
+                progress(ReencryptProgress(table=r_t.name, rows=rows_done, total=total, elapsed=time.time() - start,
+                                           bytes_before=size, bytes_after=size))
+        
+        key_info.index_check = key.check
+        session.delete(checkpoint)
+        session.commit()
+    except:
+        session.rollback()
+        log.exception("Error rebuilding the notes index; this can be resumed from last checkpoint.")
+        raise
+    
+    log.info("Rebuilt the notes index for {0} resources".format(rows_done))
+    return rows_done
+
+def _legacy_ciphertext(stored):
+    """
+    Gets the legacy ciphertext of a stored value, or None if it is not a legacy value.
+    
+    (A current-format value can look like a legacy value that was converted to binary,
+    so values that authenticate with one of our keys are not legacy values.)
+    """
+    legacy = legacy_engine.parse_stored(stored)
+    if legacy is not None and engine.parse_key_id(stored) in state.snapshot.data_keys:
+        try:
+            engine.decrypt(stored)
+        except exc.CryptoAuthenticationFailed:
+            pass
+        else:
+            return None
+    return legacy
+
+def _stream_batches(query, batch_size):
+    """
+    Generator that yields the results of a query in batches, streaming them on a separate 
+    connection (using a server-side cursor where the database supports it), so that the
+    session can commit between batches.
+    """
+    conn = meta.engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+def _load_checkpoint(session, name):
+    """
+    Gets the named checkpoint, creating it (at position 0) if it does not exist.
+    
+    :rtype: :class:`ensconce.model.Checkpoint`
+    """
+    checkpoint = session.query(model.Checkpoint).get(name)
+    if checkpoint is None:
+        checkpoint = model.Checkpoint()
+        checkpoint.name = name
+        checkpoint.position = 0
+        session.add(checkpoint)
+    return checkpoint
 
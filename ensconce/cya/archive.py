@@ -0,0 +1,315 @@
+"""
+Archival of the closed months of the audit log to compressed, columnar, checksummed files.
+
+Each archived month is one gzip-compressed file (auditlog-YYYY-MM.json.gz) of JSON lines:
+a header (with the format version, the month and the number of rows), then the rows in
+groups of :data:`ROW_GROUP_SIZE` (in datetime, id order), with each group stored a column
+at a time (one line with the values of each column, in the order of the header's column
+list).  Next to it is a checksum file (auditlog-YYYY-MM.json.gz.sha256, in the format of
+the sha256sum command) that is verified whenever the archive is read.
+
+The archived months are removed from the database (see :mod:`ensconce.cya.partitions`);
+any rows that are written for a month after it was archived (e.g. by a late flush of the
+asynchronous writer) are merged into its archive when it is archived again.  The audit log
+searches with a start date (that is in an archived month) also search
+the archives.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import gzip
+import json
+import hashlib
+from datetime import datetime
+
+import pytz
+from sqlalchemy import select, func, and_
+
+from ensconce import exc
+from ensconce.cya import partitions
+from ensconce.cya.store import audit_store
+from ensconce.model import rows
+from ensconce.autolog import log
+
+FORMAT = 'ensconce-auditlog'
+VERSION = 1
+
+# The number of rows per (columnar) group.
+ROW_GROUP_SIZE = 10000
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_DATETIME_COLUMNS = ('datetime', 'last_datetime')
+
+# The values of the columns that are not in the older archives.
+_DEFAULTS = dict(hits=1, last_datetime=None)
+_FILENAME_RE = re.compile(r'^auditlog-(\d{4})-(\d{2})\.json\.gz$')
+
+def filename(month):
+    """ Gets the file name of the archive for the month. """
+    return 'auditlog-{0:%Y-%m}.json.gz'.format(month)
+
+def checksum(path):
+    """
+    Computes the SHA-256 (hex) digest of a file.
+
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write(path, month, row_groups):
+    """
+    Writes an archive file (and its checksum file).
+
+    The file is written under a temporary name and then renamed, so that an archive file
+    is always complete.
+
+    :param path: The path of the archive file.
+    :param month: The start of the month.
+    :type month: datetime.datetime
+    :param row_groups: The rows (in groups).
+    :type row_groups: iterable of lists of :class:`ensconce.model.rows.AuditlogRow`
+    :return: The number of rows written.
+    :rtype: int
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    fp = gzip.open(tmp_path, 'wb')
+    try:
+        header = dict(format=FORMAT, version=VERSION, month='{0:%Y-%m}'.format(month),
+                      columns=rows.AuditlogRow._fields, row_group_size=ROW_GROUP_SIZE)
+        fp.write(json.dumps(header) + '\n')
+        for group in row_groups:
+            if not group:
+                continue
+            for (i, name) in enumerate(rows.AuditlogRow._fields):
+                values = [r[i] for r in group]
+                if name in _DATETIME_COLUMNS:
+                    values = [_encode_datetime(v) if v is not None else None for v in values]
+                fp.write(json.dumps(values) + '\n')
+            count += len(group)
+        fp.write(json.dumps(dict(count=count)) + '\n')
+    finally:
+        fp.close()
+    with open(path + '.sha256', 'w') as fp:
+        fp.write('{0}  {1}\n'.format(checksum(tmp_path), os.path.basename(path)))
+    os.rename(tmp_path, path)
+    return count
+
+def read(path):
+    """
+    Reads the rows from an archive file, after verifying its checksum.
+
+    :param path: The path of the archive file.
+    :return: The rows (in datetime, id order).
+    :rtype: generator of :class:`ensconce.model.rows.AuditlogRow`
+    :raise ensconce.exc.DataIntegrityError: If the file does not match its checksum, or
+                                            is not a (complete) archive file.
+    """
+    with open(path + '.sha256') as fp:
+        expected = fp.read().split()[0]
+    if checksum(path) != expected:
+        raise exc.DataIntegrityError("Audit log archive does not match its checksum: {0}".format(path))
+
+    fp = gzip.open(path, 'rb')
+    try:
+        header = json.loads(fp.readline())
+        if header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise exc.DataIntegrityError("Not a (supported) audit log archive: {0}".format(path))
+        columns = header['columns']
+        count = 0
+        while True:
+            line = fp.readline()
+            values = json.loads(line) if line else None
+            if not isinstance(values, list):
+                if values is None or values.get('count') != count:
+                    raise exc.DataIntegrityError("Audit log archive is incomplete: {0}".format(path))
+                break
+            group = [values] + [json.loads(fp.readline()) for _ in columns[1:]]
+            for (i, name) in enumerate(columns):
+                if name in _DATETIME_COLUMNS:
+                    group[i] = [_decode_datetime(v) if v is not None else None for v in group[i]]
+            for row in zip(*group):
+                fields = dict(_DEFAULTS)
+                fields.update(zip(columns, row))
+                yield rows.AuditlogRow(**fields)
+            count += len(values)
+    finally:
+        fp.close()
+
+def _encode_datetime(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value.strftime(_DATETIME_FORMAT)
+
+def _decode_datetime(value):
+    return datetime.strptime(value, _DATETIME_FORMAT).replace(tzinfo=pytz.utc)
+
+def _merge(archived, current, counts):
+    """
+    Merges the (archived) rows of a month with the (current) rows from the database, in
+    datetime, id order; a row that is in both (i.e. has the same id) is taken from the
+    database.
+
+    :param counts: A dict in which the number of current rows is counted ('current').
+    :rtype: generator of :class:`ensconce.model.rows.AuditlogRow`
+    """
+    key = lambda r: (r.datetime, r.id)
+    a = next(archived, None)
+    for row in current:
+        counts['current'] += 1
+        while a is not None and key(a) <= key(row):
+            if a.id != row.id:
+                yield a
+            a = next(archived, None)
+        yield row
+    while a is not None:
+        yield a
+        a = next(archived, None)
+
+class AuditArchive(object):
+    """
+    The directory of the audit log archives.
+
+    Archiving is disabled until a directory is configured (with :meth:`configure`).
+    """
+    def __init__(self):
+        self.path = None
+
+    def configure(self, path=None):
+        """
+        :param path: The directory for the archive files (None to disable archiving).
+        :type path: str
+        """
+        self.path = path
+
+    def months(self):
+        """
+        Gets the months that have been archived.
+
+        :return: The start of each month (in order).
+        :rtype: list
+        """
+        if not self.path or not os.path.isdir(self.path):
+            return []
+        result = []
+        for name in os.listdir(self.path):
+            m = _FILENAME_RE.match(name)
+            if m:
+                result.append(datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=pytz.utc))
+        return sorted(result)
+
+    def archive(self, retention_months):
+        """
+        Archives (and removes from the database) the months of the audit log that are
+        older than the retention period.
+
+        Each month is written to its archive file (which is then read back to verify it)
+        and then removed from the database, in its own transaction.
+
+        :param retention_months: The number of months (before the current month) to keep
+                                 in the database.
+        :type retention_months: int
+        :return: The months that were archived.
+        :rtype: list
+        """
+        if not self.path:
+            raise exc.ConfigurationError("No audit log archive path is configured (audit.archive.path).")
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, mode=0700)
+        before = partitions.add_months(partitions.month_start(datetime.now(pytz.utc)), -retention_months)
+        conn = audit_store.current.engine.connect()
+        try:
+            archived = []
+            for month in partitions.closed_months(conn, before):
+                trans = conn.begin()
+                try:
+                    self._archive_month(conn, month)
+                    partitions.drop_month(conn, month)
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+                archived.append(month)
+            return archived
+        finally:
+            conn.close()
+
+    def _archive_month(self, conn, month):
+        # (Runtime import to avoid circular dep.)
+        from ensconce import model
+        a_t = model.auditlog_table
+
+        path = os.path.join(self.path, filename(month))
+        clause = and_(a_t.c.datetime >= month, a_t.c.datetime < partitions.add_months(month, 1))
+        expected = conn.execute(select([func.count()], clause)).scalar()
+        if os.path.exists(path):
+            # (E.g. rows that were written for the month after it was archived, or the month
+            # was archived but the rows were not removed.)
+            log.info("Merging the rows into the existing audit log archive: {0}".format(path))
+            archived = read(path)
+        else:
+            archived = iter([])
+
+        q = select(rows.columns(rows.AuditlogRow, a_t), clause).order_by(a_t.c.datetime, a_t.c.id)
+        result = conn.execution_options(stream_results=True).execute(q)
+
+        def current():
+            while True:
+                group = rows.fetch(rows.AuditlogRow, result.fetchmany(ROW_GROUP_SIZE))
+                if not group:
+                    break
+                for row in group:
+                    yield row
+
+        counts = dict(current=0)
+        merged = _merge(archived, current(), counts)
+        def row_groups():
+            group = []
+            for row in merged:
+                group.append(row)
+                if len(group) == ROW_GROUP_SIZE:
+                    yield group
+                    group = []
+            yield group
+
+        count = write(path, month, row_groups())
+        if counts['current'] != expected or sum(1 for _ in read(path)) != count:
+            raise exc.DataIntegrityError("Audit log archive {0} does not have the {1} rows of the month.".format(path, expected))
+        log.info("Archived {0} audit log rows to {1} ({2} rows in total)".format(expected, path, count))
+
+    def search(self, start, end=None, matches=None, before=None):
+        """
+        Searches the archived months in a date range.
+
+        :param start: The start of the range.
+        :type start: datetime.datetime
+        :param end: The end of the range (optional).
+        :type end: datetime.datetime
+        :param matches: A function that is called with each row (in the range), to check
+                        whether it matches (the other search criteria).
+        :param before: Only search the months before this month (e.g. the months that are 
+                       not in the database).
+        :type before: datetime.datetime
+        :return: The matching rows, newest first.
+        :rtype: list of :class:`ensconce.model.rows.AuditlogRow`
+        """
+        start = partitions.as_utc(start)
+        end = partitions.as_utc(end) if end is not None else None
+        results = []
+        for month in self.months():
+            if partitions.add_months(month, 1) <= start or (end is not None and month > end):
+                continue
+            if before is not None and month >= before:
+                continue
+            for row in read(os.path.join(self.path, filename(month))):
+                if row.datetime >= start and (end is None or row.datetime <= end) and (matches is None or matches(row)):
+                    results.append(row)
+        results.sort(key=lambda r: (r.datetime, r.id), reverse=True)
+        return results
+
+audit_archive = AuditArchive()
@@ -1,16 +1,21 @@
 """
 """
+import re
 import collections
 import logging
 import warnings
 from datetime import datetime, timedelta
 
-from sqlalchemy import and_, func, text
+from sqlalchemy import and_, func, text, select
 
 from ensconce import model
-from ensconce.model import meta
+from ensconce.model import meta, rows
 from ensconce.webapp.util import operator_info
-from ensconce.dao import SearchResults
+from ensconce.dao import SearchResults, pagination
+from ensconce.cya import partitions, recent
+from ensconce.cya.store import audit_store
+from ensconce.cya.writer import audit_writer
+from ensconce.cya.archive import audit_archive
 from ensconce.autolog import log as applog
 
 logger = lambda: logging.getLogger('AUDIT')
@@ -37,6 +42,13 @@ def enumerate_codes():
 
 def log(code, target=None, comment=None, attributes_modified=None):
     """
+    Writes an audit log entry (and a syslog line).
+    
+    The entries for the codes that are configured as asynchronous are queued, to be written 
+    in batches by a background task (see :mod:`ensconce.cya.writer`); the others are written
+    in the request transaction, or (with a dedicated audit store) written to the store before
+    this returns (see :mod:`ensconce.cya.store`).
+    
     :param code: The auditlog code.
     :keyword target: The object being modified.
     :keyword comment: Any description of event that is not captured by other attributes (e.g. search string would go in here).
@@ -48,22 +60,34 @@ def log(code, target=None, comment=None, attributes_modified=None):
     session = meta.Session()
     
     try:
-        entry = model.AuditlogEntry()
-        entry.code = code
-        entry.comment = comment
-        entry.operator_id = operator_info().user_id
-        entry.operator_username = operator_info().username 
+        values = dict(datetime=datetime.now(),
+                      code=code,
+                      comment=comment,
+                      operator_id=operator_info().user_id,
+                      operator_username=operator_info().username,
+                      object_id=None,
+                      object_type=None,
+                      object_label=None,
+                      attributes_modified=attributes_modified,
+                      hits=1,
+                      last_datetime=None)
         
         if target:
-            entry.object_id = target.id
-            entry.object_type = target.__class__.__name__
+            values['object_id'] = target.id
+            values['object_type'] = target.__class__.__name__
             if hasattr(target, 'label'):
-                entry.object_label = target.label
-        
-        entry.attributes_modified = attributes_modified 
+                values['object_label'] = target.label
         
-        session.add(entry)
-        session.flush()
+        if not (audit_writer.is_async(code) and audit_writer.put(values)):
+            if audit_store.current.in_session:
+                entry = model.AuditlogEntry()
+                for (name, value) in values.items():
+                    setattr(entry, name, value)
+                session.add(entry)
+                session.flush()
+                recent.record(session.connection(), [values])
+            else:
+                audit_store.current.write([values])
         
         build_msg = []
         
@@ -84,114 +108,291 @@ def log(code, target=None, comment=None, attributes_modified=None):
     except:
         # This may be wrong, but otherwise we go to try to commit() in our wrapper and it fails due to 
         # an invalid session state.
-        session.rollback()
+        if audit_store.current.in_session:
+            session.rollback()
         
         logger().critical("There was an error writing audit log: {code}, target={target}, mod={mod}".format(code=code,
                                                                                                        target=target,
                                                                                                        mod=attributes_modified), 
                           exc_info=True)
     
+def _search_clauses(start=None, end=None, operator_id=None, operator_username=None, code=None,
+                    object_type=None, object_id=None):
+    """ Builds the filter clauses for :func:`search` and :func:`search_rows`. """
+    a_t = model.auditlog_table
+    clauses = []
+    if start:
+        applog.debug("Filtering on start date: {0}".format(start))
+        clauses.append(a_t.c.datetime >= start)
+        
+    if end:
+        applog.debug("Filtering on end date: {0}".format(end))
+        clauses.append(a_t.c.datetime <= end)
+    
+    if operator_id:
+        if operator_username:
+            warnings.warn("Ignoring operator_username parameter, since operator_id was specified.")
+        clauses.append(a_t.c.operator_id == operator_id)
+    elif operator_username:
+        applog.debug("Filtering on username: {0}".format(operator_username))
+        clauses.append(a_t.c.operator_username == operator_username)
+    
+    if object_type:
+        applog.debug("Filtering on object type: {0}".format(object_type))
+        clauses.append(a_t.c.object_type == object_type)
+        
+    if object_id:
+        applog.debug("Filtering on object id: {0}".format(object_id))
+        clauses.append(a_t.c.object_id == object_id)
+    
+    if code:
+        applog.debug("Filtering on code: {0}".format(code))
+        clauses.append(a_t.c.code.like(code)) # Allow for code wildcards (e.g. "content.%" to be passed in
+    
+    return clauses
+
+def _key_columns():
+    """ The (unique) key for the ordering and the cursor pagination: newest first. """
+    a_t = model.auditlog_table
+    return [a_t.c.datetime, a_t.c.id]
+
+def _count(session, clauses, skip_count=False, estimate_count=False):
+    a_t = model.auditlog_table
+    if skip_count:
+        return None
+    elif estimate_count:
+        return pagination.estimated_count(session, select([a_t.c.id], and_(*clauses)))
+    else:
+        return session.execute(select([func.count(a_t.c.id)], and_(*clauses))).scalar()
+
+def _code_matcher(code):
+    """ Builds a function that checks whether a code matches a (LIKE) code pattern, with % and _ wildcards and backslash escapes. """
+    pattern = []
+    chars = iter(code)
+    for c in chars:
+        if c == '\\':
+            pattern.append(re.escape(next(chars, '')))
+        else:
+            pattern.append('.*' if c == '%' else '.' if c == '_' else re.escape(c))
+    code_re = re.compile(''.join(pattern) + '$', re.DOTALL)
+    return lambda value: code_re.match(value) is not None
+
+def _matcher(operator_id=None, operator_username=None, code=None, object_type=None, object_id=None):
+    """ Builds a function that checks whether an (external) row matches the criteria, like :func:`_search_clauses`. """
+    code_matches = _code_matcher(code) if code else None
+    
+    def matches(row):
+        if operator_id:
+            if row.operator_id != int(operator_id):
+                return False
+        elif operator_username and row.operator_username != operator_username:
+            return False
+        if object_type and row.object_type != object_type:
+            return False
+        if object_id and row.object_id != int(object_id):
+            return False
+        return code_matches is None or code_matches(row.code)
+    
+    return matches
+
+def _external(session, start=None, end=None, cursor=None, limit=None, skip_count=False, estimate_count=False, **criteria):
+    """
+    Searches the entries that are not in the database: the entries in the audit store (if
+    it is not the database) and the archived months (if the search has a start date).
+    
+    Only the store entries after the cursor are read, up to the limit, and they are counted
+    (or their count estimated) by the store.  The archived months that are (still) in the
+    database are skipped.
+    
+    :return: A tuple of the matching rows (newest first) and their count (None if skip_count).
+    :rtype: tuple
+    """
+    matches = _matcher(**criteria)
+    before = tuple(pagination.decode_cursor(cursor, _key_columns())) if cursor is not None else None
+    results = audit_store.current.search(start, end, matches=matches, before=before, limit=limit)
+    count = None
+    if not skip_count:
+        code = criteria.get('code')
+        count = audit_store.current.count(start, end, matches=matches, code_matches=_code_matcher(code) if code else None,
+                                          estimate=estimate_count)
+    if start and audit_archive.path:
+        a_t = model.auditlog_table
+        first = session.execute(select([func.min(a_t.c.datetime)])).scalar()
+        before_month = partitions.month_start(first) if first is not None else None
+        archived = audit_archive.search(start, end, matches=matches, before=before_month)
+        results += archived
+        if count is not None:
+            count += len(archived)
+    return (results, count)
+
+def _page(fetch, external, key_columns, cursor=None, offset=None, limit=None):
+    """
+    Gets a page of results: the rows from the database, merged with the rows from outside
+    of the database (see :func:`_external`).
+    
+    :param fetch: A function that fetches the (ordered) database results, with params for 
+                  the offset and limit (the cursor clause must already have been applied).
+    :param external: The external matches.
+    :return: A tuple of the page rows and the cursor for the next page.
+    :rtype: tuple
+    """
+    if not external:
+        return pagination.paginate(fetch(offset, limit + 1 if limit else None), key_columns, limit or None)
+    if cursor is not None:
+        after = tuple(pagination.decode_cursor(cursor, key_columns))
+        external = [r for r in external if (r.datetime, r.id) < after]
+    skip = offset or 0
+    entries = fetch(None, skip + limit + 1 if limit else None) + external
+    entries.sort(key=lambda r: (r.datetime, r.id), reverse=True)
+    entries = entries[skip:skip + limit + 1] if limit else entries[skip:]
+    return pagination.paginate(entries, key_columns, limit or None)
+
+def _external_limit(offset, limit):
+    """ The number of external rows that a page (see :func:`_page`) may need. """
+    return (offset or 0) + limit + 1 if limit else None
+
+def _entry(row):
+    """ Converts an (external) row to a (transient) entity. """
+    entry = model.AuditlogEntry()
+    for (name, value) in row._asdict().items():
+        setattr(entry, name, value)
+    return entry
+
 def search(start=None, end=None, operator_id=None, operator_username=None, code=None, 
            object_type=None, object_id=None, offset=None, limit=None,
-           skip_count=False):
-        
-    session = meta.Session()
+           skip_count=False, cursor=None, estimate_count=False):
+    """
+    Searches the audit log (newest entries first).
+    
+    Rather than the offset, pass the next_cursor of the previous results as the cursor to 
+    get the next page (keyset pagination, which does not have to skip the preceding rows).
+    
+    The entries in the audit store (if it is not the database) are also searched, and if the 
+    start date is before the months that are in the database, the archived months (see 
+    :mod:`ensconce.cya.archive`) too.
+    
+    :param skip_count: Whether to skip counting the matches (the count is then None).
+    :type skip_count: bool
+    :param cursor: The next_cursor of the previous page.
+    :type cursor: str
+    :param estimate_count: Whether to use the (PostgreSQL) planner estimate of the count 
+                           instead of counting the matches.
+    :type estimate_count: bool
+    :returns: A :class:`ensconce.dao.SearchResults` with a list of :class:`ensconce.model.AuditlogEntry` entries.
+    :rtype: :class:`ensconce.dao.SearchResults`
+    """
+    session = audit_store.current.session()
     
     try:
-        a_t = model.auditlog_table
-        q = session.query(model.AuditlogEntry)
+        key_columns = _key_columns()
+        criteria = dict(operator_id=operator_id, operator_username=operator_username,
+                        code=code, object_type=object_type, object_id=object_id)
+        clauses = _search_clauses(start=start, end=end, **criteria)
+        (external, external_count) = _external(session, start=start, end=end, cursor=cursor, limit=_external_limit(offset, limit),
+                                               skip_count=skip_count, estimate_count=estimate_count, **criteria)
+        external = [_entry(r) for r in external]
         
-        clauses = []
-        if start:
-            applog.debug("Filtering on start date: {0}".format(start))
-            clauses.append(a_t.c.datetime >= start)
-            
-        if end:
-            applog.debug("Filtering on end date: {0}".format(end))
-            clauses.append(a_t.c.datetime <= end)
-        
-        if operator_id:
-            if operator_username:
-                warnings.warn("Ignoring operator_username parameter, since operator_id was specified.")
-            clauses.append(a_t.c.operator_id == operator_id)
-        elif operator_username:
-            applog.debug("Filtering on username: {0}".format(operator_username))
-            clauses.append(a_t.c.operator_username == operator_username)
-        
-        if object_type:
-            applog.debug("Filtering on object type: {0}".format(object_type))
-            clauses.append(a_t.c.object_type == object_type)
-            
-        if object_id:
-            applog.debug("Filtering on object id: {0}".format(object_id))
-            clauses.append(a_t.c.object_type == object_id)
+        count = _count(session, clauses, skip_count=skip_count, estimate_count=estimate_count)
+        if count is not None:
+            count += external_count
         
-        if code:
-            applog.debug("Filtering on code: {0}".format(code))
-            clauses.append(a_t.c.code.like(code)) # Allow for code wildcards (e.g. "content.%" to be passed in
+        applog.debug("Total number of rows: {0}".format(count))
         
-        if not skip_count:
-            count = session.query(func.count(a_t.c.id)).filter(and_(*clauses)).scalar()
-        else:
-            count = None
+        if cursor is not None:
+            clauses.append(pagination.seek_clause(key_columns, cursor, descending=True))
         
-        applog.debug("Total number of rows: {0}".format(count))
+        def fetch(offset, limit):
+            q = session.query(model.AuditlogEntry).filter(and_(*clauses))
+            q = q.order_by(*pagination.ordering(key_columns, descending=True))
+            if offset:
+                q = q.offset(offset)
+            if limit:
+                q = q.limit(limit)
+            return q.all()
         
-        q = q.filter(and_(*clauses))
+        (results, next_cursor) = _page(fetch, external, key_columns, cursor=cursor, offset=offset, limit=limit)
+    except:
+        applog.exception("Error searching audit log.")
+        raise
+    
+    return SearchResults(count, results, next_cursor)
+
+def search_rows(start=None, end=None, operator_id=None, operator_username=None, code=None, 
+                object_type=None, object_id=None, offset=None, limit=None,
+                skip_count=False, cursor=None, estimate_count=False):
+    """
+    Searches the audit log like :func:`search`, but returns read-only rows.
+    
+    :returns: A :class:`ensconce.dao.SearchResults` with a list of :class:`ensconce.model.rows.AuditlogRow` entries.
+    :rtype: :class:`ensconce.dao.SearchResults`
+    """
+    session = audit_store.current.session()
+    
+    try:
+        a_t = model.auditlog_table
+        key_columns = _key_columns()
+        criteria = dict(operator_id=operator_id, operator_username=operator_username,
+                        code=code, object_type=object_type, object_id=object_id)
+        clauses = _search_clauses(start=start, end=end, **criteria)
+        (external, external_count) = _external(session, start=start, end=end, cursor=cursor, limit=_external_limit(offset, limit),
+                                               skip_count=skip_count, estimate_count=estimate_count, **criteria)
         
-        q = q.order_by(a_t.c.datetime.desc())
+        count = _count(session, clauses, skip_count=skip_count, estimate_count=estimate_count)
+        if count is not None:
+            count += external_count
         
-        if offset and count > offset:
-            q = q.offset(offset)
-            
-        if limit:
-            q = q.limit(limit)
+        if cursor is not None:
+            clauses.append(pagination.seek_clause(key_columns, cursor, descending=True))
         
-        #applog.debug("Auditlog query: {0}".format(q))
+        def fetch(offset, limit):
+            q = select(rows.columns(rows.AuditlogRow, a_t), and_(*clauses))
+            q = q.order_by(*pagination.ordering(key_columns, descending=True))
+            if offset:
+                q = q.offset(offset)
+            if limit:
+                q = q.limit(limit)
+            return rows.fetch(rows.AuditlogRow, session.execute(q))
         
-        results = q.all() 
+        (results, next_cursor) = _page(fetch, external, key_columns, cursor=cursor, offset=offset, limit=limit)
     except:
         applog.exception("Error searching audit log.")
         raise
     
-    return SearchResults(count, results)
+    return SearchResults(count, results, next_cursor)
 
 def recent_content_views(operator_id, object_type, code=None, object_id=None, limit=10, limit_days=7, skip_count=False):
     """
+    Gets the objects that an operator has most recently viewed (or otherwise acted on),
+    with the latest entry for each object and code (see :mod:`ensconce.cya.recent`).
     
+    :param operator_id: The operator.
+    :param object_type: The type (class name) of the objects.
+    :param code: Only the entries with this code (optional).
+    :param object_id: Only the entries for this object (optional).
+    :param limit: The max number of results.
+    :param limit_days: Only the entries from the last limit_days days.
+    :param skip_count: Whether to skip counting the matches (the count is then 0).
+    :return: The :class:`ensconce.model.RecentView` results, newest first.
+    :rtype: ensconce.dao.SearchResults
     """
-    # This is not very efficient yet.  The right way to do this is probably to 
-    # map a subclass of AuditLogEntry to a query that groups by object_id, object_type, and code 
-    # showing the max timestamp.
-    
-    session = meta.Session()
+    session = audit_store.current.session()
     
     try:
-        a_t = model.auditlog_table
-        subq = session.query(func.max(a_t.c.id)).group_by(a_t.c.object_type,
-                                                          a_t.c.object_id,
-                                                          a_t.c.code,
-                                                          a_t.c.operator_id)
+        rv_t = model.recent_views_table
         
         clauses = []
-        clauses.append(a_t.c.operator_id==operator_id)
-        clauses.append(a_t.c.object_type==object_type)
-        # In an attempt to improve efficiency:
-        clauses.append(a_t.c.datetime>=datetime.now()-timedelta(days=limit_days))
-        
-        
+        clauses.append(rv_t.c.operator_id==operator_id)
+        clauses.append(rv_t.c.object_type==object_type)
+        clauses.append(rv_t.c.datetime>=datetime.now()-timedelta(days=limit_days))
         
         if object_id:
-            clauses.append(a_t.c.object_id==object_id)
+            clauses.append(rv_t.c.object_id==object_id)
         
         if code:
-            clauses.append(a_t.c.code==code)
+            clauses.append(rv_t.c.code==code)
         
-        subq = subq.filter(and_(*clauses))
-        
-        # Now get all the actual audit log rows that match that.  Order by the datetime descending.
-        q = session.query(model.AuditlogEntry).filter(a_t.c.id.in_(subq))
-        q = q.order_by(a_t.c.datetime.desc())
+        q = session.query(model.RecentView).filter(and_(*clauses))
+        q = q.order_by(rv_t.c.datetime.desc())
         
         if not skip_count:
             count = q.count()
@@ -203,7 +404,7 @@ def recent_content_views(operator_id, object_type, code=None, object_id=None, li
         results = q.all() 
         
     except:
-        applog.exception("Error searching audit log.")
+        applog.exception("Error searching recent views.")
         raise
     
     return SearchResults(count, results)
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Time-based (monthly) partitioning of the audit log.
+
+On PostgreSQL (11+) the auditlog table is a natively (range) partitioned table, with a
+partition per month (e.g. auditlog_p202610) and a default partition for any rows outside
+of those months.  The partitions for the coming months are created ahead of time by
+:func:`create_partitions`, and a closed month can be dropped (after it has been archived;
+see :mod:`ensconce.cya.archive`) without having to delete the rows.  The partition key
+must be part of the primary key, so the primary key is (id, datetime); the ids are still
+unique (from the sequence).
+
+On other databases the audit log is a single table, and the rows of a closed month are
+deleted instead.
+
+The months are in UTC.
+"""
+from __future__ import absolute_import
+
+import re
+from datetime import datetime
+
+import pytz
+from sqlalchemy import select, func
+
+from ensconce.autolog import log
+
+TABLE = 'auditlog'
+
+# The name of the partition for the rows outside of the monthly partitions.
+DEFAULT_PARTITION = 'auditlog_pdefault'
+
+# The number of months after the current month to create the partitions for.
+MONTHS_AHEAD = 2
+
+_PARTITION_RE = re.compile(r'^auditlog_p(\d{4})(\d{2})$')
+
+def month_start(dt):
+    """
+    Gets the start of the (UTC) month of the date/time.
+
+    :param dt: The date/time (naive values are taken to be UTC).
+    :type dt: datetime.datetime
+    :rtype: datetime.datetime
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc)
+    return datetime(dt.year, dt.month, 1, tzinfo=pytz.utc)
+
+def as_utc(value):
+    """
+    Converts a (search) date or date/time to an aware UTC date/time.
+
+    :param value: The date or date/time (naive values are taken to be UTC).
+    :type value: datetime.date
+    :rtype: datetime.datetime
+    """
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=pytz.utc)
+    return value.astimezone(pytz.utc)
+
+def add_months(start, months):
+    """
+    Gets the start of the month that is a number of months after (or before) a month.
+
+    :param start: The start of a month (from :func:`month_start`).
+    :param months: The number of months (may be negative).
+    :type months: int
+    :rtype: datetime.datetime
+    """
+    n = start.year * 12 + start.month - 1 + months
+    return datetime(n // 12, n % 12 + 1, 1, tzinfo=pytz.utc)
+
+def partition_name(start):
+    """ Gets the name of the partition for the month. """
+    return 'auditlog_p{0:%Y%m}'.format(start)
+
+def supported(connection):
+    """ Whether the database supports (our use of) native partitioning. """
+    return connection.dialect.name == 'postgresql' and connection.dialect.server_version_info >= (11,)
+
+def is_partitioned(connection):
+    """ Whether the auditlog table is partitioned. """
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute("SELECT relkind FROM pg_class WHERE relname = %(name)s AND relkind IN ('r', 'p')",
+                              name=TABLE).scalar() == 'p'
+
+def partitions(connection):
+    """
+    Gets the monthly partitions (of a partitioned table).
+
+    :return: The start of the month of each partition (in order).
+    :rtype: list
+    """
+    names = connection.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                               "WHERE i.inhparent = %(name)s::regclass", name=TABLE).fetchall()
+    result = []
+    for (name,) in names:
+        m = _PARTITION_RE.match(name)
+        if m:
+            result.append(datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=pytz.utc))
+    return sorted(result)
+
+def partition_table(connection, table):
+    """
+    Converts the (unpartitioned) auditlog table into a partitioned table (if the database
+    supports it), moving the existing rows into the monthly partitions.
+
+    The indexes and foreign keys are recreated (on the partitioned table) from the table
+    definition.  This should be run in a transaction.
+
+    :param connection: The database connection.
+    :param table: The (model) auditlog table.
+    :type table: sqlalchemy.Table
+    """
+    if not supported(connection) or is_partitioned(connection):
+        return
+    old = TABLE + '_unpartitioned'
+    sequence = connection.execute("SELECT pg_get_serial_sequence(%(name)s, 'id')", name=TABLE).scalar()
+    first = connection.execute("SELECT min(datetime) FROM {0}".format(TABLE)).scalar()
+
+    connection.execute("ALTER TABLE {0} RENAME TO {1}".format(TABLE, old))
+    connection.execute("ALTER SEQUENCE {0} OWNED BY NONE".format(sequence))
+    # (The names of the constraints and indexes are reused for the new table.)
+    for (name,) in connection.execute("SELECT conname FROM pg_constraint WHERE conrelid = %(name)s::regclass "
+                                      "AND contype IN ('p', 'f', 'u')", name=old).fetchall():
+        connection.execute("ALTER TABLE {0} DROP CONSTRAINT {1}".format(old, name))
+    for (name,) in connection.execute("SELECT indexname FROM pg_indexes WHERE tablename = %(name)s", name=old).fetchall():
+        connection.execute("DROP INDEX {0}".format(name))
+
+    connection.execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE (datetime)".format(TABLE, old))
+    connection.execute("ALTER SEQUENCE {0} OWNED BY {1}.id".format(sequence, TABLE))
+    primary_key = [c.name for c in table.primary_key.columns] + ['datetime']
+    connection.execute("ALTER TABLE {0} ADD PRIMARY KEY ({1})".format(TABLE, ', '.join(primary_key)))
+    for fk in table.foreign_keys:
+        connection.execute("ALTER TABLE {0} ADD FOREIGN KEY ({1}) REFERENCES {2} ({3}){4}".format(
+                            TABLE, fk.parent.name, fk.column.table.name, fk.column.name,
+                            ' ON DELETE {0}'.format(fk.ondelete) if fk.ondelete else ''))
+    for index in table.indexes:
+        connection.execute("CREATE INDEX {0} ON {1} ({2})".format(index.name, TABLE, ', '.join(c.name for c in index.columns)))
+
+    connection.execute("CREATE TABLE {0} PARTITION OF {1} DEFAULT".format(DEFAULT_PARTITION, TABLE))
+    start = month_start(first) if first is not None else None
+    create_partitions(connection, start=start)
+    connection.execute("INSERT INTO {0} SELECT * FROM {1}".format(TABLE, old))
+    connection.execute("DROP TABLE {0}".format(old))
+    log.info("Partitioned the {0} table.".format(TABLE))
+
+def create_partitions(connection, start=None, months_ahead=MONTHS_AHEAD):
+    """
+    Creates the (missing) monthly partitions, up to a number of months after the current
+    month, if the table is partitioned.
+
+    Any rows for those months in the default partition are moved into the new partitions.
+
+    :param connection: The database connection (in a transaction).
+    :param start: The first month to create the partition for (default is the current month).
+    :type start: datetime.datetime
+    :param months_ahead: The number of months after the current month.
+    :type months_ahead: int
+    :return: The months that the partitions were created for.
+    :rtype: list
+    """
+    if not is_partitioned(connection):
+        return []
+    existing = set(partitions(connection))
+    current = month_start(datetime.now(pytz.utc))
+    month = min(start, current) if start is not None else current
+    created = []
+    while month <= add_months(current, months_ahead):
+        if month not in existing:
+            name = partition_name(month)
+            bounds = dict(start=month, end=add_months(month, 1))
+            connection.execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS)".format(name, TABLE))
+            connection.execute("WITH moved AS (DELETE FROM {0} WHERE datetime >= %(start)s AND datetime < %(end)s RETURNING *) "
+                               "INSERT INTO {1} SELECT * FROM moved".format(DEFAULT_PARTITION, name), **bounds)
+            connection.execute("ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES FROM ({2}) TO ({3})".format(
+                                TABLE, name, _literal(bounds['start']), _literal(bounds['end'])))
+            created.append(month)
+        month = add_months(month, 1)
+    if created:
+        log.info("Created audit log partitions: {0}".format(', '.join(partition_name(m) for m in created)))
+    return created
+
+def closed_months(connection, before):
+    """
+    Gets the months (before a month) that have audit log rows (or partitions).
+
+    :param connection: The database connection.
+    :param before: The start of the first month that is not closed.
+    :type before: datetime.datetime
+    :return: The start of each month (in order).
+    :rtype: list
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    a_t = model.auditlog_table
+    
+    months = set()
+    if is_partitioned(connection):
+        months.update(m for m in partitions(connection) if m < before)
+        # (Any rows that are older than the partitions are in the default partition.)
+        first = connection.execute("SELECT min(datetime) FROM {0} WHERE datetime < %(before)s".format(DEFAULT_PARTITION),
+                                   before=before).scalar()
+    else:
+        first = connection.execute(select([func.min(a_t.c.datetime)], a_t.c.datetime < before)).scalar()
+    if first is not None:
+        month = month_start(first)
+        while month < before:
+            months.add(month)
+            month = add_months(month, 1)
+    return sorted(months)
+
+def drop_month(connection, month):
+    """
+    Removes the rows of a month: drops its partition (if the table is partitioned) and 
+    deletes any other rows of the month.
+
+    :param connection: The database connection (in a transaction).
+    :param month: The start of the month.
+    :type month: datetime.datetime
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    a_t = model.auditlog_table
+    
+    if is_partitioned(connection) and month in partitions(connection):
+        name = partition_name(month)
+        connection.execute("ALTER TABLE {0} DETACH PARTITION {1}".format(TABLE, name))
+        connection.execute("DROP TABLE {0}".format(name))
+    connection.execute(a_t.delete().where((a_t.c.datetime >= month) & (a_t.c.datetime < add_months(month, 1))))
+    log.info("Removed the audit log rows for {0:%Y-%m}.".format(month))
+
+def _literal(month):
+    # (Partition bounds must be literals.)
+    return "'{0:%Y-%m-%d %H:%M:%S}+00'".format(month)
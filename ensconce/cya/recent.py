@@ -0,0 +1,79 @@
+"""
+The latest audit log entry of each (operator, object, code), e.g. for the "recently viewed"
+passwords on the home page.
+
+The recent_views table is updated (upserted) as the audit log entries are written, in the
+same transaction, so that the recent views of an operator are an indexed read rather than
+a GROUP BY over the audit log.  It can be rebuilt from the audit log with :func:`rebuild`
+(e.g. after upgrading the database).
+"""
+from __future__ import absolute_import
+
+from sqlalchemy import select, func, and_
+
+from ensconce import model
+from ensconce.autolog import log
+
+_KEY = ('operator_id', 'object_type', 'object_id', 'code')
+
+# (The later entry wins, since the asynchronous entries may be written out of order.)
+_UPSERT = ("INSERT INTO recent_views (operator_id, object_type, object_id, code, datetime) "
+           "VALUES (%(operator_id)s, %(object_type)s, %(object_id)s, %(code)s, %(datetime)s) "
+           "ON CONFLICT (operator_id, object_type, object_id, code) DO UPDATE SET datetime = EXCLUDED.datetime "
+           "WHERE recent_views.datetime < EXCLUDED.datetime")
+
+def _upsert_supported(connection):
+    return connection.dialect.name == 'postgresql' and connection.dialect.server_version_info >= (9, 5)
+
+def record(connection, entries):
+    """
+    Records the audit log entries (that have an operator and an object) as the latest
+    entries of their operator, object and code.
+
+    :param connection: The database connection (in the transaction that writes the entries).
+    :param entries: The column values of the audit log entries.
+    :type entries: list of dict
+    """
+    values = [dict([(k, e[k]) for k in _KEY] + [('datetime', e.get('last_datetime') or e['datetime'])]) for e in entries
+              if all(e.get(k) is not None for k in _KEY)]
+    if not values:
+        return
+    if _upsert_supported(connection):
+        connection.execute(_UPSERT, values)
+        return
+
+    rv_t = model.recent_views_table
+    for v in values:
+        key = and_(*[rv_t.c[k] == v[k] for k in _KEY])
+        if connection.execute(select([func.count()], key)).scalar():
+            connection.execute(rv_t.update().where(and_(key, rv_t.c.datetime < v['datetime'])).values(datetime=v['datetime']))
+        else:
+            connection.execute(rv_t.insert().values(**v))
+
+def rebuild(connection):
+    """
+    (Re)builds the recent_views table from the audit log (e.g. after upgrading the database).
+
+    :param connection: The database connection (in a transaction).
+    :return: The number of rows in the table.
+    :rtype: int
+    """
+    a_t = model.auditlog_table
+    rv_t = model.recent_views_table
+
+    columns = [a_t.c[k] for k in _KEY]
+    q = select(columns + [func.max(func.coalesce(a_t.c.last_datetime, a_t.c.datetime))], and_(*[c != None for c in columns])).group_by(*columns)
+    # (The query has no parameters.)
+    insert = "INSERT INTO recent_views (operator_id, object_type, object_id, code, datetime) " + unicode(q.compile(dialect=connection.dialect))
+
+    if _upsert_supported(connection):
+        # (Merged with the table, since entries may be written while this is running.)
+        connection.execute(insert + " ON CONFLICT (operator_id, object_type, object_id, code) DO UPDATE SET datetime = EXCLUDED.datetime "
+                           "WHERE recent_views.datetime < EXCLUDED.datetime")
+    else:
+        connection.execute(rv_t.delete())
+        connection.execute(insert)
+
+    count = connection.execute(select([func.count()], from_obj=rv_t)).scalar()
+    log.info("Rebuilt the recent views ({0} rows).".format(count))
+    return count
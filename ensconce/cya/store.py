@@ -0,0 +1,566 @@
+"""
+The (pluggable) stores that the audit log entries are written to.
+
+The store is selected by the `audit.store` setting:
+
+- 'session' writes the (synchronous) entries in the request's session, so they are
+  committed (or rolled back) with the request transaction.
+- 'engine' writes the entries through a dedicated engine (and connection pool), in their
+  own (short) transactions, so that they do not lengthen the request transactions or
+  compete for their connections.  The engine connects to the main database by default,
+  or to a separate database (`audit.sqlalchemy.url`), where the audit tables are created
+  (without the foreign keys to the operators) when it is first used.
+- 'segments' appends the entries to local, append-only segment files (JSON lines),
+  with an fsync per batch of entries (the concurrent writes are grouped into one batch).
+  The entries that were written to the database before switching to this store are still
+  searched.
+
+The synchronous entries are written (and, for the segment files, synced) before
+:func:`ensconce.cya.auditlog.log` returns; see also :mod:`ensconce.cya.writer` for the
+asynchronous (and coalesced) entries, which are written by a background task.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import json
+import fcntl
+import threading
+from datetime import datetime
+
+import pytz
+from dateutil.tz import tzlocal
+from sqlalchemy import create_engine, orm, MetaData, Table, Column, Index
+
+from ensconce import exc
+from ensconce import model
+from ensconce.model import meta, rows
+from ensconce.cya import recent, partitions
+from ensconce.autolog import log
+
+class AuditStore(object):
+    """
+    The interface for the audit log stores.
+    """
+    name = None
+
+    # Whether the (synchronous) entries are written in the request session.
+    in_session = False
+
+    @property
+    def engine(self):
+        """ The engine for the database that has the audit log (and recent views) tables. """
+        return meta.engine
+
+    def session(self):
+        """ Gets the session for reading (searching) the audit log and recent views tables. """
+        return meta.Session()
+
+    def remove_session(self):
+        """
+        Removes the (thread's) reading session at the end of the request, so that its
+        connection is returned to the pool (and its transaction does not hold any locks on
+        the audit tables).  The request session (meta.Session) is closed separately.
+        """
+        pass
+
+    def write(self, entries):
+        """
+        Writes (durably) a batch of entries.
+
+        :param entries: The column values of the entries.
+        :type entries: list of dict
+        """
+        conn = self.engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                conn.execute(model.auditlog_table.insert(), entries)
+                recent.record(conn, entries)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+
+    def search(self, start=None, end=None, matches=None, before=None, limit=None):
+        """
+        Searches the entries that are not in the database tables.
+
+        :param start: The start of the date range (optional).
+        :param end: The end of the date range (optional).
+        :param matches: A function that is called with each row (in the range), to check
+                        whether it matches (the other search criteria).
+        :param before: Only the rows before this (datetime, id) key, e.g. the (decoded)
+                       cursor of the previous page (optional).
+        :type before: tuple
+        :param limit: The max number of rows (optional).
+        :return: The matching rows, newest first.
+        :rtype: list of :class:`ensconce.model.rows.AuditlogRow`
+        """
+        return []
+
+    def count(self, start=None, end=None, matches=None, code_matches=None, estimate=False):
+        """
+        Counts the entries (that are not in the database tables) that match a search.
+
+        :param start: The start of the date range (optional).
+        :param end: The end of the date range (optional).
+        :param matches: A function that checks whether a row matches (see :meth:`search`).
+        :param code_matches: A function that checks whether a code matches (for the estimate).
+        :param estimate: Whether an estimate will do (without reading all of the entries).
+        :rtype: int
+        """
+        return 0
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.name)
+
+class SessionStore(AuditStore):
+    """
+    Writes the entries in the request session (and the asynchronous entries through the
+    main engine).
+    """
+    name = 'session'
+    in_session = True
+
+class EngineStore(AuditStore):
+    """
+    Writes the entries through a dedicated engine (and connection pool).
+    """
+    name = 'engine'
+
+    def __init__(self, url=None, pool_size=5, max_overflow=10):
+        """
+        :param url: The database URL (default is the main database).
+        :param pool_size: The number of connections to keep in the pool.
+        :param max_overflow: The number of connections to allow beyond the pool size.
+        """
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self._engine = None
+        self._session = None
+        self.lock = threading.Lock()
+
+    @property
+    def engine(self):
+        with self.lock:
+            if self._engine is None:
+                engine = create_engine(self.url or meta.engine.url, pool_size=self.pool_size,
+                                       max_overflow=self.max_overflow, echo=meta.engine.echo)
+                if str(engine.url) != str(meta.engine.url):
+                    create_tables(engine)
+                self._session = orm.scoped_session(orm.sessionmaker(autoflush=True, autocommit=False, bind=engine))
+                self._engine = engine
+                log.info("Writing the audit log through a dedicated engine (database {0}).".format(engine.url.database))
+            return self._engine
+
+    def session(self):
+        self.engine # (Creates the session factory.)
+        return self._session()
+
+    def remove_session(self):
+        if self._session is not None:
+            self._session.remove()
+
+def create_tables(engine):
+    """
+    Creates the audit log and recent views tables (if they do not exist) in a separate
+    database, without the foreign keys to the operators (which are in the main database).
+
+    :param engine: The engine for the audit database.
+    """
+    metadata = MetaData()
+    tables = []
+    for table in (model.auditlog_table, model.recent_views_table):
+        copy = Table(table.name, metadata, *[Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable,
+                                                    autoincrement=c.autoincrement) for c in table.columns])
+        for index in table.indexes:
+            Index(index.name, *[copy.c[c.name] for c in index.columns])
+        tables.append(copy)
+    conn = engine.connect()
+    try:
+        missing = [t for t in tables if not engine.dialect.has_table(conn, t.name)]
+        if missing:
+            trans = conn.begin()
+            try:
+                metadata.create_all(conn, tables=missing)
+                if tables[0] in missing:
+                    partitions.partition_table(conn, tables[0])
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            log.info("Created the audit tables: {0}".format(', '.join(t.name for t in missing)))
+    finally:
+        conn.close()
+
+class SegmentStore(AuditStore):
+    """
+    Appends the entries to local segment files.
+
+    The segments are files of JSON lines (one entry per line) named for the id of their
+    first entry (audit-000000001234.log); a new segment is started when the current one
+    reaches segment_size bytes.  The entry ids are reserved from the sequence of the audit
+    log table (see :func:`reserve_ids`).  The appends are serialized (also between
+    processes) with a lock file.
+
+    Each segment has an index file (audit-000000001234.idx) with the range of its entry
+    ids and date/times and its number of entries of each code, so that the searches only
+    read the segments in the date range, newest first, until they have a page of
+    matches (after the cursor), and the estimated counts do not read the segments at all.
+    An index that is missing or out of date (e.g. after an interrupted write) is rebuilt
+    from its segment.
+    """
+    name = 'segments'
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync=True):
+        """
+        :param path: The directory for the segment files.
+        :param segment_size: The size (bytes) at which a new segment is started.
+        :param fsync: Whether to sync the files after each batch (disable for tests only).
+        """
+        if not path:
+            raise exc.ConfigurationError("No audit log segments path is configured (audit.segments.path).")
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._cond = threading.Condition()
+        self._queue = []
+        self._writing = False
+
+    def write(self, entries):
+        """
+        Appends the entries, grouped with the entries of any concurrent writes into one
+        batch (with one fsync), and waits until they have been written.
+        """
+        ticket = dict(done=False, error=None)
+        with self._cond:
+            self._queue.append((ticket, entries))
+            while not ticket['done']:
+                if self._writing:
+                    self._cond.wait()
+                    continue
+                (batch, self._queue) = (self._queue, [])
+                self._writing = True
+                error = None
+                self._cond.release()
+                try:
+                    self._append([e for (_, batch_entries) in batch for e in batch_entries])
+                except Exception as e:
+                    log.exception("Error writing audit log entries to the segments.")
+                    error = e
+                finally:
+                    self._cond.acquire()
+                    self._writing = False
+                    for (t, _) in batch:
+                        t.update(done=True, error=error)
+                    self._cond.notify_all()
+        if ticket['error'] is not None:
+            raise exc.DataError("Error writing audit log entries: {0}".format(ticket['error']))
+
+        conn = meta.engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                recent.record(conn, entries)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+
+    def _append(self, entries):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, mode=0700)
+        with open(os.path.join(self.path, 'audit.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                segments = self.segments()
+                if segments:
+                    name = segments[-1][1]
+                # (Reserved under the lock, so that the ids increase through the segments.)
+                ids = reserve_ids(len(entries))
+
+                encoded = [_encode(dict(values, id=entry_id)) for (entry_id, values) in zip(ids, entries)]
+                data = ''.join(json.dumps(values, separators=(',', ':')) + '\n' for values in encoded)
+
+                # (A new segment is also started after an incomplete entry.)
+                created = (not segments or os.path.getsize(os.path.join(self.path, name)) >= self.segment_size
+                           or not _complete(os.path.join(self.path, name)))
+                if created:
+                    if segments:
+                        # (Brings the index of the previous segment up to date, e.g. after an incomplete entry.)
+                        segment_index(os.path.join(self.path, name), save=True)
+                    name = _SEGMENT_FORMAT.format(ids[0])
+                    index = _new_index()
+                else:
+                    index = segment_index(os.path.join(self.path, name))
+                path = os.path.join(self.path, name)
+
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+                try:
+                    os.write(fd, data)
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+                if created and self.fsync:
+                    dirfd = os.open(self.path, os.O_RDONLY)
+                    try:
+                        os.fsync(dirfd)
+                    finally:
+                        os.close(dirfd)
+
+                for values in encoded:
+                    _add_to_index(index, values)
+                index['size'] += len(data)
+                _save_index(path, index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def segments(self):
+        """
+        Gets the segment files.
+
+        :return: A list of (first id, file name) tuples, in order.
+        :rtype: list
+        """
+        if not os.path.isdir(self.path):
+            return []
+        result = []
+        for name in os.listdir(self.path):
+            m = _SEGMENT_RE.match(name)
+            if m:
+                result.append((int(m.group(1)), name))
+        return sorted(result)
+
+    def _indexes(self, start=None, end=None, before=None):
+        """ Gets the (index, path) of each segment that has entries in the range (and before the key). """
+        result = []
+        for (_, name) in self.segments():
+            path = os.path.join(self.path, name)
+            index = segment_index(path)
+            if not index['count']:
+                continue
+            if (start is not None and index['end'] < start) or (end is not None and index['start'] > end):
+                continue
+            if before is not None and (index['start'], index['first_id']) >= before:
+                continue
+            result.append((index, path))
+        return result
+
+    def search(self, start=None, end=None, matches=None, before=None, limit=None):
+        start = partitions.as_utc(start) if start else None
+        end = partitions.as_utc(end) if end else None
+        key = lambda r: (r.datetime, r.id)
+
+        # The segments with the newest entries first, so that the reading can stop once no
+        # (remaining) segment has entries newer than the last of the (limit) matches.
+        indexes = self._indexes(start, end, before)
+        indexes.sort(key=lambda (index, path): (index['end'], index['last_id']), reverse=True)
+        results = []
+        for (index, path) in indexes:
+            if limit and len(results) >= limit and (index['end'], index['last_id']) < key(results[limit - 1]):
+                break
+            for row in read_segment(path):
+                if ((start is None or row.datetime >= start) and (end is None or row.datetime <= end)
+                    and (before is None or key(row) < before) and (matches is None or matches(row))):
+                    results.append(row)
+            results.sort(key=key, reverse=True)
+            if limit:
+                del results[limit:]
+        return results
+
+    def count(self, start=None, end=None, matches=None, code_matches=None, estimate=False):
+        """
+        Counts the matching entries in the segments of the date range.
+
+        The estimate is the number of entries with matching codes in the segment indexes
+        (prorated by how much of the time span of a segment is in the range); the other
+        criteria are not applied, so it can be high.
+        """
+        start = partitions.as_utc(start) if start else None
+        end = partitions.as_utc(end) if end else None
+        count = 0
+        for (index, path) in self._indexes(start, end):
+            if estimate:
+                n = sum(c for (code, c) in index['codes'].items() if code_matches is None or code_matches(code))
+                span = (index['end'] - index['start']).total_seconds()
+                if span > 0:
+                    covered = (min(end or index['end'], index['end']) - max(start or index['start'], index['start'])).total_seconds()
+                    n = n * covered / span
+                count += int(round(n))
+            else:
+                count += sum(1 for row in read_segment(path)
+                             if ((start is None or row.datetime >= start) and (end is None or row.datetime <= end)
+                                 and (matches is None or matches(row))))
+        return count
+
+_SEGMENT_FORMAT = 'audit-{0:012d}.log'
+_SEGMENT_RE = re.compile(r'^audit-(\d+)\.log$')
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_DATETIME_COLUMNS = ('datetime', 'last_datetime')
+
+def reserve_ids(count):
+    """
+    Reserves ids for (segment) entries from the sequence of the audit log table, so that
+    they are not used again for the entries written to the database (e.g. after switching
+    back to one of the database stores).
+
+    :param count: The number of ids.
+    :return: The ids, in order.
+    :rtype: list of int
+    :raise ensconce.exc.ConfigurationError: If the database is not PostgreSQL.
+    """
+    conn = meta.engine.connect()
+    try:
+        if conn.dialect.name != 'postgresql':
+            raise exc.ConfigurationError("The audit log segments store requires a PostgreSQL database (for the id sequence).")
+        return sorted(r[0] for r in conn.execute("SELECT nextval(pg_get_serial_sequence(%(table)s, 'id')) "
+                                                 "FROM generate_series(1, %(count)s)", table=partitions.TABLE, count=count))
+    finally:
+        conn.close()
+
+def read_segment(path):
+    """
+    Reads the entries of a segment file.
+
+    An incomplete line (from a write that was interrupted) is skipped.
+
+    :rtype: generator of :class:`ensconce.model.rows.AuditlogRow`
+    """
+    for values in _read_lines(path):
+        for name in _DATETIME_COLUMNS:
+            if values.get(name) is not None:
+                values[name] = _decode_datetime(values[name])
+        yield rows.AuditlogRow(**dict((f, values.get(f)) for f in rows.AuditlogRow._fields))
+
+def segment_index(path, save=False):
+    """
+    Gets the index of a segment file, rebuilding it (from the segment) if it is missing
+    or out of date.
+
+    :param path: The path of the segment file.
+    :param save: Whether to save a rebuilt index.
+    :return: A dict with the size (bytes) of the segment, the count, first_id and last_id
+             of its entries, the range of their date/times (start and end) and the number
+             of entries of each code (codes).
+    :rtype: dict
+    """
+    index_path = _index_path(path)
+    size = os.path.getsize(path)
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as fp:
+            index = json.load(fp)
+        if index['size'] == size:
+            for name in ('start', 'end'):
+                if index[name] is not None:
+                    index[name] = _decode_datetime(index[name])
+            return index
+    index = _new_index()
+    for values in _read_lines(path):
+        _add_to_index(index, values)
+    index['size'] = size
+    if save:
+        _save_index(path, index)
+    return index
+
+def _index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
+
+def _new_index():
+    return dict(size=0, count=0, first_id=None, last_id=None, start=None, end=None, codes={})
+
+def _add_to_index(index, values):
+    """ Adds an (encoded) entry to an index. """
+    dt = _decode_datetime(values['datetime'])
+    index['count'] += 1
+    index['first_id'] = values['id'] if index['first_id'] is None else min(index['first_id'], values['id'])
+    index['last_id'] = values['id'] if index['last_id'] is None else max(index['last_id'], values['id'])
+    index['start'] = dt if index['start'] is None else min(index['start'], dt)
+    index['end'] = dt if index['end'] is None else max(index['end'], dt)
+    index['codes'][values['code']] = index['codes'].get(values['code'], 0) + 1
+
+def _save_index(path, index):
+    # (Not synced; an index that is lost is rebuilt from the segment.)
+    encoded = dict(index)
+    for name in ('start', 'end'):
+        if encoded[name] is not None:
+            encoded[name] = encoded[name].strftime(_DATETIME_FORMAT)
+    index_path = _index_path(path)
+    with open(index_path + '.tmp', 'wb') as fp:
+        json.dump(encoded, fp, separators=(',', ':'))
+    os.rename(index_path + '.tmp', index_path)
+
+def _read_lines(path):
+    """ Reads the (encoded) entries of a segment file, skipping an incomplete line. """
+    with open(path, 'rb') as fp:
+        for line in fp:
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError("No end of line")
+                values = json.loads(line)
+            except ValueError:
+                log.warning("Skipping incomplete audit log entry in {0}".format(path))
+                continue
+            yield values
+
+def _decode_datetime(value):
+    return datetime.strptime(value, _DATETIME_FORMAT).replace(tzinfo=pytz.utc)
+
+def _complete(path):
+    """ Whether the segment file ends with a complete entry (or is empty). """
+    with open(path, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        if fp.tell() == 0:
+            return True
+        fp.seek(-1, os.SEEK_END)
+        return fp.read(1) == '\n'
+
+def _encode(values):
+    encoded = dict(values)
+    for name in _DATETIME_COLUMNS:
+        value = encoded.get(name)
+        if value is not None:
+            if value.tzinfo is None:
+                # (The entry date/times are naive local times, like in the database.)
+                value = value.replace(tzinfo=tzlocal())
+            encoded[name] = value.astimezone(pytz.utc).strftime(_DATETIME_FORMAT)
+    return encoded
+
+class AuditStoreSelector(object):
+    """
+    Holds the store that the audit log entries are written to (and read from).
+    """
+    def __init__(self):
+        self.current = SessionStore()
+
+    def configure(self, name='session', url=None, pool_size=5, max_overflow=10, path=None, segment_size=64 * 1024 * 1024):
+        """
+        Selects the store to use.
+
+        :param name: The name of the store ('session', 'engine' or 'segments').
+        :type name: str
+        :param url: The database URL for the 'engine' store (default is the main database).
+        :param pool_size: The connection pool size for the 'engine' store.
+        :param max_overflow: The number of connections beyond the pool size for the 'engine' store.
+        :param path: The directory for the 'segments' store.
+        :param segment_size: The size (bytes) of the segment files for the 'segments' store.
+        :raise ensconce.exc.ConfigurationError: If there is no store with that name.
+        """
+        if name == SessionStore.name:
+            self.current = SessionStore()
+        elif name == EngineStore.name:
+            self.current = EngineStore(url=url, pool_size=pool_size, max_overflow=max_overflow)
+        elif name == SegmentStore.name:
+            self.current = SegmentStore(path, segment_size=segment_size)
+        else:
+            raise exc.ConfigurationError("Audit store is not available: {0}".format(name))
+        log.info("Using audit store {0}.".format(name))
+
+audit_store = AuditStoreSelector()
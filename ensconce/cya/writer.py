@@ -0,0 +1,262 @@
+"""
+The (optionally asynchronous) writer for the audit log entries.
+
+By default (and always for the codes that are not configured as asynchronous) the
+entries are added to the request's session, so they are written when the request
+transaction is committed (and are rolled back with it).  The entries for the
+asynchronous codes (e.g. content views and searches, which are most of the entries)
+are instead queued in memory and written in batches (with a single executemany INSERT
+in a separate transaction, or a single append to the segment files; see
+:mod:`ensconce.cya.store`) by a background task that calls :meth:`AuditWriter.flush`.
+
+The queue is bounded: when it is full, :meth:`AuditWriter.put` waits for up to the
+configured timeout for space, and then writes the entry synchronously (so entries are
+never dropped, but the requests are slowed down to the rate the database can take).
+The queued entries are lost if the process dies before they are flushed (they are
+still in the syslog, though), which is why this is opt-in per code.
+
+The entries for the coalesced codes (e.g. the content views of automation clients that
+fetch the same password many times a minute) are also written asynchronously, but the
+entries with the same operator, code and object within a window (of seconds from the
+first one) are folded into one entry, with the number of hits and the date/time of the
+last one.  The entry is queued when its window closes.
+"""
+from __future__ import absolute_import
+
+import time
+import Queue
+import threading
+
+from ensconce.cya.store import audit_store
+from ensconce.autolog import log
+
+class AuditWriter(object):
+    """
+    Queues the audit log entries (for the asynchronous codes) and writes them in batches.
+
+    The writer is synchronous by default; use :meth:`configure` to enable the queue.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._open = {}
+        self.configure()
+        self.reset_stats()
+
+    def configure(self, async_codes=(), batch_size=500, max_queued=10000, queue_timeout=1.0,
+                  coalesce_codes=(), coalesce_window=60.0):
+        """
+        (Re)configure the writer.
+
+        This should be done before the writer is used (any queued entries are discarded).
+
+        :param async_codes: The audit codes whose entries are written asynchronously (the
+                            others are written in the request transaction).
+        :type async_codes: list
+        :param batch_size: The max number of entries per INSERT.
+        :type batch_size: int
+        :param max_queued: The max number of queued entries.
+        :type max_queued: int
+        :param queue_timeout: The max time (seconds) to wait for space in a full queue,
+                              before writing the entry synchronously instead.
+        :type queue_timeout: float
+        :param coalesce_codes: The audit codes whose (asynchronous) entries are coalesced.
+        :type coalesce_codes: list
+        :param coalesce_window: The time (seconds) from the first entry during which the
+                                entries (with the same operator, code and object) are
+                                coalesced; 0 disables coalescing.
+        :type coalesce_window: float
+        """
+        if batch_size < 1 or max_queued < 1:
+            raise ValueError("Audit writer batch_size and max_queued must be positive numbers.")
+        self.async_codes = frozenset(async_codes)
+        self.coalesce_codes = frozenset(coalesce_codes) if coalesce_window > 0 else frozenset()
+        self.coalesce_window = coalesce_window
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._queue = Queue.Queue(maxsize=max_queued)
+        with self.lock:
+            self._pending = []
+            self._open = {}
+
+    def reset_stats(self):
+        """ Resets the counters. """
+        with self.lock:
+            self.written = 0
+            self.batches = 0
+            self.max_batch = 0
+            self.overflows = 0
+            self.errors = 0
+            self.dropped = 0
+            self.coalesced = 0
+            self.last_lag = 0.0
+            self.max_lag = 0.0
+
+    @property
+    def stats(self):
+        """
+        A dict of the number of queued entries and the write counters: the number of
+        entries written (by the background task) and of batches, the largest batch, the
+        number of entries that were written synchronously because the queue was full
+        (overflows), the number of failed batches and of the entries that were dropped
+        because they could not be written (dropped), the number of coalesced entries that
+        are waiting for their window to close (open) and of the entries that were folded
+        into them (coalesced), and the time (seconds) between queuing
+        and writing the oldest entry of the last batch (last_lag) and of any batch (max_lag).
+        """
+        with self.lock:
+            return dict(queued=self._queue.qsize() + len(self._pending),
+                        open=len(self._open),
+                        written=self.written,
+                        batches=self.batches,
+                        max_batch=self.max_batch,
+                        overflows=self.overflows,
+                        errors=self.errors,
+                        dropped=self.dropped,
+                        coalesced=self.coalesced,
+                        last_lag=self.last_lag,
+                        max_lag=self.max_lag)
+
+    def is_async(self, code):
+        """ Whether the entries with the code are written asynchronously. """
+        return code in self.async_codes or code in self.coalesce_codes
+
+    def put(self, values):
+        """
+        Queues an entry to be written.
+
+        :param values: The column values of the entry.
+        :type values: dict
+        :return: False if the queue was full (so the entry was not queued, and must be
+                 written synchronously).
+        :rtype: bool
+        """
+        if values['code'] in self.coalesce_codes:
+            return self._coalesce(values)
+        try:
+            self._queue.put((time.time(), values), timeout=self.queue_timeout)
+        except Queue.Full:
+            with self.lock:
+                self.overflows += 1
+            log.warning("Audit log queue is full; writing entry synchronously.")
+            return False
+        return True
+
+    def _coalesce(self, values):
+        key = (values['operator_id'], values['code'], values['object_type'], values['object_id'])
+        now = time.time()
+        with self.lock:
+            opened = self._open.get(key)
+            if opened is not None and now - opened[0] < self.coalesce_window:
+                entry = opened[1]
+                entry['hits'] += 1
+                entry['last_datetime'] = values['datetime']
+                self.coalesced += 1
+                return True
+            if opened is None and len(self._open) >= self.max_queued:
+                self.overflows += 1
+                log.warning("Too many coalesced audit log entries; writing entry synchronously.")
+                return False
+            if opened is not None:
+                # (Its window has closed.)
+                self._pending.append((now, opened[1]))
+            self._open[key] = (now, dict(values, hits=1, last_datetime=values['datetime']))
+        return True
+
+    def _close_windows(self, close_all=False):
+        """ Moves the coalesced entries whose window has closed to the pending entries. """
+        now = time.time()
+        with self.lock:
+            for (key, (opened, entry)) in self._open.items():
+                if close_all or now - opened >= self.coalesce_window:
+                    del self._open[key]
+                    self._pending.append((now, entry))
+
+    def flush(self, close_all=False):
+        """
+        Writes all of the queued entries (in batches of up to batch_size), including the 
+        coalesced entries whose window has closed.
+
+        The entries of a batch that fails are written one at a time; if the others are
+        written, the entries that still fail (e.g. because their operator has been
+        deleted) are dropped (and logged), so that they do not hold up the rest of the
+        queue.  If none of them can be written (e.g. the database is down), the batch is
+        retried on the next flush.
+
+        :param close_all: Whether to also write the coalesced entries whose window is still
+                          open (e.g. when the application stops).
+        :type close_all: bool
+        :return: The number of entries that were written.
+        :rtype: int
+        """
+        written = 0
+        with self._flush_lock:
+            self._close_windows(close_all)
+            while True:
+                with self.lock:
+                    batch = self._pending[:self.batch_size]
+                    del self._pending[:self.batch_size]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                if not batch:
+                    break
+                try:
+                    audit_store.current.write([values for (_, values) in batch])
+                except:
+                    log.exception("Error writing {0} audit log entries; writing them one at a time.".format(len(batch)))
+                    with self.lock:
+                        self.errors += 1
+                    (batch, failed) = self._write_each(batch)
+                    if not batch:
+                        log.error("Could not write any of the {0} audit log entries (will retry).".format(len(failed)))
+                        with self.lock:
+                            self._pending[:0] = failed
+                        break
+                    for (_, values) in failed:
+                        log.critical("Dropping audit log entry that could not be written: {0!r}".format(values))
+                    with self.lock:
+                        self.dropped += len(failed)
+                lag = time.time() - min(queued for (queued, _) in batch)
+                with self.lock:
+                    self.written += len(batch)
+                    self.batches += 1
+                    self.max_batch = max(self.max_batch, len(batch))
+                    self.last_lag = lag
+                    self.max_lag = max(self.max_lag, lag)
+                written += len(batch)
+        return written
+
+    def _write_each(self, batch):
+        """
+        Writes the entries of a batch one at a time.
+
+        :return: A tuple of the (queued, values) of the entries that were written and of those that failed.
+        :rtype: tuple
+        """
+        (written, failed) = ([], [])
+        for item in batch:
+            try:
+                audit_store.current.write([item[1]])
+            except:
+                log.exception("Error writing audit log entry.")
+                failed.append(item)
+            else:
+                written.append(item)
+        return (written, failed)
+
+    def close(self):
+        """
+        Writes all of the entries, including the open coalesced entries (e.g. when the 
+        application stops).
+
+        :return: The number of entries that were written.
+        :rtype: int
+        """
+        return self.flush(close_all=True)
+
+audit_writer = AuditWriter()
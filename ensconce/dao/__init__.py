@@ -6,4 +6,6 @@ but it is how the code is currently organized.
 """
 from collections import namedtuple
 
-SearchResults = namedtuple('SearchResults', ['count', 'entries'])
+# (The next_cursor is only set by the searches that support keyset pagination; see :mod:`ensconce.dao.pagination`.)
+SearchResults = namedtuple('SearchResults', ['count', 'entries', 'next_cursor'])
+SearchResults.__new__.__defaults__ = (None,)
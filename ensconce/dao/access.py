@@ -5,7 +5,6 @@ from sqlalchemy.exc import IntegrityError
 from ensconce import model, exc
 from ensconce.autolog import log
 from ensconce.cya import auditlog
-from ensconce.dao import operators
 from ensconce.model import meta
 
 def get(access_id, assert_exists=True):
@@ -101,6 +100,23 @@ def modify(access_id, **kwargs):
     
     return (alevel, modified)
 
+def access_level(operator_id):
+    """
+    Gets the access level (mask) of an operator, with a single query.
+    
+    :param operator_id: The operator.
+    :return: The numeric access level mask (0 if the operator has no access level).
+    :rtype: int
+    :raise ensconce.exc.NoSuchEntity: If operator_id cannot be resolved.
+    """
+    session = meta.Session()
+    q = session.query(model.Operator.id, model.Access.level)
+    q = q.outerjoin(model.Access, model.Operator.access_id==model.Access.id)
+    row = q.filter(model.Operator.id==operator_id).first()
+    if row is None:
+        raise exc.NoSuchEntity(model.Operator, operator_id)
+    return row.level or 0
+
 def has_access(operator_id, level_mask=None):
     """
     This function will check to see whether specified operator_id has specified access level.
@@ -110,10 +126,9 @@ def has_access(operator_id, level_mask=None):
     :type level_mask: int
     :return: Whether or not operator has access.
     :rtype: bool
-    :raise ValueError: If operator_id cannot be resolved. 
+    :raise ensconce.exc.NoSuchEntity: If operator_id cannot be resolved. 
     """
-    user = operators.get(operator_id)
-    return ((user.access.level & level_mask) != 0)
+    return ((access_level(operator_id) & level_mask) != 0)
     
 def verify_access(operator_id, level_mask=None):
     """
@@ -2,11 +2,11 @@ from __future__ import absolute_import
 from datetime import datetime
 
 import pytz
-from sqlalchemy import and_, select
+from sqlalchemy import and_, select, func
 from sqlalchemy.orm.exc import NoResultFound
 
 from ensconce import model, exc
-from ensconce.model import meta
+from ensconce.model import meta, rows
 from ensconce.autolog import log
 #from ensconce.dao import history
 
@@ -66,6 +66,28 @@ def list(): # @ReservedAssignment
     else:
         return groups
 
+def list_rows():
+    """
+    Gets all of the groups (ordered by name) as read-only rows, with the number
+    of resources in each group.
+    
+    :rtype: list of :class:`ensconce.model.rows.GroupRow`
+    """
+    session = meta.Session()
+    try:
+        gt = model.groups_table
+        grt = model.group_resources_table
+        counts = select([grt.c.group_id, func.count(grt.c.resource_id).label('resource_count')]).group_by(grt.c.group_id).alias('counts')
+        q = select([gt.c.id, gt.c.name, func.coalesce(counts.c.resource_count, 0)],
+                   from_obj=[gt.outerjoin(counts, counts.c.group_id == gt.c.id)])
+        q = q.order_by(gt.c.name)
+        groups = rows.fetch(rows.GroupRow, session.execute(q))
+    except:
+        log.exception("Error retrieving groups.")
+        raise
+    else:
+        return groups
+
 def create(name):
     """
     This function will create a group, add it to the database, and
@@ -0,0 +1,134 @@
+"""
+Keyset ("seek") pagination and (estimated) counts for the DAO searches.
+
+A page is ordered by a unique key of columns (e.g. (datetime, id) or (name, id)); the
+next page is then the rows that come after the key of the last row of the page, which
+the database can find through an index on the key columns (unlike an OFFSET, which has
+to skip all of the preceding rows).  The key of the last row is passed around as an
+opaque cursor string.
+"""
+from __future__ import absolute_import
+
+import json
+import base64
+from datetime import datetime
+
+import pytz
+from sqlalchemy import tuple_, literal, select, func
+from sqlalchemy.types import DateTime
+
+from ensconce.autolog import log
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_cursor(values):
+    """
+    Encodes the key values of a row as a cursor.
+
+    :param values: The values of the key columns.
+    :type values: list
+    :rtype: str
+    """
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(pytz.utc).replace(tzinfo=None)
+            value = value.strftime(_DATETIME_FORMAT)
+        encoded.append(value)
+    return base64.urlsafe_b64encode(json.dumps(encoded, separators=(',', ':'))).rstrip('=')
+
+def decode_cursor(cursor, key_columns):
+    """
+    Decodes a cursor into the values of the key columns.
+
+    :param cursor: The cursor (from :func:`encode_cursor`).
+    :type cursor: str
+    :param key_columns: The key columns.
+    :type key_columns: list
+    :rtype: list
+    :raise ValueError: If the cursor is not valid (for the key columns).
+    """
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(key_columns):
+            raise ValueError("Wrong number of values")
+        decoded = []
+        for (column, value) in zip(key_columns, values):
+            if isinstance(column.type, DateTime):
+                value = datetime.strptime(value, _DATETIME_FORMAT)
+                if column.type.timezone:
+                    value = value.replace(tzinfo=pytz.utc)
+            decoded.append(value)
+        return decoded
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("Invalid pagination cursor: {0!r} ({1})".format(cursor, e))
+
+def ordering(key_columns, descending=False):
+    """
+    Gets the ORDER BY clauses for the key columns.
+
+    :rtype: list
+    """
+    return [c.desc() if descending else c.asc() for c in key_columns]
+
+def seek_clause(key_columns, cursor, descending=False):
+    """
+    Builds the clause that selects the rows after the cursor (in the :func:`ordering`).
+
+    This is a row-value comparison, e.g. (datetime, id) < (:datetime, :id), which can use
+    an index on the key columns.
+
+    :param key_columns: The key columns.
+    :param cursor: The cursor of the last row of the previous page.
+    :param descending: Whether the rows are ordered descending.
+    """
+    values = decode_cursor(cursor, key_columns)
+    key = tuple_(*key_columns)
+    bound = tuple_(*[literal(v, type_=c.type) for (c, v) in zip(key_columns, values)])
+    return key < bound if descending else key > bound
+
+def paginate(entries, key_columns, limit):
+    """
+    Splits the extra row (if any) from the fetched rows, to get the page and the cursor
+    of the next page.
+
+    The query should have fetched (up to) limit + 1 rows.
+
+    :param entries: The fetched rows (entities or rows with attributes for the key columns).
+    :param key_columns: The key columns.
+    :param limit: The page size (or None for all of the rows).
+    :return: A tuple of the page rows and the cursor for the next page (or None if
+             this is the last page).
+    :rtype: tuple
+    """
+    if limit is None or len(entries) <= limit:
+        return (entries, None)
+    entries = entries[:limit]
+    last = entries[-1]
+    return (entries, encode_cursor([getattr(last, c.key) for c in key_columns]))
+
+def estimated_count(session, query):
+    """
+    Gets the number of rows that the planner expects the query to return.
+
+    On PostgreSQL this is the row estimate of EXPLAIN (from the table statistics), which
+    does not read the rows; it can be off, especially for filtered queries and tables that
+    have not been analyzed recently.  On other databases this counts the rows.
+
+    :param session: The database session.
+    :param query: The (select) query, without ORDER BY/LIMIT.
+    :rtype: int
+    """
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql':
+        return session.execute(select([func.count()], from_obj=query.alias())).scalar()
+    compiled = query.compile(dialect=connection.dialect)
+    # (A plain string is passed straight through to the DB-API, with the compiled params.)
+    plan = connection.execute("EXPLAIN (FORMAT JSON) " + unicode(compiled), compiled.params).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    count = int(plan[0]['Plan']['Plan Rows'])
+    log.debug("Estimated count: {0}".format(count))
+    return count
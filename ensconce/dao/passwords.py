@@ -10,6 +10,7 @@ from sqlalchemy.orm import attributes
 
 from ensconce import model, exc
 from ensconce.model import meta
+from ensconce.searchindex import vault_index
 from ensconce.autolog import log
 from ensconce.webapp.util import operator_info
 
@@ -69,6 +70,7 @@ def delete(password_id):
         log.exception("Unable to delete password: {0}".format(password_id))
         raise
     
+    vault_index.password_deleted(pw)
     return pw
 
 def create(username, resource_id, password=None, description=None, tags=None, expire_months=None):
@@ -112,6 +114,7 @@ def create(username, resource_id, password=None, description=None, tags=None, ex
         log.exception("Error saving new password.")
         raise
     
+    vault_index.password_saved(pw)
     return pw
 
 def modify(password_id, **kwargs):
@@ -150,4 +153,5 @@ def modify(password_id, **kwargs):
         log.exception("Error modifying password: {0}".format(password_id))
         raise
     
+    vault_index.password_saved(pw)
     return (pw, modified)
\ No newline at end of file
@@ -3,14 +3,16 @@ This module provides the database routines to manipulate resources.
 """
 from __future__ import absolute_import
 
-from sqlalchemy import or_, and_, func
+from sqlalchemy import and_, func, select
 from sqlalchemy.orm.exc import NoResultFound
 
 #from ensconce.dao import groups
 from ensconce.autolog import log
-from ensconce.dao import SearchResults
-from ensconce.model import meta
+from ensconce.dao import SearchResults, pagination
+from ensconce.model import meta, rows
 from ensconce import model, exc
+from ensconce.textsearch import search_backend, split_terms
+from ensconce.searchindex import vault_index
 
 def get(resource_id, assert_exists=True):
     """
@@ -71,14 +73,17 @@ def get_by_name(name, assert_single=True, assert_exists=True):
     return match
 
 
-def search(searchstr=None, order_by=None, offset=None, limit=None): # @ReservedAssignment
+def search(searchstr=None, order_by=None, offset=None, limit=None, cursor=None, # @ReservedAssignment
+           skip_count=False, estimate_count=False):
     """
     Search within resources and return matched results for specified limit/offset.
     
-    :param searchstr: A search string that will be matched against name, addr, and description attributes.
+    :param searchstr: A search string whose words will be matched against the name, addr, description and tags 
+                      attributes (see :mod:`ensconce.textsearch`).
     :type searchstr: str
     
     :param order_by: The sort column can be expressed as a string that includes asc/desc (e.g. "name asc").
+                     (The default is to order by name, which supports the cursor pagination.)
     :type order_by: str
     
     :param offset: Offset in list for rows to return (supporting pagination).
@@ -87,35 +92,62 @@ def search(searchstr=None, order_by=None, offset=None, limit=None): # @ReservedA
     :param limit: Max rows to return (supporting pagination).
     :type limit: int
     
-    :returns: A :class:`ensconce.dao.SearchResults` named tuple that includes count and list of :class:`ensconce.model.Resource` matches.
+    :param cursor: The next_cursor of the previous page, to return the rows after it (keyset 
+                   pagination, which does not have to skip the preceding rows like the offset).
+    :type cursor: str
+    
+    :param skip_count: Whether to skip counting the matches (the count is then None).
+    :type skip_count: bool
+    
+    :param estimate_count: Whether to use the (PostgreSQL) planner estimate of the count 
+                           instead of counting the matches.
+    :type estimate_count: bool
+    
+    :returns: A :class:`ensconce.dao.SearchResults` named tuple that includes count and list of :class:`ensconce.model.Resource` 
+              matches, and the next_cursor (if ordered by name and there are more than limit matches).
     :rtype: :class:`ensconce.dao.SearchResults`
     """
     session = meta.Session()
     try:
         r_t = model.resources_table
+        key_columns = [r_t.c.name, r_t.c.id]
         
-        if order_by is None:
-            order_by = r_t.c.name
+        if cursor is not None and order_by is not None:
+            raise ValueError("The cursor pagination requires the default (name) order.")
         
         clauses = []
         
-        if searchstr:
-            clauses.append(or_(r_t.c.name.ilike('%'+searchstr+'%'),
-                             r_t.c.addr.ilike('%'+searchstr+'%'),
-                             r_t.c.description.ilike('%'+searchstr+'%')))
+        if split_terms(searchstr):
+            clauses.append(search_backend.current.match(r_t, searchstr))
         
-        # (Well, there's only a single clause right now, so that's a little over-engineered)
+        if skip_count:
+            count = None
+        elif estimate_count:
+            count = pagination.estimated_count(session, select([r_t.c.id], and_(*clauses)))
+        else:
+            count = session.query(func.count(r_t.c.id)).filter(and_(*clauses)).scalar()
         
-        count = session.query(func.count(r_t.c.id)).filter(and_(*clauses)).scalar()
+        if cursor is not None:
+            clauses.append(pagination.seek_clause(key_columns, cursor))
         
-        q = session.query(model.Resource).filter(and_(*clauses)).order_by(order_by)
+        q = session.query(model.Resource).filter(and_(*clauses))
+        
+        if order_by is None:
+            q = q.order_by(*pagination.ordering(key_columns))
+        else:
+            q = q.order_by(order_by)
         
         if limit is not None:
-            q = q.limit(limit)
+            q = q.limit(limit if order_by is not None else limit + 1)
         if offset is not None:
             q = q.offset(offset)
         
-        return SearchResults(count=count, entries=q.all())
+        entries = q.all()
+        next_cursor = None
+        if order_by is None:
+            (entries, next_cursor) = pagination.paginate(entries, key_columns, limit)
+        
+        return SearchResults(count=count, entries=entries, next_cursor=next_cursor)
     except:
         log.exception("Error listing resources")
         raise
@@ -145,6 +177,23 @@ def list(): # @ReservedAssignment
         raise
     else:
         return resources
+
+def list_rows():
+    """
+    Gets all of the resources (ordered by name) as read-only rows.
+    
+    :rtype: list of :class:`ensconce.model.rows.ResourceRow`
+    """
+    session = meta.Session()
+    try:
+        r_t = model.resources_table
+        q = select(rows.columns(rows.ResourceRow, r_t)).order_by(r_t.c.name)
+        resources = rows.fetch(rows.ResourceRow, session.execute(q))
+    except:
+        log.exception("Error listing resources")
+        raise
+    else:
+        return resources
     
 def create(name, group_ids, addr=None, description=None, notes=None, tags=None):
     """
@@ -187,6 +236,7 @@ def create(name, group_ids, addr=None, description=None, notes=None, tags=None):
         
     session.flush()
     
+    vault_index.resource_saved(resource)
     return resource
 
 def modify(resource_id, group_ids=None, **kwargs):
@@ -243,6 +293,7 @@ def modify(resource_id, group_ids=None, **kwargs):
     
     session.flush()
     
+    vault_index.resource_saved(resource)
     return (resource, modified)
 
 def delete(resource_id):
@@ -257,4 +308,5 @@ def delete(resource_id):
     except:
         log.exception("Error deleting resource: {0}".format(resource_id))
         raise
+    vault_index.resource_deleted(resource)
     return resource
@@ -12,11 +12,12 @@ import tempfile
 
 import pexpect
 import gnupg
-from sqlalchemy import and_
+from sqlalchemy import and_, orm
 import yaml
 
 from ensconce import model, exc
 from ensconce.model import meta
+from ensconce.crypto import engine
 from ensconce.config import config
 from ensconce.autolog import log
 from ensconce.dao import passwords, resources, groups
@@ -82,21 +83,38 @@ class DictExporter(Exporter):
         pass_t = model.passwords_table
         grp_t = model.groups_table
         
-        q = session.query(model.Resource).order_by(rsrc_t.c.name)
+        q = session.query(model.Resource).options(orm.undefer('notes')).order_by(rsrc_t.c.name)
         if self.resource_filters:
             q = q.join(model.GroupResource)
             q = q.filter(and_(*self.resource_filters))
             
         q = q.order_by(rsrc_t.c.name)
-        for resource in q.all():
-            rdict = resource.to_dict(decrypt=True)
-            pw_q = resource.passwords
+        resources = q.all()
+        
+        # We decrypt the notes (and later all of the passwords) in batches, rather
+        # than having each to_dict() call decrypt its own value.
+        pw_dicts = []
+        pw_ciphertexts = []
+        
+        notes = engine.decrypt_many(resource.notes for resource in resources)
+        for (resource, notes_decrypted) in zip(resources, notes):
+            rdict = resource.to_dict(decrypt=False)
+            rdict['notes'] = unicode(notes_decrypted, 'utf-8') if notes_decrypted is not None else None
+            pw_q = resource.passwords.options(orm.undefer('password'))
             if self.password_filters:
                 pw_q = pw_q.filter(and_(*self.password_filters))
             pw_q = pw_q.order_by(pass_t.c.username)
-            rdict['passwords'] = [pw.to_dict(decrypt=True) for pw in pw_q.all()]
+            rdict['passwords'] = []
+            for pw in pw_q.all():
+                pw_dict = pw.to_dict(decrypt=False)
+                rdict['passwords'].append(pw_dict)
+                pw_dicts.append(pw_dict)
+                pw_ciphertexts.append(pw.password)
             rdict['groups'] = [g.name for g in resource.groups.order_by(grp_t.c.name).all()]
             content['resources'].append(rdict)
+        
+        for (pw_dict, password) in zip(pw_dicts, engine.decrypt_many(pw_ciphertexts)):
+            pw_dict['password'] = password
             
         return content
     
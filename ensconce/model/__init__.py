@@ -8,22 +8,23 @@ import binascii
 
 import pytz
 
-from sqlalchemy import orm, engine_from_config
+from sqlalchemy import orm, event, engine_from_config, DDL
 from sqlalchemy.orm import attributes
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.sql import select, and_
 from sqlalchemy import (Table, Column, PickleType, ForeignKey, Integer,
                         DateTime, PassiveDefault, LargeBinary,
                         ForeignKeyConstraint, String, Boolean, Text,
-                        UniqueConstraint, BigInteger)
+                        UniqueConstraint, BigInteger, Index)
 
 from alembic import command
 
 from ensconce.exc import ConfigurationError, DatabaseVersionError
 from ensconce.autolog import log
 from ensconce.model import meta, migrationsutil
-from ensconce.crypto import engine
-from ensconce.model import satypes
+from ensconce.crypto import engine, blindindex
+from ensconce.model import satypes, tags as tagging
+from ensconce.cya import partitions
 from ensconce.util import pwhash
 
 def init_model(config, drop=False, check_version=True):
@@ -241,23 +242,11 @@ class Password(Entity):
         :param decrypt: Whether to include decrypted password.
         :param include_resources: Whether to include associated parent resource.
         :param include_history: Whether to add password history rows.
+        :see: :func:`ensconce.model.serialize.passwords_to_dicts`
         """        
-        d = dict(id=self.id,
-                 username=self.username,
-                 resource_id=self.resource_id,
-                 description=self.description,
-                 tags=self.tags, # XXX: split?
-                 )
-        if decrypt:
-            d['password'] = self.password_decrypted
-            
-        if include_resource:
-            d['resource'] = self.resource.to_dict()
-            
-        if include_history:
-            d['history'] = [h.to_dict() for h in self.history.order_by(password_history_table.c.modified.desc())]
-            
-        return d
+        from ensconce.model import serialize # (Runtime import to avoid circular dep.)
+        return serialize.passwords_to_dicts([self], decrypt=decrypt, include_resource=include_resource,
+                                            include_history=include_history)[0]
 
 class PasswordHistory(Entity):
     
@@ -285,13 +274,10 @@ class PasswordHistory(Entity):
         """
         :param decrypt: Whether to include decrypted password.
         :param include_subject: Whether to include the parent/subject Password object.
+        :see: :func:`ensconce.model.serialize.history_to_dicts`
         """
-        d = dict(id=self.id,
-                 password_id=self.password_id,
-                 )
-        if decrypt:
-            d['password'] = self.password_decrypted
-            
+        from ensconce.model import serialize # (Runtime import to avoid circular dep.)
+        d = serialize.history_to_dicts([self], decrypt=decrypt)[0]
         if include_subject:
             d['subject'] = self.subject.to_dict()
         return d
@@ -303,12 +289,12 @@ class Group(Entity):
         return self.name
     
     def to_dict(self, include_resources=False, decrypt_resources=False):
-        d = dict(id=self.id,
-                 name=self.name,
-                 )
-        if include_resources:
-            d['resources'] = [r.to_dict(decrypt=decrypt_resources) for r in self.resources.order_by('name')]
-        return d
+        """
+        :see: :func:`ensconce.model.serialize.groups_to_dicts`
+        """
+        from ensconce.model import serialize # (Runtime import to avoid circular dep.)
+        return serialize.groups_to_dicts([self], include_resources=include_resources, 
+                                         decrypt_resources=decrypt_resources)[0]
     
 class Resource(Entity):
     """
@@ -328,20 +314,15 @@ class Resource(Entity):
     @notes_decrypted.setter
     def notes_decrypted(self, cleartext):
         self.notes = engine.encrypt(cleartext)
+        self._notes_cleartext = cleartext # (For the blind index; see _notes_index_listener.)
 
     def to_dict(self, decrypt=True, include_passwords=False, decrypt_passwords=False):
-        d = dict(id=self.id,
-                 group_ids=[g.id for g in self.groups.all()],
-                 name=self.name,
-                 addr=self.addr,
-                 description=self.description,
-                 tags=self.tags, # XXX: split?
-                 )
-        if decrypt:
-            d['notes'] = self.notes_decrypted
-        if include_passwords:
-            d['passwords'] = [p.to_dict(decrypt=decrypt_passwords) for p in self.passwords.order_by(passwords_table.c.username)]
-        return d
+        """
+        :see: :func:`ensconce.model.serialize.resources_to_dicts`
+        """
+        from ensconce.model import serialize # (Runtime import to avoid circular dep.)
+        return serialize.resources_to_dicts([self], decrypt=decrypt, include_passwords=include_passwords,
+                                            decrypt_passwords=decrypt_passwords)[0]
     
 class Access(Entity):
     """
@@ -363,6 +344,18 @@ class GroupResource(object):
     """
     pass
 
+def _lookup_entity(object_type, object_id):
+    """ Looks up an entity by its (audit log) object type and id. """
+    if object_id is None or object_type is None:
+        return None
+    try:
+        clazz = globals()[object_type]
+    except KeyError:
+        raise ValueError("Invalid class object specified in audit log: {0}".format(object_type))
+    
+    session = meta.Session()
+    return session.query(clazz).get(object_id)
+
 class AuditlogEntry(object):
     """
     An entry in the audit log.
@@ -373,15 +366,7 @@ class AuditlogEntry(object):
         Lookup the entity object associated with this audit log row or None if 
         there is no target object.
         """
-        if self.object_id is None or self.object_type is None:
-            return None
-        try:
-            clazz = globals()[self.object_type]
-        except KeyError:
-            raise ValueError("Invalid class object specified in audit log: {0}".format(self.object_type))
-        
-        session = meta.Session()
-        return session.query(clazz).get(self.object_id)
+        return _lookup_entity(self.object_type, self.object_id)
         
     def to_dict(self, include_operator=False):
         d = dict(id=self.id,
@@ -394,11 +379,27 @@ class AuditlogEntry(object):
                  object_label=self.object_label,
                  attributes_modified=self.attributes_modified,
                  comment=self.comment,
+                 hits=self.hits,
+                 last_datetime=self.last_datetime.strftime('%Y-%m-%d %H:%M:%S') if self.last_datetime else None,
                  )
         if include_operator:
             d['operator'] = self.operator.to_dict() if self.operator else None
         return d
     
+class RecentView(object):
+    """
+    The latest audit log entry of an operator for an object (and code).
+    """
+    def lookup_entity(self):
+        """
+        Lookup the entity object that was viewed (or None if it no longer exists).
+        """
+        return _lookup_entity(self.object_type, self.object_id)
+    
+    def __repr__(self):
+        return '<{0} operator_id={1} {2}:{3} code={4}>'.format(self.__class__.__name__, self.operator_id,
+                                                              self.object_type, self.object_id, self.code)
+    
 class KeyMetadata(object):
     """
     An entry in the encryption-key validation/metadata table.
@@ -418,8 +419,39 @@ class KeyMetadata(object):
 # from passphrase.  
 key_metadata_table = Table('key_metadata', meta.metadata,
                             Column('id', Integer, primary_key=True, autoincrement=False),
-                            Column('validation', satypes.HexEncodedBinary, nullable=False),
-                            Column('kdf_salt', satypes.HexEncodedBinary, nullable=False))
+                            Column('validation', satypes.Ciphertext, nullable=False),
+                            Column('kdf_salt', satypes.HexEncodedBinary, nullable=False),
+                            Column('index_check', LargeBinary, nullable=True)) # See ensconce.crypto.blindindex
+
+class DataKey(object):
+    """
+    A data-encryption key, stored wrapped (encrypted) with the master key.
+    
+    The database contents are encrypted with data keys (and tagged with the id
+    of the key), so that replacing the master key only requires re-wrapping these
+    rows rather than re-encrypting the entire database.
+    """
+    def __repr__(self):
+        return '<{0} id={1}>'.format(self.__class__.__name__, self.id)
+
+# The data key with the highest id is the one used to encrypt new data.
+data_keys_table = Table('data_keys', meta.metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('wrapped_key', satypes.Ciphertext, nullable=False),
+                        Column('created', DateTime(timezone=pytz.utc), default=datetime.now, nullable=False))
+
+class Checkpoint(object):
+    """
+    The saved position of a long-running (resumable) batch operation.
+    """
+    def __repr__(self):
+        return '<{0} name={1} position={2}>'.format(self.__class__.__name__, self.name, self.position)
+
+# The position is typically the last processed id of an id-ordered scan.
+checkpoints_table = Table('checkpoints', meta.metadata,
+                          Column('name', String(255), primary_key=True),
+                          Column('position', Integer, nullable=False),
+                          Column('modified', DateTime(timezone=pytz.utc), default=datetime.now, onupdate=datetime.now, nullable=False))
 
 operators_table = Table('operators', meta.metadata,
                         Column('id', Integer, primary_key=True),
@@ -433,11 +465,12 @@ operators_table = Table('operators', meta.metadata,
 passwords_table = Table('passwords', meta.metadata,
                         Column('id', BigInteger, primary_key=True, autoincrement=True),
                         Column('username', String(255), nullable=False, index=True),
-                        Column('password', satypes.HexEncodedBinary, nullable=True),
+                        Column('password', satypes.Ciphertext, nullable=True),
                         Column('resource_id', Integer, ForeignKey('resources.id', ondelete="RESTRICT"), nullable=False, index=True), # TODO: Cascade delete
                         Column('description', Text, nullable=True), # NOT ENCRYPTED
                         Column('expire', DateTime(timezone=pytz.utc), nullable=True, index=True), # Relevant for the future?
                         Column('tags', Text, nullable=True), # NOT ENCRYPTED
+                        info={'searchable': ('username', 'description', 'tags')},
                         )
 
 password_history_table = Table('password_history', meta.metadata,
@@ -446,19 +479,21 @@ password_history_table = Table('password_history', meta.metadata,
                          Column('modified', DateTime(timezone=pytz.utc), default=datetime.now, nullable=False, index=True),
                          Column('modifier_id', Integer, ForeignKey('operators.id', ondelete="SET NULL"), nullable=True, index=True),
                          Column('modifier_username', String(255), nullable=True), # For when the operators are deleted.
-                         Column('password', satypes.HexEncodedBinary, nullable=True)) # Encrypted!
+                         Column('password', satypes.Ciphertext, nullable=True)) # Encrypted!
                         
 groups_table = Table('groups', meta.metadata,
                      Column('id', Integer, primary_key=True),
-                     Column('name', String(255), nullable=False, index=True, unique=True))
+                     Column('name', String(255), nullable=False, index=True, unique=True),
+                     info={'searchable': ('name',)})
 
 resources_table = Table('resources', meta.metadata,
                         Column('id', Integer, primary_key=True),
                         Column('name', String(255), nullable=False, index=True),
                         Column('addr', String(255), nullable=True, index=True),
                         Column('description', Text, nullable=True),
-                        Column('notes', satypes.HexEncodedBinary, nullable=True),
+                        Column('notes', satypes.Ciphertext, nullable=True),
                         Column('tags', Text, nullable=True), # NOT ENCRYPTED
+                        info={'searchable': ('name', 'addr', 'description', 'tags')},
                         )
 
 group_resources_table = Table('group_resources', meta.metadata,
@@ -467,15 +502,18 @@ group_resources_table = Table('group_resources', meta.metadata,
 
 auditlog_table = Table('auditlog', meta.metadata,
                        Column('id', BigInteger, primary_key=True),
-                       Column('datetime', DateTime(timezone=pytz.utc), default=datetime.now, nullable=False, index=True),
+                       Column('datetime', DateTime(timezone=pytz.utc), default=datetime.now, nullable=False),
                        Column('code', String(255), nullable=False, index=True),
                        Column('operator_id', Integer, ForeignKey('operators.id', ondelete="SET NULL"), nullable=True, index=True),
                        Column('operator_username', String(255), nullable=True, index=True),
-                       Column('object_type', String(255), nullable=True, index=True),
-                       Column('object_id', BigInteger, nullable=True, index=True),
+                       Column('object_type', String(255), nullable=True),
+                       Column('object_id', BigInteger, nullable=True),
                        Column('object_label', Text, nullable=True),
                        Column('attributes_modified', satypes.SimpleList, nullable=True),
-                       Column('comment', Text, nullable=True))
+                       Column('comment', Text, nullable=True),
+                       # The number of (coalesced) events, and the date/time of the last one; see ensconce.cya.writer
+                       Column('hits', Integer, default=1, nullable=False),
+                       Column('last_datetime', DateTime(timezone=pytz.utc), nullable=True))
 
 access_table = Table('access', meta.metadata,
                      Column('id', Integer, primary_key=True, nullable=False),
@@ -483,16 +521,91 @@ access_table = Table('access', meta.metadata,
                      Column('description', Text, nullable=True))
 
 
+def _add_fulltext_search(table):
+    """
+    Adds the DDL for the (PostgreSQL) full-text search of the searchable columns of the table.
+    
+    This is a tsvector `search_document` column (not mapped) that is kept up-to-date by a 
+    trigger, with a GIN index; see :mod:`ensconce.textsearch`.  (The migrations create 
+    the same for existing databases.)  The columns are joined and the punctuation is 
+    replaced by spaces, so that host names and addresses are split into words.
+    """
+    columns = table.info['searchable']
+    text = " || ' ' || ".join("coalesce(NEW.{0}, '')".format(c) for c in columns)
+    statements = ("ALTER TABLE {table} ADD COLUMN search_document tsvector",
+                  "CREATE OR REPLACE FUNCTION {table}_search_document() RETURNS trigger AS $$ BEGIN "
+                  "NEW.search_document := to_tsvector('simple'::regconfig, regexp_replace({text}, '[^[:alnum:]]+', ' ', 'g')); "
+                  "RETURN NEW; END $$ LANGUAGE plpgsql",
+                  "CREATE TRIGGER {table}_search_document BEFORE INSERT OR UPDATE OF {columns} ON {table} "
+                  "FOR EACH ROW EXECUTE PROCEDURE {table}_search_document()",
+                  "CREATE INDEX ix_{table}_fulltext ON {table} USING gin (search_document)")
+    for statement in statements:
+        ddl = DDL(statement.format(table=table.name, text=text, columns=', '.join(columns)), on='postgresql')
+        event.listen(table, 'after_create', ddl)
+
+_add_fulltext_search(resources_table)
+_add_fulltext_search(groups_table)
+_add_fulltext_search(passwords_table)
+
+# The tags parsed from the resources.tags and passwords.tags fields (see ensconce.model.tags).
+tags_table = Table('tags', meta.metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('name', String(255), nullable=False, unique=True))
+
+# (The primary keys are tag first, so that they are the indexes for the tag searches.)
+resource_tags_table = Table('resource_tags', meta.metadata,
+                            Column('tag_id', Integer, ForeignKey('tags.id', ondelete="CASCADE"), primary_key=True),
+                            Column('resource_id', Integer, ForeignKey('resources.id', ondelete="CASCADE"), primary_key=True, index=True))
+
+password_tags_table = Table('password_tags', meta.metadata,
+                            Column('tag_id', Integer, ForeignKey('tags.id', ondelete="CASCADE"), primary_key=True),
+                            Column('password_id', BigInteger, ForeignKey('passwords.id', ondelete="CASCADE"), primary_key=True, index=True))
+
+# The blind index of the (encrypted) resource notes (see ensconce.crypto.blindindex).
+# (The primary key is token first, so that it is the index for the searches.)
+resource_note_tokens_table = Table('resource_note_tokens', meta.metadata,
+                                   Column('token', BigInteger, primary_key=True, autoincrement=False),
+                                   Column('resource_id', Integer, ForeignKey('resources.id', ondelete="CASCADE"), primary_key=True, index=True))
+
+# The keys of the (keyset) pagination; see ensconce.dao.pagination.
+Index('ix_resources_name_id', resources_table.c.name, resources_table.c.id)
+Index('ix_auditlog_datetime_id', auditlog_table.c.datetime, auditlog_table.c.id)
+
+Index('ix_auditlog_object', auditlog_table.c.object_type, auditlog_table.c.object_id)
+
+def _partition_auditlog(target, connection, **kw):
+    """ Converts the (new) auditlog table into a partitioned table, on databases that support it. """
+    partitions.partition_table(connection, target)
+
+event.listen(auditlog_table, 'after_create', _partition_auditlog)
+
+# The latest audit log entry of each (operator, object, code), maintained as the entries
+# are written (see ensconce.cya.recent); for the "recently viewed" lists.
+recent_views_table = Table('recent_views', meta.metadata,
+                           Column('operator_id', Integer, ForeignKey('operators.id', ondelete="CASCADE"), primary_key=True),
+                           Column('object_type', String(255), primary_key=True),
+                           Column('object_id', BigInteger, primary_key=True, autoincrement=False),
+                           Column('code', String(255), primary_key=True),
+                           Column('datetime', DateTime(timezone=pytz.utc), nullable=False))
+
+Index('ix_recent_views_operator_datetime', recent_views_table.c.operator_id, recent_views_table.c.object_type,
+      recent_views_table.c.datetime)
+
 orm.mapper(Operator, operators_table, properties={
     'access': orm.relationship(Access),
     'auditlog': orm.relationship(AuditlogEntry, lazy="dynamic", backref="operator")
 })
 
+# The encrypted columns are deferred (only loaded when they are accessed), since most
+# queries (lists, searches) do not need them.  Use orm.undefer() when loading many rows
+# whose values will be decrypted.
 orm.mapper(Password, passwords_table, properties={
+    'password': orm.deferred(passwords_table.c.password),
     'history': orm.relationship(PasswordHistory, backref='subject', lazy="dynamic", cascade="all,delete")
 })
 
 orm.mapper(PasswordHistory, password_history_table, properties={
+    'password': orm.deferred(password_history_table.c.password),
     'modifier': orm.relationship(Operator)
 })
 
@@ -501,6 +614,7 @@ orm.mapper(Group, groups_table, properties={
 })
 
 orm.mapper(Resource, resources_table, properties={
+    'notes': orm.deferred(resources_table.c.notes),
     'groups': orm.relationship(Group, secondary=group_resources_table, lazy="dynamic"),
     'passwords':  orm.relationship(Password, backref="resource", lazy="dynamic")
 })
@@ -513,4 +627,33 @@ orm.mapper(GroupResource, group_resources_table) # We probably don't need this m
 
 orm.mapper(AuditlogEntry, auditlog_table)
 
+orm.mapper(RecentView, recent_views_table)
+
+def _tags_listener(join_table):
+    """ Creates a mapper event listener that updates the tags join table when the tags field changes. """
+    def sync(mapper, connection, target):
+        if attributes.get_history(target, 'tags').has_changes():
+            tagging.sync_tags(connection, join_table, target.id, target.tags)
+    return sync
+
+event.listen(Resource, 'after_insert', _tags_listener(resource_tags_table))
+event.listen(Resource, 'after_update', _tags_listener(resource_tags_table))
+event.listen(Password, 'after_insert', _tags_listener(password_tags_table))
+event.listen(Password, 'after_update', _tags_listener(password_tags_table))
+
+def _notes_index_listener(mapper, connection, target):
+    """
+    A mapper event listener that updates the blind index of the notes when they have been set 
+    (with `notes_decrypted`; re-encrypting the notes does not change the index).
+    """
+    if '_notes_cleartext' in target.__dict__:
+        blindindex.update(connection, target.id, target.__dict__.pop('_notes_cleartext'))
+
+event.listen(Resource, 'after_insert', _notes_index_listener)
+event.listen(Resource, 'after_update', _notes_index_listener)
+
 orm.mapper(KeyMetadata, key_metadata_table)
+
+orm.mapper(DataKey, data_keys_table)
+
+orm.mapper(Checkpoint, checkpoints_table)
@@ -0,0 +1,68 @@
+"""
+Lightweight read-only rows for the list and search results.
+
+These are namedtuples (so they have no per-instance dict) that are built directly from
+column-projected queries, bypassing the ORM identity map.  They have the same attribute
+names (and `label`) as the corresponding entities, so the templates and the bulk
+serialization functions in :mod:`ensconce.model.serialize` can use either.  They do not
+have the relationships or the encrypted columns.
+"""
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+class GroupRow(namedtuple('GroupRow', ['id', 'name', 'resource_count'])):
+    __slots__ = ()
+
+    @property
+    def label(self):
+        return self.name
+
+    def to_dict(self):
+        return dict(id=self.id, name=self.name)
+
+class ResourceRow(namedtuple('ResourceRow', ['id', 'name', 'addr', 'description', 'tags'])):
+    __slots__ = ()
+
+    @property
+    def label(self):
+        return self.name
+
+class PasswordRow(namedtuple('PasswordRow', ['id', 'resource_id', 'username', 'description', 'tags'])):
+    __slots__ = ()
+
+    @property
+    def label(self):
+        return self.username
+
+class AuditlogRow(namedtuple('AuditlogRow', ['id', 'datetime', 'code', 'operator_id', 'operator_username',
+                                             'object_type', 'object_id', 'object_label',
+                                             'attributes_modified', 'comment', 'hits', 'last_datetime'])):
+    __slots__ = ()
+
+    def to_dict(self):
+        d = self._asdict()
+        d['datetime'] = self.datetime.strftime('%Y-%m-%d %H:%M:%S') # TODO: TZ?
+        d['last_datetime'] = self.last_datetime.strftime('%Y-%m-%d %H:%M:%S') if self.last_datetime else None
+        return d
+
+def columns(row_class, table):
+    """
+    Gets the table columns for the fields of the row class (in order).
+
+    :param row_class: The row class (its fields must be columns of the table).
+    :param table: The table.
+    :rtype: list
+    """
+    return [table.c[f] for f in row_class._fields]
+
+def fetch(row_class, result):
+    """
+    Builds rows from the (column-projected) query result.
+
+    :param row_class: The row class.
+    :param result: The result rows (with the columns in the order of the row class fields).
+    :rtype: list
+    """
+    make = row_class._make
+    return [make(r) for r in result]
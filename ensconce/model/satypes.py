@@ -1,7 +1,7 @@
 import binascii
 import json
 
-from sqlalchemy import TypeDecorator, Text
+from sqlalchemy import TypeDecorator, Text, LargeBinary
 
 class Json(TypeDecorator):
 
@@ -47,4 +47,29 @@ class HexEncodedBinary(TypeDecorator):
     def process_result_value(self, value, dialect):
         if value is not None:
             value = binascii.unhexlify(value)
-        return value
\ No newline at end of file
+        return value
+
+
+# The characters of (lower-case) hex-encoded values.
+_HEX_DIGITS = '0123456789abcdef'
+
+class Ciphertext(TypeDecorator):
+    """
+    A native binary column for encrypted values.
+    
+    This also reads values that are still hex-encoded (i.e. those that were stored
+    with :class:`HexEncodedBinary` and have not been converted yet).  A real (random)
+    ciphertext will not consist only of hex digits, so the two encodings can be 
+    distinguished.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value and len(value) % 2 == 0 and not value.translate(None, _HEX_DIGITS):
+            value = binascii.unhexlify(value)
+        return value
@@ -0,0 +1,220 @@
+"""
+Bulk serialization of the model entities to dicts (e.g. for the JSON-RPC API).
+
+The related rows (group memberships, passwords, password history) for a whole list of
+entities are loaded with a few IN-queries, rather than a few queries per entity, and
+the encrypted values are decrypted as a batch.  The `to_dict()` methods of the entities
+delegate to these functions, so the dicts have the same shape either way.
+
+The encrypted columns are deferred in the mappers; any that were not loaded with the
+entities are loaded for the whole list with one more IN-query (see `_load_deferred`).
+"""
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+from sqlalchemy import select, orm
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ensconce.crypto import engine
+from ensconce.model import meta
+from ensconce import model
+
+# The maximum number of ids in an IN clause.
+IN_BATCH_SIZE = 500
+
+# The (deferred) encrypted attribute of each entity.
+_ENCRYPTED_ATTRIBUTES = {model.Resource: 'notes',
+                         model.Password: 'password',
+                         model.PasswordHistory: 'password'}
+
+def groups_to_dicts(groups, include_resources=False, decrypt_resources=False):
+    """
+    Converts groups to dicts.
+
+    :param groups: The groups to convert.
+    :type groups: list of :class:`ensconce.model.Group`
+    :param include_resources: Whether to include the (member) resources of each group.
+    :param decrypt_resources: Whether to include the decrypted notes of the resources.
+    :rtype: list of dict
+    """
+    groups = list(groups)
+    dicts = [dict(id=g.id, name=g.name) for g in groups]
+
+    if include_resources:
+        session = meta.Session()
+        gr_t = model.group_resources_table
+        resources_by_group = defaultdict(list)
+        members = []
+        options = [orm.undefer('notes')] if decrypt_resources else []
+        for batch in _batches(g.id for g in groups):
+            members.extend(session.query(model.Resource, gr_t.c.group_id).options(*options)
+                           .join(gr_t, gr_t.c.resource_id == model.resources_table.c.id)
+                           .filter(gr_t.c.group_id.in_(batch))
+                           .order_by(model.resources_table.c.name)
+                           .all())
+
+        resources = _unique(r for (r, group_id) in members)
+        resource_dicts = dict(zip([r.id for r in resources], resources_to_dicts(resources, decrypt=decrypt_resources)))
+        for (r, group_id) in members:
+            resources_by_group[group_id].append(resource_dicts[r.id])
+
+        for (g, d) in zip(groups, dicts):
+            d['resources'] = resources_by_group.get(g.id, [])
+
+    return dicts
+
+def resources_to_dicts(resources, decrypt=True, include_passwords=False, decrypt_passwords=False):
+    """
+    Converts resources to dicts.
+
+    :param resources: The resources to convert.
+    :type resources: list of :class:`ensconce.model.Resource`
+    :param decrypt: Whether to include the decrypted notes.
+    :param include_passwords: Whether to include the passwords of each resource.
+    :param decrypt_passwords: Whether to include the decrypted passwords.
+    :rtype: list of dict
+    """
+    resources = list(resources)
+
+    session = meta.Session()
+    session.flush() # (The memberships are read with a Core query, which does not autoflush.)
+    gr_t = model.group_resources_table
+    group_ids = defaultdict(list)
+    for batch in _batches(r.id for r in resources):
+        rows = session.execute(select([gr_t.c.resource_id, gr_t.c.group_id], gr_t.c.resource_id.in_(batch))
+                               .order_by(gr_t.c.group_id))
+        for (resource_id, group_id) in rows:
+            group_ids[resource_id].append(group_id)
+
+    dicts = [dict(id=r.id,
+                  group_ids=group_ids.get(r.id, []),
+                  name=r.name,
+                  addr=r.addr,
+                  description=r.description,
+                  tags=r.tags, # XXX: split?
+                  ) for r in resources]
+
+    if decrypt:
+        _load_deferred(resources, model.resources_table.c.notes)
+        for (d, notes) in zip(dicts, engine.decrypt_many(r.notes for r in resources)):
+            d['notes'] = unicode(notes, 'utf-8') if notes is not None else None
+
+    if include_passwords:
+        pw_t = model.passwords_table
+        passwords = _query_in(model.Password, pw_t.c.resource_id, [r.id for r in resources], order_by=pw_t.c.username,
+                              undefer=decrypt_passwords)
+        passwords_by_resource = defaultdict(list)
+        for (pw, pw_dict) in zip(passwords, passwords_to_dicts(passwords, decrypt=decrypt_passwords)):
+            passwords_by_resource[pw.resource_id].append(pw_dict)
+        for (r, d) in zip(resources, dicts):
+            d['passwords'] = passwords_by_resource.get(r.id, [])
+
+    return dicts
+
+def passwords_to_dicts(passwords, decrypt=True, include_resource=False, include_history=False):
+    """
+    Converts passwords to dicts.
+
+    :param passwords: The passwords to convert.
+    :type passwords: list of :class:`ensconce.model.Password`
+    :param decrypt: Whether to include the decrypted password.
+    :param include_resource: Whether to include the parent resource of each password.
+    :param include_history: Whether to include the password history (newest first).
+    :rtype: list of dict
+    """
+    passwords = list(passwords)
+    dicts = [dict(id=pw.id,
+                  username=pw.username,
+                  resource_id=pw.resource_id,
+                  description=pw.description,
+                  tags=pw.tags, # XXX: split?
+                  ) for pw in passwords]
+
+    if decrypt:
+        _load_deferred(passwords, model.passwords_table.c.password)
+        for (d, password) in zip(dicts, engine.decrypt_many(pw.password for pw in passwords)):
+            d['password'] = password
+
+    if include_resource:
+        resources = _query_in(model.Resource, model.resources_table.c.id, [pw.resource_id for pw in passwords], undefer=True)
+        resource_dicts = dict(zip([r.id for r in resources], resources_to_dicts(resources)))
+        for (pw, d) in zip(passwords, dicts):
+            d['resource'] = resource_dicts[pw.resource_id]
+
+    if include_history:
+        ph_t = model.password_history_table
+        history = _query_in(model.PasswordHistory, ph_t.c.password_id, [pw.id for pw in passwords], order_by=ph_t.c.modified.desc(),
+                            undefer=True)
+        history_by_password = defaultdict(list)
+        for (h, h_dict) in zip(history, history_to_dicts(history)):
+            history_by_password[h.password_id].append(h_dict)
+        for (pw, d) in zip(passwords, dicts):
+            d['history'] = history_by_password.get(pw.id, [])
+
+    return dicts
+
+def history_to_dicts(history, decrypt=True):
+    """
+    Converts password history entries to dicts.
+
+    :param history: The password history entries to convert.
+    :type history: list of :class:`ensconce.model.PasswordHistory`
+    :param decrypt: Whether to include the decrypted password.
+    :rtype: list of dict
+    """
+    history = list(history)
+    dicts = [dict(id=h.id, password_id=h.password_id) for h in history]
+    if decrypt:
+        _load_deferred(history, model.password_history_table.c.password)
+        for (d, password) in zip(dicts, engine.decrypt_many(h.password for h in history)):
+            d['password'] = unicode(password, 'utf-8') if password is not None else None
+    return dicts
+
+def _query_in(entity, column, ids, order_by=None, undefer=False):
+    """
+    Gets the entities whose column matches any of the ids, in IN_BATCH_SIZE batches.
+
+    (The results are only ordered within each batch; all of the rows for an id are
+    in the same batch.)
+
+    :param undefer: Whether to load the (deferred) encrypted column of the entities.
+    """
+    session = meta.Session()
+    options = [orm.undefer(_ENCRYPTED_ATTRIBUTES[entity])] if undefer else []
+    results = []
+    for batch in _batches(ids):
+        q = session.query(entity).options(*options).filter(column.in_(batch))
+        if order_by is not None:
+            q = q.order_by(order_by)
+        results.extend(q.all())
+    return results
+
+def _load_deferred(entities, column):
+    """
+    Loads the (deferred) column for any of the entities that have not loaded it.
+
+    :param entities: The entities (all of the same class).
+    :param column: The table column (the attribute has the same name).
+    """
+    attr = column.name
+    pending = dict((e.id, e) for e in entities if attr not in e.__dict__)
+    if not pending:
+        return
+    session = meta.Session()
+    session.flush()
+    id_col = column.table.c.id
+    for batch in _batches(pending.keys()):
+        for (id, value) in session.execute(select([id_col, column], id_col.in_(batch))):
+            set_committed_value(pending[id], attr, value)
+
+def _batches(ids):
+    """ Generator that yields lists of (at most IN_BATCH_SIZE) unique ids. """
+    ids = _unique(ids)
+    for i in xrange(0, len(ids), IN_BATCH_SIZE):
+        yield ids[i:i + IN_BATCH_SIZE]
+
+def _unique(values):
+    """ Removes duplicates from the values (keeping the first of each). """
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
@@ -0,0 +1,158 @@
+"""
+The normalized (indexed) storage of the resource and password tags.
+
+The free-text `tags` columns are still what the users edit; whenever one changes the
+tags are parsed from it and the `resource_tags` / `password_tags` join tables are
+updated to match (by the mapper event listeners that are registered in :mod:`ensconce.model`).
+
+A tag is a run of letters, digits and `_-|:` characters, stored lower-case.  The
+`:` separates the parts of namespaced tags (e.g. "os:linux"); see :func:`match_clause`.
+"""
+from __future__ import absolute_import
+
+import re
+
+from sqlalchemy import select, or_
+from sqlalchemy.exc import DBAPIError
+
+# The characters that separate tags (i.e. everything but these).
+_TAG_RE = re.compile(r'[\w|:-]+', re.UNICODE)
+
+# The maximum length of a (stored) tag; longer ones are ignored.
+MAX_TAG_LENGTH = 255
+
+_INSERT_NEW = "INSERT INTO tags (name) VALUES (%(name)s) ON CONFLICT (name) DO NOTHING"
+
+def parse_tags(text):
+    """
+    Gets the (unique, lower-case) tags from a tags field value.
+
+    :param text: The tags field value.
+    :type text: unicode
+    :rtype: list
+    """
+    if not text:
+        return []
+    tags = []
+    for tag in _TAG_RE.findall(text.lower()):
+        tag = tag.strip(':')
+        if tag and len(tag) <= MAX_TAG_LENGTH and tag not in tags:
+            tags.append(tag)
+    return tags
+
+def match_clause(term):
+    """
+    Builds the clause that selects the tags (rows of the tags table) matching a search term.
+
+    A term matches a whole tag or any `:`-separated part of one.  A term that starts with
+    `:` only matches after a `:` (e.g. ":linux" matches "os:linux" but not "linux") and
+    one that ends with `:` only matches before one ("os:" matches "os:linux").
+
+    :param term: The search term.
+    :type term: unicode
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    t_t = model.tags_table
+
+    term = term.strip().lower()
+    prefix = term.startswith(':')
+    suffix = term.endswith(':')
+    term = term.strip(':')
+    # (Not using backslash as the LIKE escape character, since its quoting varies between databases.)
+    escaped = term.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+    def like(pattern):
+        return t_t.c.name.like(pattern, escape='!')
+
+    # (The stored tags never start or end with ':', so there is always a part before/after the ':'.)
+    clauses = [like('%:{0}:%'.format(escaped))]
+    if not suffix:
+        clauses.append(like('%:{0}'.format(escaped)))
+    if not prefix:
+        clauses.append(like('{0}:%'.format(escaped)))
+    if not prefix and not suffix:
+        clauses.append(t_t.c.name == term)
+    return or_(*clauses)
+
+def tagged_clause(id_column, join_table, terms):
+    """
+    Builds the clause that selects the entities that have tags matching all of the terms.
+
+    Each term is an (indexed) IN subquery on the join table, so the database can
+    intersect them.
+
+    :param id_column: The id column of the entity table (e.g. resources.id).
+    :param join_table: The tags join table for the entity (e.g. resource_tags).
+    :param terms: The search terms.
+    :type terms: list
+    :return: A list of clauses (to AND together).
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    t_t = model.tags_table
+    owner_col = owner_column(join_table)
+    return [id_column.in_(select([owner_col], join_table.c.tag_id.in_(select([t_t.c.id], match_clause(term)))))
+            for term in terms]
+
+def sync_tags(connection, join_table, entity_id, text):
+    """
+    Replaces the join table rows for an entity with the tags parsed from the text
+    (adding any new tags to the tags table).
+
+    :param connection: The connection (of the current flush/transaction).
+    :param join_table: The tags join table for the entity.
+    :param entity_id: The id of the resource/password.
+    :param text: The tags field value.
+    """
+    owner_col = owner_column(join_table)
+
+    connection.execute(join_table.delete().where(owner_col == entity_id))
+    names = parse_tags(text)
+    if not names:
+        return
+
+    tag_ids = _tag_ids(connection, names)
+    missing = [name for name in names if name not in tag_ids]
+    if missing:
+        _add_tags(connection, missing)
+        tag_ids = _tag_ids(connection, names)
+    connection.execute(join_table.insert(), [{owner_col.name: entity_id, 'tag_id': tag_ids[name]} for name in names])
+
+def _on_conflict_supported(connection):
+    return connection.dialect.name == 'postgresql' and connection.dialect.server_version_info >= (9, 5)
+
+def _tag_ids(connection, names):
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    t_t = model.tags_table
+    return dict(connection.execute(select([t_t.c.name, t_t.c.id], t_t.c.name.in_(names))).fetchall())
+
+def _add_tags(connection, names):
+    """
+    Adds the tags to the tags table, skipping any that another transaction has
+    (concurrently) added, so the ids must be selected again afterwards.
+    """
+    # (Runtime import to avoid circular dep.)
+    from ensconce import model
+    t_t = model.tags_table
+
+    if _on_conflict_supported(connection):
+        connection.execute(_INSERT_NEW, [dict(name=name) for name in names])
+        return
+    # Elsewhere each insert gets a savepoint, so that a duplicate does not abort the transaction.
+    for name in names:
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(t_t.insert(), name=name)
+        except DBAPIError as e:
+            # (The DB-API integrity error subclasses are not all wrapped as IntegrityError.)
+            savepoint.rollback()
+            if not isinstance(e.orig, connection.dialect.dbapi.IntegrityError):
+                raise
+        else:
+            savepoint.commit()
+
+def owner_column(join_table):
+    """ Gets the entity id column of a tags join table. """
+    return [c for c in join_table.c if c.name != 'tag_id'][0]
@@ -1,15 +1,19 @@
 from __future__ import absolute_import
-import re
 from collections import namedtuple
 
-from sqlalchemy.sql import and_, or_
+from sqlalchemy import orm, func
+from sqlalchemy.sql import and_, select
 
 from ensconce import model
-from ensconce.model import meta
+from ensconce.textsearch import search_backend, split_terms
+from ensconce.searchindex import vault_index
+from ensconce.model import meta, rows, tags as tagging
+from ensconce.crypto import engine, blindindex
 from ensconce.autolog import log
 
 SearchResults = namedtuple('SearchResults', ('resource_matches', 'group_matches', 'password_matches'))
 TagSearchResults = namedtuple('TagSearchResults', ('resource_matches', 'password_matches'))
+TagFacet = namedtuple('TagFacet', ('name', 'resource_count', 'password_count'))
 
 def search(searchstr, search_resources=True, search_groups=True, search_passwords=True, include_encrypted=False):
     """
@@ -17,13 +21,15 @@ def search(searchstr, search_resources=True, search_groups=True, search_password
     the search string in all applicable tables. It will return a list
     of lists of matches, one for resources, groups and passwords.
     
-    :param searchstr: The search keyword (currently only single word supported)
+    :param searchstr: The search words; the matches contain all of the words (see :mod:`ensconce.textsearch`).
     :param search_resources: Whether to search the resources table..
     :param search_groups: Whether to search the groups table.
     :param search_passwords: Whether to search the passwords table.
-    :param include_encrypted: Whether to search through encrypted fields (will be slow!). This is currently only
-                              the resources.notes field.
-    :returns: A tuple of (resource matches, group matches, password matches)
+    :param include_encrypted: Whether to search through encrypted fields. This is currently only the 
+                              resources.notes field; only the notes that the blind index matches are 
+                              decrypted (see :mod:`ensconce.crypto.blindindex`).
+    :returns: A tuple of (resource matches, group matches, password matches), best matches first
+              (the resources that only matched on their notes are last).
     :rtype: :class:`ensconce.search.SearchResults`
     """
     
@@ -31,25 +37,37 @@ def search(searchstr, search_resources=True, search_groups=True, search_password
     group_results = []
     password_results = []
     
+    if not split_terms(searchstr):
+        return SearchResults(resource_results, group_results, password_results)
+    
     session = meta.Session()
+    if vault_index.ready:
+        # The resources and passwords are searched in the in-memory index (see ensconce.searchindex).
+        (resource_ranks, password_ranks) = vault_index.search(searchstr, search_resources=search_resources,
+                                                              search_passwords=search_passwords, 
+                                                              include_encrypted=include_encrypted)
+        if resource_ranks:
+            q = session.query(model.Resource).filter(model.Resource.id.in_(resource_ranks.keys()))
+            resource_results = _by_rank(q.all(), resource_ranks, 'name')
+        if password_ranks:
+            q = session.query(model.Password).filter(model.Password.id.in_(password_ranks.keys()))
+            password_results = _by_rank(q.all(), password_ranks, 'username')
+        search_resources = search_passwords = False
+    
     if search_resources:
         r_t = model.resources_table
         try:
-            q = session.query(model.Resource).filter(or_(r_t.c.name.ilike('%'+searchstr+'%'),
-                                                     r_t.c.addr.ilike('%'+searchstr+'%'),
-                                                     r_t.c.description.ilike('%'+searchstr+'%'),
-                                                     r_t.c.tags.ilike('%'+searchstr+'%')))
-            q = q.order_by(r_t.c.name)
+            q = session.query(model.Resource).filter(_match(r_t, searchstr))
+            q = q.order_by(*_ranking(r_t, searchstr, r_t.c.name))
             resource_results = q.all()
             
             if include_encrypted: 
-                for r in session.query(model.Resource).all():
-                    if r not in resource_results:
-                        if r.notes_decrypted and searchstr.lower() in r.notes_decrypted.lower():
-                            resource_results.append(r)
-                            
-                # re-sort them.
-                resource_results = sorted(resource_results, key=lambda rsc: rsc.name)
+                matched = set(resource_results)
+                q = session.query(model.Resource).options(orm.undefer('notes')).filter(_notes_clause(session, searchstr))
+                candidates = [c for c in q.order_by(r_t.c.name).all() if c not in matched]
+                for (r, notes) in zip(candidates, engine.decrypt_many(c.notes for c in candidates)):
+                    if _notes_match(searchstr, notes):
+                        resource_results.append(r)
                 
         except:
             log.exception("Error searching on resources.")
@@ -58,8 +76,8 @@ def search(searchstr, search_resources=True, search_groups=True, search_password
     if search_groups:    
         try:
             g_t = model.groups_table
-            q = session.query(model.Group).filter(g_t.c.name.ilike('%'+searchstr+'%'))
-            q = q.order_by(g_t.c.name)
+            q = session.query(model.Group).filter(_match(g_t, searchstr))
+            q = q.order_by(*_ranking(g_t, searchstr, g_t.c.name))
             group_results = q.all()
         except:
             log.exception("Error searching on groups.")
@@ -70,10 +88,8 @@ def search(searchstr, search_resources=True, search_groups=True, search_password
             p_t = model.passwords_table
             
             # And these are the users/passwords associated with resources
-            q = session.query(model.Password).filter(or_(p_t.c.username.ilike('%'+searchstr+'%'),
-                                                         p_t.c.description.ilike('%'+searchstr+'%'),
-                                                         p_t.c.tags.ilike('%'+searchstr+'%')))
-            q = q.order_by(p_t.c.username)
+            q = session.query(model.Password).filter(_match(p_t, searchstr))
+            q = q.order_by(*_ranking(p_t, searchstr, p_t.c.username))
             pw_results = q.all()
             
             password_results.extend(pw_results)
@@ -84,6 +100,107 @@ def search(searchstr, search_resources=True, search_groups=True, search_password
 
     return SearchResults(resource_results, group_results, password_results)
 
+def search_rows(searchstr, search_resources=True, search_groups=True, search_passwords=True, include_encrypted=False):
+    """
+    Searches like :func:`search`, but returns read-only rows.
+    
+    The matches are loaded with column-projected queries (no ORM entities); the
+    notes are only read for the resources that did not match otherwise.
+    
+    :returns: A tuple of (resource matches, group matches, password matches) lists of
+              :class:`ensconce.model.rows.ResourceRow`, :class:`ensconce.model.rows.GroupRow`
+              (without resource_count) and :class:`ensconce.model.rows.PasswordRow`.
+    :rtype: :class:`ensconce.search.SearchResults`
+    """
+    resource_results = []
+    group_results = []
+    password_results = []
+    
+    if not split_terms(searchstr):
+        return SearchResults(resource_results, group_results, password_results)
+    
+    session = meta.Session()
+    if vault_index.ready:
+        # The resources and passwords are searched in the in-memory index (see ensconce.searchindex).
+        (resource_ranks, password_ranks) = vault_index.search(searchstr, search_resources=search_resources,
+                                                              search_passwords=search_passwords, 
+                                                              include_encrypted=include_encrypted)
+        if resource_ranks:
+            r_t = model.resources_table
+            q = select(rows.columns(rows.ResourceRow, r_t), r_t.c.id.in_(resource_ranks.keys()))
+            resource_results = _by_rank(rows.fetch(rows.ResourceRow, session.execute(q)), resource_ranks, 'name')
+        if password_ranks:
+            p_t = model.passwords_table
+            q = select(rows.columns(rows.PasswordRow, p_t), p_t.c.id.in_(password_ranks.keys()))
+            password_results = _by_rank(rows.fetch(rows.PasswordRow, session.execute(q)), password_ranks, 'username')
+        search_resources = search_passwords = False
+    
+    if search_resources:
+        r_t = model.resources_table
+        try:
+            cols = rows.columns(rows.ResourceRow, r_t)
+            q = select(cols, _match(r_t, searchstr)).order_by(*_ranking(r_t, searchstr, r_t.c.name))
+            resource_results = rows.fetch(rows.ResourceRow, session.execute(q))
+            
+            if include_encrypted:
+                matched = set(r.id for r in resource_results)
+                q = select(cols + [r_t.c.notes], _notes_clause(session, searchstr)).order_by(r_t.c.name)
+                candidates = [tuple(c) for c in session.execute(q) if c[0] not in matched]
+                for (c, notes) in zip(candidates, engine.decrypt_many(c[-1] for c in candidates)):
+                    if _notes_match(searchstr, notes):
+                        resource_results.append(rows.ResourceRow._make(c[:-1]))
+        except:
+            log.exception("Error searching on resources.")
+            raise
+    
+    if search_groups:
+        try:
+            g_t = model.groups_table
+            q = select([g_t.c.id, g_t.c.name], _match(g_t, searchstr)).order_by(*_ranking(g_t, searchstr, g_t.c.name))
+            group_results = [rows.GroupRow(id, name, None) for (id, name) in session.execute(q)]
+        except:
+            log.exception("Error searching on groups.")
+            raise
+    
+    if search_passwords:
+        try:
+            p_t = model.passwords_table
+            q = select(rows.columns(rows.PasswordRow, p_t), _match(p_t, searchstr)).order_by(*_ranking(p_t, searchstr, p_t.c.username))
+            password_results = rows.fetch(rows.PasswordRow, session.execute(q))
+        except:
+            log.exception("Error searching on passwords.")
+            raise
+    
+    return SearchResults(resource_results, group_results, password_results)
+
+def _match(table, searchstr):
+    """ The (search backend) clause matching the rows of the table that contain all of the words. """
+    return search_backend.current.match(table, searchstr)
+
+def _ranking(table, searchstr, column):
+    """ The order by clauses for the matches: best first, then by the column. """
+    return [search_backend.current.rank(table, searchstr).desc(), column]
+
+def _by_rank(results, ranks, label):
+    """ Sorts the matches (from the in-memory index) by rank (best first), then by the label attribute. """
+    return sorted(results, key=lambda r: (-ranks[r.id], (getattr(r, label) or u'').lower()))
+
+def _notes_clause(session, searchstr):
+    """ The clause for the resources whose notes need to be checked (narrowed by the blind index, if it is current). """
+    r_t = model.resources_table
+    clause = and_(r_t.c.notes != None, r_t.c.notes != '')
+    candidates = blindindex.candidates(session, searchstr)
+    if candidates is None:
+        return clause
+    return and_(clause, r_t.c.id.in_(candidates))
+
+def _notes_match(searchstr, notes):
+    """ Whether the (decrypted) notes contain all of the words. """
+    if not notes:
+        return False
+    notes = unicode(notes, 'utf-8').lower()
+    return all(term in notes for term in split_terms(searchstr))
+
 
 def tagsearch(tags, search_resources=True, search_passwords=True):
     """
@@ -105,34 +222,10 @@ def tagsearch(tags, search_resources=True, search_passwords=True):
     resource_results = []
     password_results = []
     
-    def _process_tag(tag):
-        tag = tag.strip()
-        # Support prefixing or suffixing tags with ':'
-        prefix = tag.startswith(':')
-        suffix = tag.endswith(':')
-        
-        if prefix or suffix:
-            tag = tag.strip(':')
-        
-        tag = re.escape(tag)
-        
-        if prefix:
-            tag = '.+?\:' + tag
-            
-        if suffix:
-            tag += '\:.+?'
-        
-        # Defnitely possible here to create something that won't match anything
-        return tag
-    
     if search_resources:
         r_t = model.resources_table
         try:
-            r_clause = []
-            for tag in tags:
-                tagstr = _process_tag(tag)
-                r_clause.append(r_t.c.tags.op('~*')(r'([^|[:alnum:]_-]|^){0}([^[:alnum:]_-]|$)'.format(tagstr)))
-            
+            r_clause = tagging.tagged_clause(r_t.c.id, model.resource_tags_table, tags)
             q = session.query(model.Resource).filter(and_(*r_clause))
             q = q.order_by(r_t.c.name)
             resource_results = q.all()
@@ -145,13 +238,7 @@ def tagsearch(tags, search_resources=True, search_passwords=True):
     if search_passwords:
         try:
             p_t = model.passwords_table
-            
-            p_clause = []
-            for tag in tags:
-                tagstr = _process_tag(tag)
-                p_clause.append(p_t.c.tags.op('~*')(r'([^|[:alnum:]_-]|^){0}([^[:alnum:]_-]|$)'.format(tagstr)))
-            
-            # And these are the users/passwords associated with resources
+            p_clause = tagging.tagged_clause(p_t.c.id, model.password_tags_table, tags)
             q = session.query(model.Password).filter(and_(*p_clause))
             q = q.order_by(p_t.c.username)
             password_results = q.all()
@@ -162,3 +249,47 @@ def tagsearch(tags, search_resources=True, search_passwords=True):
             raise
 
     return TagSearchResults(resource_results, password_results)
+
+def tagfacets(tags=None, search_resources=True, search_passwords=True, limit=None):
+    """
+    Counts the resources and passwords that have each tag.
+    
+    :param tags: Only count the resources/passwords that match all of these tags (like 
+                 :func:`tagsearch`), e.g. to show the tags that would narrow a tag search.
+    :type tags: list
+    :param search_resources: Whether to count the resources.
+    :param search_passwords: Whether to count the passwords.
+    :param limit: The maximum number of tags to return.
+    :type limit: int
+    :returns: The tags, most used first.
+    :rtype: list of :class:`ensconce.search.TagFacet`
+    """
+    if isinstance(tags, basestring):
+        tags = [tags]
+    
+    session = meta.Session()
+    t_t = model.tags_table
+    counts = {}
+    
+    def count(join_table, index):
+        owner_col = tagging.owner_column(join_table)
+        clauses = tagging.tagged_clause(owner_col, join_table, tags) if tags else []
+        q = select([t_t.c.name, func.count(owner_col)], and_(t_t.c.id == join_table.c.tag_id, *clauses))
+        q = q.group_by(t_t.c.name)
+        for (name, n) in session.execute(q):
+            counts.setdefault(name, [0, 0])[index] = n
+    
+    try:
+        if search_resources:
+            count(model.resource_tags_table, 0)
+        if search_passwords:
+            count(model.password_tags_table, 1)
+    except:
+        log.exception("Error counting tags.")
+        raise
+    
+    facets = sorted((TagFacet(name, r, p) for (name, (r, p)) in counts.items()),
+                    key=lambda f: (-(f.resource_count + f.password_count), f.name))
+    if limit is not None:
+        facets = facets[:limit]
+    return facets
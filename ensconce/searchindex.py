@@ -0,0 +1,351 @@
+"""
+An (optional) in-memory inverted index of the resources and passwords, for the searches.
+
+When it is enabled (the `search.memory_index` setting), the index is built when the crypto
+state is unlocked and is then updated by the DAO create/modify/delete functions (when their
+transaction is committed), and the searches in :mod:`ensconce.search` use it instead of the
+database for the resources and passwords.  The index has the searchable columns (see
+:mod:`ensconce.textsearch`) and the decrypted resource notes, so (the words of) the notes
+are kept in memory while the application is running.  Changes that are not made through the
+DAO (e.g. by `paver import_data`) are only picked up when the index is next built.
+
+The (lower-case, whitespace-separated) words of the entities are numbered, and each word
+has a posting list: an array of the (sorted) ids of the entities that contain it.  A search
+word matches all of the words that contain it (which are found through an index of the
+3-character substrings of the words), so the searches have the same semantics as the 'like'
+search backend.  The matches are ranked by whether the words are equal to, start with, or
+just contain the search words (the notes do not count towards the rank).
+"""
+from __future__ import absolute_import
+
+import sys
+import bisect
+import weakref
+import threading
+from array import array
+
+from sqlalchemy import orm, event, select
+
+from ensconce import model
+from ensconce.model import meta
+from ensconce.crypto import engine, state
+from ensconce.textsearch import split_terms
+from ensconce.autolog import log
+
+# The length of the substrings that are indexed; shorter search words are matched by
+# scanning all of the words.
+GRAM_SIZE = 3
+
+# The rank of a word that is equal to, starts with, or (just) contains a search word.
+EXACT = 3
+PREFIX = 2
+SUBSTRING = 1
+
+def words(text):
+    """
+    Splits a field value into the (lower-case) words to index.
+
+    :param text: The field value (or None).
+    :type text: unicode or str (UTF-8)
+    :rtype: list
+    """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = unicode(text, 'utf-8')
+    return text.lower().split()
+
+class Vocabulary(object):
+    """
+    The (numbered) words and their posting lists.
+
+    Words are never removed (an unused word just has an empty posting list), so that the
+    numbers do not change; the index is rebuilt from scratch each time it is built.
+    """
+    def __init__(self):
+        self.numbers = {}
+        self.words = []
+        self.postings = []
+        self.grams = {}
+
+    def number(self, word):
+        """ Gets the number of the word, adding it if it is new. """
+        n = self.numbers.get(word)
+        if n is None:
+            n = self.numbers[word] = len(self.words)
+            self.words.append(word)
+            self.postings.append(array('l'))
+            for gram in set(word[i:i + GRAM_SIZE] for i in xrange(len(word) - GRAM_SIZE + 1)):
+                self.grams.setdefault(gram, array('i')).append(n)
+        return n
+
+    def add(self, n, entity_id):
+        """ Adds the entity to the posting list of word number `n`. """
+        postings = self.postings[n]
+        i = bisect.bisect_left(postings, entity_id)
+        if i == len(postings) or postings[i] != entity_id:
+            postings.insert(i, entity_id)
+
+    def remove(self, n, entity_id):
+        """ Removes the entity from the posting list of word number `n`. """
+        postings = self.postings[n]
+        i = bisect.bisect_left(postings, entity_id)
+        if i < len(postings) and postings[i] == entity_id:
+            del postings[i]
+
+    def matching(self, term):
+        """
+        Gets the numbers of the (used) words that contain the search word.
+
+        :rtype: list
+        """
+        if len(term) < GRAM_SIZE:
+            candidates = xrange(len(self.words))
+        else:
+            lists = []
+            for i in xrange(len(term) - GRAM_SIZE + 1):
+                numbers = self.grams.get(term[i:i + GRAM_SIZE])
+                if numbers is None:
+                    return []
+                lists.append(numbers)
+            lists.sort(key=len)
+            candidates = set(lists[0])
+            for numbers in lists[1:]:
+                candidates.intersection_update(numbers)
+        return [n for n in candidates if self.postings[n] and term in self.words[n]]
+
+    def memory_usage(self):
+        """ The (approximate) memory used by the vocabulary, in bytes. """
+        size = sys.getsizeof(self.numbers) + sys.getsizeof(self.words) + sys.getsizeof(self.postings) + sys.getsizeof(self.grams)
+        size += sum(sys.getsizeof(w) for w in self.words)
+        size += sum(sys.getsizeof(p) for p in self.postings)
+        size += sum(sys.getsizeof(g) + sys.getsizeof(n) for (g, n) in self.grams.iteritems())
+        return size
+
+class InvertedIndex(object):
+    """
+    The index of one kind of entity: the words of its (public) fields and of its encrypted fields.
+    """
+    def __init__(self):
+        self.fields = Vocabulary()
+        self.encrypted = Vocabulary()
+        # The (field, encrypted) word numbers of each entity, for removing it.
+        self.entities = {}
+
+    def put(self, entity_id, values, encrypted_values=()):
+        """
+        Adds (or replaces) an entity.
+
+        :param entity_id: The id of the entity.
+        :param values: The values of the (public) fields.
+        :type values: list
+        :param encrypted_values: The (decrypted) values of the encrypted fields.
+        :type encrypted_values: list
+        """
+        self.remove(entity_id)
+        entry = (self._add(self.fields, entity_id, values), self._add(self.encrypted, entity_id, encrypted_values))
+        self.entities[entity_id] = entry
+
+    def _add(self, vocabulary, entity_id, values):
+        numbers = array('i', sorted(set(vocabulary.number(w) for v in values for w in words(v))))
+        for n in numbers:
+            vocabulary.add(n, entity_id)
+        return numbers
+
+    def remove(self, entity_id):
+        """ Removes an entity (if it is in the index). """
+        entry = self.entities.pop(entity_id, None)
+        if entry is not None:
+            for n in entry[0]:
+                self.fields.remove(n, entity_id)
+            for n in entry[1]:
+                self.encrypted.remove(n, entity_id)
+
+    def search(self, terms, include_encrypted=False):
+        """
+        Finds the entities that contain all of the search words.
+
+        :param terms: The (lower-case) search words.
+        :type terms: list
+        :param include_encrypted: Whether to also match the encrypted fields.
+        :type include_encrypted: bool
+        :return: The rank of each matching entity, keyed by id.
+        :rtype: dict
+        """
+        result = None
+        for term in terms:
+            ranks = {}
+            for n in self.fields.matching(term):
+                word = self.fields.words[n]
+                rank = EXACT if word == term else PREFIX if word.startswith(term) else SUBSTRING
+                for entity_id in self.fields.postings[n]:
+                    if (result is None or entity_id in result) and ranks.get(entity_id, 0) < rank:
+                        ranks[entity_id] = rank
+            if include_encrypted:
+                for n in self.encrypted.matching(term):
+                    for entity_id in self.encrypted.postings[n]:
+                        if result is None or entity_id in result:
+                            ranks.setdefault(entity_id, 0)
+            if result is None:
+                result = ranks
+            else:
+                result = dict((entity_id, rank + ranks[entity_id]) for (entity_id, rank) in result.iteritems() if entity_id in ranks)
+            if not result:
+                break
+        return result or {}
+
+    def memory_usage(self):
+        """ The (approximate) memory used by the index, in bytes. """
+        size = self.fields.memory_usage() + self.encrypted.memory_usage() + sys.getsizeof(self.entities)
+        size += sum(sys.getsizeof(e) + sys.getsizeof(e[0]) + sys.getsizeof(e[1]) for e in self.entities.itervalues())
+        return size
+
+class VaultIndex(object):
+    """
+    The in-memory index of the resources and passwords (see module docs).
+
+    The changes that are made through the DAO are queued for the session, and applied
+    when it is committed (or discarded if it is rolled back).
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.RLock()
+        self._resources = None
+        self._passwords = None
+        self._password_resources = {}
+        self._pending = weakref.WeakKeyDictionary()
+
+    def configure(self, enabled=False):
+        """
+        Enables (or disables) the index; it is then built by :meth:`build`.
+
+        :param enabled: Whether to use the in-memory index.
+        :type enabled: bool
+        """
+        with self._lock:
+            self.enabled = enabled
+            self._resources = None
+            self._passwords = None
+            self._password_resources = {}
+
+    @property
+    def ready(self):
+        """ Whether the index is enabled and has been built (for the current crypto state). """
+        return self.enabled and self._resources is not None and state.initialized
+
+    def build(self):
+        """
+        (Re)builds the index from the database, if it is enabled.
+
+        This decrypts all of the resource notes, so it requires the crypto state.
+        """
+        if not self.enabled:
+            return
+        r_t = model.resources_table
+        p_t = model.passwords_table
+        resources = InvertedIndex()
+        passwords = InvertedIndex()
+        password_resources = {}
+        r_cols = [r_t.c[name] for name in r_t.info['searchable']]
+        p_cols = [p_t.c[name] for name in p_t.info['searchable']]
+        conn = meta.engine.connect()
+        try:
+            rows = conn.execute(select([r_t.c.id, r_t.c.notes] + r_cols)).fetchall()
+            for (row, notes) in zip(rows, engine.decrypt_many(row['notes'] for row in rows)):
+                resources.put(row['id'], [row[c] for c in r_cols], [notes])
+            for row in conn.execute(select([p_t.c.id, p_t.c.resource_id] + p_cols)):
+                passwords.put(row['id'], [row[c] for c in p_cols])
+                password_resources[row['id']] = row['resource_id']
+        finally:
+            conn.close()
+        with self._lock:
+            (self._resources, self._passwords, self._password_resources) = (resources, passwords, password_resources)
+        log.info("Built search index of {0} resources and {1} passwords ({2:,} bytes)".format(len(resources.entities), len(passwords.entities),
+                                                                                            self.memory_usage()))
+
+    def search(self, searchstr, search_resources=True, search_passwords=True, include_encrypted=False):
+        """
+        Searches the index.
+
+        :param searchstr: The search string.
+        :param search_resources: Whether to search the resources.
+        :param search_passwords: Whether to search the passwords.
+        :param include_encrypted: Whether to also search the resource notes.
+        :return: A tuple of the (resource, password) ranks, keyed by id.
+        :rtype: tuple
+        """
+        terms = split_terms(searchstr)
+        with self._lock:
+            resource_ranks = self._resources.search(terms, include_encrypted) if search_resources and terms else {}
+            password_ranks = self._passwords.search(terms) if search_passwords and terms else {}
+        return (resource_ranks, password_ranks)
+
+    def memory_usage(self):
+        """ The (approximate) memory used by the index, in bytes. """
+        with self._lock:
+            if self._resources is None:
+                return 0
+            return (self._resources.memory_usage() + self._passwords.memory_usage() +
+                    sys.getsizeof(self._password_resources))
+
+    def resource_saved(self, resource):
+        """ Queues the (created or modified) resource to be updated in the index. """
+        if self.ready:
+            values = [getattr(resource, name) for name in model.resources_table.info['searchable']]
+            self._queue(self._put_resource, resource.id, values, resource.notes_decrypted)
+
+    def resource_deleted(self, resource):
+        """ Queues the resource (and its passwords) to be removed from the index. """
+        if self.ready:
+            self._queue(self._remove_resource, resource.id)
+
+    def password_saved(self, password):
+        """ Queues the (created or modified) password to be updated in the index. """
+        if self.ready:
+            values = [getattr(password, name) for name in model.passwords_table.info['searchable']]
+            self._queue(self._put_password, password.id, password.resource_id, values)
+
+    def password_deleted(self, password):
+        """ Queues the password to be removed from the index. """
+        if self.ready:
+            self._queue(self._remove_password, password.id)
+
+    def _queue(self, operation, *args):
+        session = meta.Session()
+        with self._lock:
+            self._pending.setdefault(session, []).append((operation, args))
+
+    def _put_resource(self, resource_id, values, notes):
+        self._resources.put(resource_id, values, [notes])
+
+    def _remove_resource(self, resource_id):
+        self._resources.remove(resource_id)
+        for (password_id, owner_id) in self._password_resources.items():
+            if owner_id == resource_id:
+                self._remove_password(password_id)
+
+    def _put_password(self, password_id, resource_id, values):
+        self._passwords.put(password_id, values)
+        self._password_resources[password_id] = resource_id
+
+    def _remove_password(self, password_id):
+        self._passwords.remove(password_id)
+        self._password_resources.pop(password_id, None)
+
+    def _commit(self, session):
+        """ Applies the changes that were queued for the (committed) session. """
+        with self._lock:
+            pending = self._pending.pop(session, None)
+            if pending and self._resources is not None:
+                for (operation, args) in pending:
+                    operation(*args)
+
+    def _rollback(self, session):
+        """ Discards the changes that were queued for the (rolled back) session. """
+        with self._lock:
+            self._pending.pop(session, None)
+
+vault_index = VaultIndex()
+
+event.listen(orm.Session, 'after_commit', vault_index._commit)
+event.listen(orm.Session, 'after_rollback', vault_index._rollback)
@@ -20,6 +20,14 @@ from ensconce.config import config, init_app
 from ensconce.autolog import log
 from ensconce.model import meta
 from ensconce.cya import auditlog
+from ensconce.cya.store import audit_store
+from ensconce.cya.writer import audit_writer
+from ensconce.cya.archive import audit_archive
+from ensconce.crypto.cache import decrypted_cache
+from ensconce.crypto.padding import padding_policy
+from ensconce.crypto.backends import backend_selector
+from ensconce.textsearch import search_backend
+from ensconce.searchindex import vault_index
 from ensconce.webapp import util, tree, tasks
 from ensconce.auth import get_configured_providers
 
@@ -165,10 +173,44 @@ def configure():
     util.RNGInitializer(cherrypy.engine).subscribe()
 
 
+    decrypted_cache.configure(enabled=config['crypto.cache.enabled'],
+                              ttl=config['crypto.cache.ttl'],
+                              max_entries=config['crypto.cache.max_entries'])
+    padding_policy.configure(config['crypto.padding_buckets'])
+    backend_selector.configure(config['crypto.backend'])
+    search_backend.configure(config['search.backend'])
+    vault_index.configure(enabled=config['search.memory_index'])
+    audit_archive.configure(path=config['audit.archive.path'])
+    audit_store.configure(config['audit.store'],
+                          url=config['audit.sqlalchemy.url'],
+                          pool_size=config['audit.sqlalchemy.pool_size'],
+                          max_overflow=config['audit.sqlalchemy.max_overflow'],
+                          path=config['audit.segments.path'],
+                          segment_size=config['audit.segments.size_mb'] * 1024 * 1024)
+    audit_writer.configure(async_codes=config['audit.async_codes'],
+                           batch_size=config['audit.batch_size'],
+                           max_queued=config['audit.max_queued'],
+                           queue_timeout=config['audit.queue_timeout'],
+                           coalesce_codes=config['audit.coalesce_codes'],
+                           coalesce_window=config['audit.coalesce_window'])
+
     # Wire up our daemon tasks
     background_tasks = []
     if config.get('sessions.on'):
         background_tasks.append(tasks.DaemonTask(tasks.remove_old_session_files, interval=60))
+    
+    if config.get('crypto.cache.enabled'):
+        stats_interval = config['crypto.cache.stats_interval_minutes'] * 60
+        background_tasks.append(tasks.DaemonTask(tasks.log_cache_stats, interval=stats_interval, wait_first=True))
+        
+    if config.get('audit.async_codes') or config.get('audit.coalesce_codes'):
+        background_tasks.append(tasks.DaemonTask(audit_writer.flush, interval=config['audit.flush_interval']))
+        stats_interval = config['audit.stats_interval_minutes'] * 60
+        background_tasks.append(tasks.DaemonTask(tasks.log_audit_stats, interval=stats_interval, wait_first=True))
+        
+    background_tasks.append(tasks.DaemonTask(tasks.create_audit_partitions, interval=3600))
+    if config.get('audit.archive.on'):
+        background_tasks.append(tasks.DaemonTask(tasks.archive_audit_log, interval=86400, wait_first=True))
         
     if config.get('backups.on'):
         backup_interval = config['backups.interval_minutes'] * 60
@@ -189,6 +231,9 @@ def configure():
         cherrypy.engine.subscribe("start", task.start, priority=99)
         cherrypy.engine.subscribe("stop", task.stop)
     
+    # Write any audit log entries that are still queued (or being coalesced) once the tasks have stopped.
+    cherrypy.engine.subscribe("stop", audit_writer.close, priority=60)
+    
     # Setup the basic/top-level webapp API
     root = tree.Root()
     
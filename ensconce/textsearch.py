@@ -0,0 +1,204 @@
+"""
+The (pluggable) implementations of the text matching for the searches.
+
+A search string is split into words, and an entity matches if all of the words are
+found in (any of) its searchable columns.  The backend is selected by the
+`search.backend` setting ('auto' keeps the default, 'like'):
+
+- 'tsvector' (PostgreSQL 9.6+, opt-in) uses the GIN-indexed `search_document` columns (that are
+  maintained by triggers; see :mod:`ensconce.model`) and ranks the results with
+  ts_rank.  The words are matched as prefixes of the words in the columns (e.g. "exam"
+  and "host1.exa" match "host1.example.com", but "ost1" does not).
+- 'like' (the default) uses case-insensitive substring matching, which works on any
+  database but needs a full scan.
+"""
+from __future__ import absolute_import
+
+import re
+
+from sqlalchemy import and_, or_, func, case, literal_column
+from sqlalchemy.sql.expression import ColumnClause
+
+from ensconce import exc
+from ensconce.model import meta
+from ensconce.autolog import log
+
+def split_terms(searchstr):
+    """
+    Splits the search string into the (unique) words to match.
+
+    :param searchstr: The search string.
+    :type searchstr: unicode
+    :rtype: list
+    """
+    terms = []
+    for term in (searchstr or '').lower().split():
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+def searchable_columns(table):
+    """
+    Gets the searchable columns of the table (from the table info; these are also the
+    columns of the full-text indexes).
+
+    :rtype: list
+    """
+    return [table.c[name] for name in table.info['searchable']]
+
+class SearchBackend(object):
+    """
+    The interface for the text matching implementations.
+    """
+    name = None
+
+    @classmethod
+    def available(cls, dialect):
+        """ Whether the implementation can be used with the database (SQLAlchemy dialect). """
+        return True
+
+    def match(self, table, searchstr):
+        """
+        Builds the clause that matches the rows whose searchable columns contain all of the
+        words of the search string.
+
+        :param table: The table (with searchable columns).
+        :param searchstr: The search string.
+        :return: The clause, or None if the search string has no words.
+        """
+        raise NotImplementedError()
+
+    def rank(self, table, searchstr):
+        """
+        Builds an expression to order the matching rows by (descending; best first).
+        """
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.name)
+
+class LikeBackend(SearchBackend):
+    """
+    Case-insensitive substring matching (works on any database).
+    """
+    name = 'like'
+
+    def match(self, table, searchstr):
+        terms = split_terms(searchstr)
+        if not terms:
+            return None
+        columns = searchable_columns(table)
+        return and_(*[or_(*[c.ilike('%' + _escape_like(t) + '%', escape='!') for c in columns]) for t in terms])
+
+    def rank(self, table, searchstr):
+        # The number of words that start a column value (so e.g. the resource name matches come first).
+        terms = split_terms(searchstr)
+        columns = searchable_columns(table)
+        return sum([case([(c.ilike(_escape_like(t) + '%', escape='!'), 1)], else_=0) for c in columns for t in terms],
+                   literal_column('0'))
+
+class TsvectorBackend(SearchBackend):
+    """
+    PostgreSQL full-text search (on the indexed :func:`document` columns).
+    """
+    name = 'tsvector'
+
+    @classmethod
+    def available(cls, dialect):
+        # (The phrase queries need 9.6.)
+        return dialect.name == 'postgresql' and dialect.server_version_info >= (9, 6)
+
+    def match(self, table, searchstr):
+        query = self._query(searchstr)
+        if query is None:
+            return None
+        return document(table).op('@@')(query)
+
+    def rank(self, table, searchstr):
+        query = self._query(searchstr)
+        if query is None:
+            return literal_column('0')
+        return func.ts_rank(document(table), query)
+
+    def _query(self, searchstr):
+        # Each word is split like the document (on the punctuation), into a phrase whose
+        # last part is matched as a prefix (e.g. "10.1.2" -> "10 <-> 1 <-> 2:*").
+        phrases = []
+        for term in split_terms(searchstr):
+            parts = _WORD_RE.findall(term)
+            if parts:
+                phrases.append('(' + ' <-> '.join(parts[:-1] + [parts[-1] + ':*']) + ')')
+        if not phrases:
+            return None
+        return func.to_tsquery(_TS_CONFIG, ' & '.join(phrases))
+
+# The text search configuration ('simple' does no stemming and has no stop words).
+_TS_CONFIG = literal_column("'simple'::regconfig")
+
+# The words (letters and digits) for the tsvector documents and queries.
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+def document(table):
+    """
+    Gets the (PostgreSQL-only, so not mapped) tsvector column of the searchable columns of the table.
+    """
+    return ColumnClause('search_document', selectable=table)
+
+def _escape_like(term):
+    return term.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+BACKENDS = (LikeBackend, TsvectorBackend)
+
+# The backend for 'auto' (the tsvector backend changes which words match, so it must be chosen explicitly).
+DEFAULT_BACKEND = LikeBackend
+
+class SearchBackendSelector(object):
+    """
+    Holds the backend that is used by the searches.
+
+    Whether the backend supports the database is checked when it is first used (after
+    the model has been initialized).
+    """
+    def __init__(self):
+        self._name = 'auto'
+        self._current = None
+
+    def configure(self, name='auto'):
+        """
+        Selects the backend to use.
+
+        :param name: The name of the backend, or 'auto' to use the default (like) backend.
+        :type name: str
+        :raise ensconce.exc.ConfigurationError: If there is no backend with that name.
+        """
+        if name != 'auto' and name not in [b.name for b in BACKENDS]:
+            raise exc.ConfigurationError("Search backend is not available: {0}".format(name))
+        self._name = name
+        self._current = None
+
+    @property
+    def current(self):
+        """
+        The selected backend.
+
+        :raise ensconce.exc.ConfigurationError: If the configured backend does not support the database.
+        """
+        if self._current is None:
+            dialect = meta.engine.dialect
+            if dialect.server_version_info is None:
+                meta.engine.connect().close() # (The version is read when the first connection is made.)
+            if self._name == 'auto':
+                backend = DEFAULT_BACKEND
+            else:
+                backend = [b for b in BACKENDS if b.name == self._name][0]
+            if not backend.available(dialect):
+                raise exc.ConfigurationError("Search backend {0} is not supported on {1}.".format(self._name, dialect.name))
+            self._current = backend()
+            log.info("Using search backend {0}.".format(self._current.name))
+        return self._current
+
+    @current.setter
+    def current(self, backend):
+        self._current = backend
+
+search_backend = SearchBackendSelector()
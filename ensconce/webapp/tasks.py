@@ -12,6 +12,11 @@ from ensconce import exc
 from ensconce.config import config
 from ensconce.export import GpgYamlExporter
 from ensconce.dao import passwords
+from ensconce.crypto.cache import decrypted_cache
+from ensconce.cya import partitions
+from ensconce.cya.store import audit_store
+from ensconce.cya.writer import audit_writer
+from ensconce.cya.archive import audit_archive
 from ensconce.autolog import log
 
 class DaemonTask(object):
@@ -77,6 +82,49 @@ def remove_old_session_files():
                 log.exception("Error removign session: {0}".format(fname))
                 pass
     
+def log_cache_stats():
+    """
+    Logs the size and hit/miss counters for the decrypted-value cache.
+    """
+    stats = decrypted_cache.stats
+    lookups = stats['hits'] + stats['misses']
+    hit_pct = (100.0 * stats['hits'] / lookups) if lookups else 0.0
+    log.info("Decrypted-value cache: size={size}, hits={hits}, misses={misses}, evictions={evictions} ({0:.1f}% hit rate)".format(hit_pct, **stats))
+    
+def log_audit_stats():
+    """
+    Logs the queue size, batch and lag counters for the asynchronous audit log writer.
+    """
+    stats = audit_writer.stats
+    log.info("Audit log writer: queued={queued}, written={written}, batches={batches}, max_batch={max_batch}, "
+             "overflows={overflows}, errors={errors}, open={open}, coalesced={coalesced}, "
+             "last_lag={last_lag:.3f}s, max_lag={max_lag:.3f}s".format(**stats))
+    
+def create_audit_partitions():
+    """
+    Creates the audit log partitions for the coming months (if the table is partitioned).
+    """
+    conn = audit_store.current.engine.connect()
+    try:
+        trans = conn.begin()
+        try:
+            partitions.create_partitions(conn)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+    
+def archive_audit_log():
+    """
+    Archives (and removes from the database) the months of the audit log that are older 
+    than the configured retention.
+    """
+    months = audit_archive.archive(config['audit.archive.retention_months'])
+    if months:
+        log.info("Archived the audit log for {0}".format(', '.join('{0:%Y-%m}'.format(m) for m in months)))
+    
 def backup_database():
     """
     Backups entire database contents to a YAML file which is encrypted using the password
@@ -1,5 +1,4 @@
 import warnings
-import math
 import re
 from functools import wraps
 from collections import namedtuple
@@ -11,17 +10,19 @@ import cherrypy
 import gnupg
 from jinja2 import Environment, PackageLoader
 from dateutil import parser as date_parser
-from wtforms import Form, TextField, PasswordField, validators, ValidationError, SelectField, IntegerField
+from wtforms import Form, TextField, PasswordField, validators, ValidationError, SelectField
 from wtforms.ext.dateutil.fields import DateField
 
 from ensconce.config import config
 from ensconce.autolog import log
 from ensconce.dao import operators
 from ensconce import exc, search, acl
+from ensconce.searchindex import vault_index
 from ensconce.auth import get_configured_providers
 from ensconce.crypto import state, util as crypto_util
 from ensconce.model import meta, Password
 from ensconce.cya import auditlog 
+from ensconce.cya.store import audit_store
 from ensconce.webapp.util import render, request_params, notify, operator_info
 from wtforms.fields.simple import HiddenField
 
@@ -43,6 +44,7 @@ def ensure_initialized(f):
             if config.get('debug', False) and config.get('debug.secret_key'):
                 secret_key_file = config.get('debug.secret_key')
                 crypto_util.load_secret_key_file(secret_key_file)
+                vault_index.build()
             else:        
                 raise exc.CryptoNotInitialized("Crypto engine has not been initialized.")
         return f(*args, **kwargs)
@@ -105,6 +107,7 @@ def clean_errors(f):
                 raise cherrypy.HTTPError("503 Service Unavailable", "Crypto engine has not been initialized.")
         finally:
             sess.close()
+            audit_store.current.remove_session()
             
     return wrapper
 
@@ -188,7 +191,7 @@ class AuditlogForm(Form):
     end = DateField('End')
     comment = TextField('Username')
     operator = TextField('Operator')
-    page = IntegerField('Page', default=1)
+    cursor = HiddenField('Cursor')
     
     
 @expose_all(insecure_methods=('login', 'startup', 'process_login', 'initialize', 'osd'),
@@ -219,6 +222,7 @@ class Root(object):
         form = PassphraseSubmitForm(request_params())
         if form.validate():
             crypto_util.configure_crypto_state(form.passphrase.data)
+            vault_index.build()
             raise cherrypy.HTTPRedirect("/")
         else:
             return render("startup.html", {'form': form})
@@ -294,24 +298,20 @@ class Root(object):
         form = AuditlogForm(request_params())
         
         page_size = 50
-        page = form.page.data
-        offset = page_size * (page - 1)
-        limit = page_size
-        
-        log.debug("Page = {0}, offset={1}, limit={2}".format(page, offset, limit))
-        results = auditlog.search(start=form.start.data,
-                                  end=form.end.data,
-                                  code=form.code.data,
-                                  operator_username=form.operator.data,
-                                  offset=offset,
-                                  limit=limit)
-        
-        if results.count < offset:
-            form.page.data = 1
-            form.page.raw_data = ['1'] # Apparently need this too!
+        try:
+            results = auditlog.search_rows(start=form.start.data,
+                                           end=form.end.data,
+                                           code=form.code.data,
+                                           operator_username=form.operator.data,
+                                           cursor=form.cursor.data or None,
+                                           limit=page_size,
+                                           estimate_count=True)
+        except ValueError:
+            log.warning("Ignoring invalid auditlog cursor: {0!r}".format(form.cursor.data))
+            raise cherrypy.HTTPRedirect("/auditlog")
         
-        total_pages = int(math.ceil( (1.0 * results.count) / page_size))  
-        return render('auditlog.html', {'entries': results.entries, 'form': form, 'total_pages': total_pages})
+        return render('auditlog.html', {'entries': results.entries, 'form': form, 'estimated_count': results.count,
+                                        'next_cursor': results.next_cursor})
     
     @acl.require_access([acl.GROUP_R, acl.RESOURCE_R, acl.PASS_R])
     def search(self, searchstr):
@@ -56,7 +56,7 @@ class Root(object):
     @acl.require_access([acl.GROUP_R, acl.RESOURCE_R, acl.PASS_R])
     def export(self, group_id=None, **kwargs):
         form = ExportForm(request_params(), group_id=group_id)
-        form.group_id.choices = [(g.id, g.name) for g in groups.list()]
+        form.group_id.choices = [(g.id, g.name) for g in groups.list_rows()]
         
         exporter_choices = [('yaml', 'YAML (GPG/PGP-encrypted)')]
         if config['export.keepass.enabled']:
@@ -103,7 +103,7 @@ class Root(object):
     @acl.require_access([acl.GROUP_R, acl.GROUP_W, acl.RESOURCE_W])
     def merge(self, group_id=None):
         form = MergeForm(from_group_id=group_id)
-        group_tuples = [(g.id, g.name) for g in groups.list()]
+        group_tuples = [(g.id, g.name) for g in groups.list_rows()]
         form.from_group_id.choices = [(0, '[From Group]')] + group_tuples
         form.to_group_id.choices = [(0, '[To Group]')] + group_tuples
         return render("group/merge.html", {'form': form})
@@ -111,7 +111,7 @@ class Root(object):
     @acl.require_access([acl.GROUP_W, acl.RESOURCE_W])
     def process_merge(self, **kwargs):
         form = MergeForm(request_params())
-        group_tuples = [(g.id, g.name) for g in groups.list()]
+        group_tuples = [(g.id, g.name) for g in groups.list_rows()]
         form.from_group_id.choices = [(0, '[From Group]')] + group_tuples
         form.to_group_id.choices = [(0, '[To Group]')] + group_tuples
         if form.validate():
@@ -139,7 +139,7 @@ class Root(object):
     
     @acl.require_access(acl.GROUP_R)
     def list(self):
-        return render('group/list.html', {'groups': groups.list()})
+        return render('group/list.html', {'groups': groups.list_rows()})
         
     @acl.require_access([acl.GROUP_R, acl.GROUP_W])
     def add(self):
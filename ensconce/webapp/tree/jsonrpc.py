@@ -3,12 +3,15 @@ import socket
 from functools import wraps
 
 import cherrypy
+from dateutil import parser as date_parser
 
 from ensconce import search, acl, exc
 from ensconce.cya import auditlog
+from ensconce.cya.writer import audit_writer
 from ensconce.auth import get_configured_providers
 from ensconce.autolog import log
 from ensconce.dao import groups, passwords, operators, resources
+from ensconce.model import serialize
 from ensconce.webapp.tree import expose_all
 from ensconce.util.cpjsonrpc import JsonRpcMethods
 from ensconce.util.pwtools import generate_password
@@ -29,7 +32,7 @@ class Root(JsonRpcMethods):
     
     @acl.require_access(acl.GROUP_R)
     def listGroups(self):
-        return [g.to_dict() for g in groups.list()]
+        return serialize.groups_to_dicts(groups.list_rows())
     
     @acl.require_access(acl.GROUP_R)    
     def getGroup(self, group_id):
@@ -258,12 +261,12 @@ class Root(JsonRpcMethods):
         :returns: A dict like {'resources': [r1,r2,...], 'groups': [g1,g2,...], 'passwords': [p1,p2,...]}
         :rtype: dict
         """
-        results = search.search(searchstr)
+        results = search.search_rows(searchstr)
         auditlog.log(auditlog.CODE_SEARCH, comment=searchstr)
         return {
-            'resources':    [r.to_dict(decrypt=False) for r in results.resource_matches],
-            'groups':       [r.to_dict() for r in results.group_matches],
-            'passwords':    [r.to_dict(decrypt=False) for r in results.password_matches],
+            'resources':    serialize.resources_to_dicts(results.resource_matches, decrypt=False),
+            'groups':       serialize.groups_to_dicts(results.group_matches),
+            'passwords':    serialize.passwords_to_dicts(results.password_matches, decrypt=False),
         }
     
     @acl.require_access([acl.GROUP_R, acl.PASS_R, acl.RESOURCE_R, acl.USER_R])
@@ -279,10 +282,86 @@ class Root(JsonRpcMethods):
         results = search.tagsearch(tags)
         auditlog.log(auditlog.CODE_SEARCH, comment=repr(tags))
         return {
-            'resources':    [r.to_dict(decrypt=False) for r in results.resource_matches],
-            'passwords':    [r.to_dict(decrypt=False) for r in results.password_matches],
+            'resources':    serialize.resources_to_dicts(results.resource_matches, decrypt=False),
+            'passwords':    serialize.passwords_to_dicts(results.password_matches, decrypt=False),
         }
     
+    @acl.require_access([acl.PASS_R, acl.RESOURCE_R])
+    def tagFacets(self, tags=None, limit=None):
+        """
+        Get the number of resources and passwords that have each tag.
+        
+        :param tags: Only count the resources/passwords that have all of these tags (optional).
+        :type tags: list
+        :param limit: The maximum number of tags to return (optional).
+        :type limit: int
+        :returns: A list of dicts like {'name': 'tagone', 'resource_count': 3, 'password_count': 2}, most used first.
+        :rtype: list
+        """
+        return [facet._asdict() for facet in search.tagfacets(tags, limit=limit)]
+    
+    @acl.require_access(acl.RESOURCE_R)
+    def listResources(self, searchstr=None, cursor=None, limit=100):
+        """
+        List the resources (ordered by name), a page at a time.
+        
+        :param searchstr: Only list the resources that match this search string (optional).
+        :type searchstr: str
+        :param cursor: The next_cursor from the previous page (to get the next page).
+        :type cursor: str
+        :param limit: The maximum number of resources to return.
+        :type limit: int
+        :returns: A dict like {'resources': [r1,r2,...], 'count': 1234, 'next_cursor': 'abc'}; count is
+                  an estimate, and next_cursor is None for the last page.
+        :rtype: dict
+        """
+        results = resources.search(searchstr, cursor=cursor, limit=limit, estimate_count=True)
+        return {
+            'resources':    serialize.resources_to_dicts(results.entries, decrypt=False),
+            'count':        results.count,
+            'next_cursor':  results.next_cursor,
+        }
+    
+    @acl.require_access(acl.AUDIT)
+    def searchAuditlog(self, start=None, end=None, code=None, operator_username=None, object_type=None,
+                       object_id=None, cursor=None, limit=100):
+        """
+        Search the audit log (newest entries first), a page at a time.
+        
+        :param start: Only entries at or after this date/time (e.g. '2013-01-31 12:00:00').
+        :type start: str
+        :param end: Only entries at or before this date/time.
+        :type end: str
+        :param code: Only entries with this code (may contain % wildcards, e.g. 'content.%').
+        :type code: str
+        :param cursor: The next_cursor from the previous page (to get the next page).
+        :type cursor: str
+        :param limit: The maximum number of entries to return.
+        :type limit: int
+        :returns: A dict like {'entries': [e1,e2,...], 'count': 1234, 'next_cursor': 'abc'}; count is
+                  an estimate, and next_cursor is None for the last page.
+        :rtype: dict
+        """
+        results = auditlog.search_rows(start=start and date_parser.parse(start), end=end and date_parser.parse(end),
+                                       code=code, operator_username=operator_username, object_type=object_type,
+                                       object_id=object_id, cursor=cursor, limit=limit, estimate_count=True)
+        return {
+            'entries':      [e.to_dict() for e in results.entries],
+            'count':        results.count,
+            'next_cursor':  results.next_cursor,
+        }
+    
+    @acl.require_access(acl.AUDIT)
+    def auditWriterStats(self):
+        """
+        Get the counters of the asynchronous audit log writer.
+        
+        :returns: A dict like {'queued': 0, 'written': 1234, 'batches': 56, 'max_batch': 80, 'overflows': 0, 
+                  'errors': 0, 'dropped': 0, 'last_lag': 0.2, 'max_lag': 0.6} (the lags are in seconds).
+        :rtype: dict
+        """
+        return audit_writer.stats
+    
     @acl.require_access(acl.PASS_W)
     def deletePassword(self, password_id):
         """
@@ -1,9 +1,10 @@
 from __future__ import absolute_import
 
 import cherrypy
+from sqlalchemy import orm
 from wtforms import Form, IntegerField, TextField, TextAreaField, validators, widgets, ValidationError
 
-from ensconce import acl
+from ensconce import acl, model
 from ensconce.util import pwtools
 from ensconce.model import Password
 from ensconce.dao import passwords, resources
@@ -83,7 +84,9 @@ class Root(object):
     def view(self, password_id):
         pw = passwords.get(password_id)
         auditlog.log(auditlog.CODE_CONTENT_VIEW, target=pw)
-        return render('password/view.html', {'password': pw})
+        history = (pw.history.options(orm.undefer('password'))
+                   .order_by(model.password_history_table.c.modified.desc()).all())
+        return render('password/view.html', {'password': pw, 'history': history})
     
     @acl.require_access([acl.PASS_R, acl.PASS_W])
     def add(self, resource_id):
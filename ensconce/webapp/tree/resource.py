@@ -95,13 +95,13 @@ class Root(object):
             group_ids = [group_id]
             
         form = ResourceAddForm(group_ids=group_ids)
-        form.group_ids.choices = [(g.id, g.label) for g in groups.list()]
+        form.group_ids.choices = [(g.id, g.label) for g in groups.list_rows()]
         return render('resource/add.html', {'form': form })
 
     @acl.require_access([acl.GROUP_R, acl.RESOURCE_R, acl.RESOURCE_W])
     def process_add(self, **kwargs):
         form = ResourceAddForm(request_params())
-        form.group_ids.choices = [(g.id, g.label) for g in groups.list()]
+        form.group_ids.choices = [(g.id, g.label) for g in groups.list_rows()]
         if form.validate():
             resource = resources.create(name=form.name.data,
                                         group_ids=form.group_ids.data,
@@ -120,13 +120,13 @@ class Root(object):
         resource = resources.get(resource_id)
         log.debug("Resource matched: {0!r}".format(resource))
         form = ResourceEditForm(request_params(), obj=resource, resource_id=resource_id, group_ids=[g.id for g in resource.groups])
-        form.group_ids.choices = [(g.id, g.label) for g in groups.list()]
+        form.group_ids.choices = [(g.id, g.label) for g in groups.list_rows()]
         return render('resource/edit.html', {'form': form})
     
     @acl.require_access([acl.GROUP_R, acl.RESOURCE_R, acl.RESOURCE_W])
     def process_edit(self, **kwargs):
         form = ResourceEditForm(request_params())
-        form.group_ids.choices = [(g.id, g.label) for g in groups.list()]
+        form.group_ids.choices = [(g.id, g.label) for g in groups.list_rows()]
         if form.validate():
             (resource, modified) = resources.modify(form.resource_id.data,
                                                     name=form.name.data,
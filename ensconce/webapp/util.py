@@ -60,7 +60,7 @@ def render(filename, data=None):
     
     if operator_info().user_id: # They are logged in, so add the quick-group-nav form.
         form = QuickGroupForm() # Do not initialize we/ request params, since that could be confusing.
-        form.group_id.choices = [(0, '[Jump to Group]')] + [(g.id, g.name) for g in groups.list()]
+        form.group_id.choices = [(0, '[Jump to Group]')] + [(g.id, g.name) for g in groups.list_rows()]
         env.globals['quickgroupform'] = form
     
     return env.get_template(filename).render(data)
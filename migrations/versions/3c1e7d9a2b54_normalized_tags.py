@@ -0,0 +1,81 @@
+"""Add normalized (indexed) tags tables, populated from the resources.tags and passwords.tags fields.
+
+Revision ID: 3c1e7d9a2b54
+Revises: e50a8f449da5
+Create Date: 2026-10-17 16:40:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c1e7d9a2b54'
+down_revision = 'e50a8f449da5'
+
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+# (A copy of the parsing in ensconce.model.tags, as of this revision.)
+_TAG_RE = re.compile(r'[\w|:-]+', re.UNICODE)
+MAX_TAG_LENGTH = 255
+
+# The number of rows to parse per SELECT.
+BATCH_SIZE = 5000
+
+def _parse_tags(text):
+    tags = []
+    for tag in _TAG_RE.findall(text.lower()):
+        tag = tag.strip(':')
+        if tag and len(tag) <= MAX_TAG_LENGTH and tag not in tags:
+            tags.append(tag)
+    return tags
+
+def _populate(bind, table, join_table, owner_column, tags_t, tag_ids):
+    """ Parses the tags field of the table rows (in id order batches) into the join table. """
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.text("SELECT id, tags FROM {0} WHERE id > :last_id AND tags IS NOT NULL "
+                                    "ORDER BY id LIMIT {1}".format(table, BATCH_SIZE)), last_id=last_id).fetchall()
+        if not rows:
+            break
+        links = []
+        for (id, text) in rows:
+            for name in _parse_tags(text):
+                if name not in tag_ids:
+                    tag_ids[name] = bind.execute(tags_t.insert().values(name=name)).inserted_primary_key[0]
+                links.append({owner_column: id, 'tag_id': tag_ids[name]})
+        if links:
+            bind.execute(join_table.insert(), links)
+        last_id = rows[-1][0]
+
+def upgrade():
+    op.create_table('tags',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('name', sa.String(255), nullable=False, unique=True))
+    op.create_table('resource_tags',
+                    sa.Column('tag_id', sa.Integer, sa.ForeignKey('tags.id', ondelete="CASCADE"), primary_key=True),
+                    sa.Column('resource_id', sa.Integer, sa.ForeignKey('resources.id', ondelete="CASCADE"), primary_key=True))
+    op.create_index('ix_resource_tags_resource_id', 'resource_tags', ['resource_id'])
+    op.create_table('password_tags',
+                    sa.Column('tag_id', sa.Integer, sa.ForeignKey('tags.id', ondelete="CASCADE"), primary_key=True),
+                    sa.Column('password_id', sa.BigInteger, sa.ForeignKey('passwords.id', ondelete="CASCADE"), primary_key=True))
+    op.create_index('ix_password_tags_password_id', 'password_tags', ['password_id'])
+    
+    # (Just enough of the tables for the inserts.)
+    metadata = sa.MetaData()
+    tags_t = sa.Table('tags', metadata,
+                      sa.Column('id', sa.Integer, primary_key=True),
+                      sa.Column('name', sa.String(255)))
+    resource_tags_t = sa.Table('resource_tags', metadata, sa.Column('tag_id', sa.Integer), sa.Column('resource_id', sa.Integer))
+    password_tags_t = sa.Table('password_tags', metadata, sa.Column('tag_id', sa.Integer), sa.Column('password_id', sa.BigInteger))
+    
+    bind = op.get_bind()
+    tag_ids = {}
+    _populate(bind, 'resources', resource_tags_t, 'resource_id', tags_t, tag_ids)
+    _populate(bind, 'passwords', password_tags_t, 'password_id', tags_t, tag_ids)
+
+
+def downgrade():
+    op.drop_table('password_tags')
+    op.drop_table('resource_tags')
+    op.drop_table('tags')
@@ -0,0 +1,29 @@
+"""Add data_keys table (envelope encryption).
+
+Existing data remains encrypted with the master key until the next key
+replacement (e.g. `paver rekey`), which will create the first data key and
+re-encrypt the database contents with it.
+
+Revision ID: 4894f6bf9829
+Revises: None
+Create Date: 2026-10-17 10:12:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4894f6bf9829'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('data_keys',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('wrapped_key', sa.Text, nullable=False),
+                    sa.Column('created', sa.DateTime(timezone=True), nullable=False))
+
+
+def downgrade():
+    op.drop_table('data_keys')
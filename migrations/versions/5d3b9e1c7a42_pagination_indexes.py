@@ -0,0 +1,24 @@
+"""Add the indexes for the keyset pagination of the resources and the audit log.
+
+Revision ID: 5d3b9e1c7a42
+Revises: b7d2e4f19a60
+Create Date: 2026-10-17 22:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d3b9e1c7a42'
+down_revision = 'b7d2e4f19a60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_resources_name_id', 'resources', ['name', 'id'])
+    op.create_index('ix_auditlog_datetime_id', 'auditlog', ['datetime', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_auditlog_datetime_id')
+    op.drop_index('ix_resources_name_id')
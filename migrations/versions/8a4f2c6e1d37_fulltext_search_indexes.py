@@ -0,0 +1,56 @@
+"""Add (PostgreSQL) full-text search columns, maintained by triggers, with GIN indexes.
+
+On the other databases the searches use the 'like' backend, which does not need these.
+
+Revision ID: 8a4f2c6e1d37
+Revises: 3c1e7d9a2b54
+Create Date: 2026-10-17 18:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a4f2c6e1d37'
+down_revision = '3c1e7d9a2b54'
+
+from alembic import op
+import sqlalchemy as sa
+
+# The searchable columns of each table (as of this revision).
+SEARCHABLE_COLUMNS = (('resources', ('name', 'addr', 'description', 'tags')),
+                      ('groups', ('name',)),
+                      ('passwords', ('username', 'description', 'tags')))
+
+# The number of ids to update per UPDATE statement.
+BATCH_SIZE = 5000
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    for (table, columns) in SEARCHABLE_COLUMNS:
+        text = " || ' ' || ".join("coalesce(NEW.{0}, '')".format(c) for c in columns)
+        op.execute("ALTER TABLE {0} ADD COLUMN search_document tsvector".format(table))
+        op.execute("CREATE OR REPLACE FUNCTION {0}_search_document() RETURNS trigger AS $$ BEGIN "
+                   "NEW.search_document := to_tsvector('simple'::regconfig, regexp_replace({1}, '[^[:alnum:]]+', ' ', 'g')); "
+                   "RETURN NEW; END $$ LANGUAGE plpgsql".format(table, text))
+        op.execute("CREATE TRIGGER {0}_search_document BEFORE INSERT OR UPDATE OF {1} ON {0} "
+                   "FOR EACH ROW EXECUTE PROCEDURE {0}_search_document()".format(table, ', '.join(columns)))
+        
+        # Fill in the column for the existing rows (the trigger does the work).
+        (min_id, max_id) = bind.execute(sa.text("SELECT min(id), max(id) FROM {0}".format(table))).fetchone()
+        if min_id is not None:
+            for lo in xrange(min_id, max_id + 1, BATCH_SIZE):
+                bind.execute(sa.text("UPDATE {0} SET {1} = {1} WHERE id >= :lo AND id < :hi".format(table, columns[0])),
+                             lo=lo, hi=lo + BATCH_SIZE)
+        
+        op.execute("CREATE INDEX ix_{0}_fulltext ON {0} USING gin (search_document)".format(table))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for (table, columns) in SEARCHABLE_COLUMNS:
+        op.drop_index('ix_{0}_fulltext'.format(table))
+        op.execute("DROP TRIGGER {0}_search_document ON {0}".format(table))
+        op.execute("DROP FUNCTION {0}_search_document()".format(table))
+        op.execute("ALTER TABLE {0} DROP COLUMN search_document".format(table))
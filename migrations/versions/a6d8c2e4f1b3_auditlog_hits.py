@@ -0,0 +1,25 @@
+"""Add the hit count and last date/time of the (coalesced) audit log entries.
+
+Revision ID: a6d8c2e4f1b3
+Revises: e9f3a7c1d2b8
+Create Date: 2026-10-18 02:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a6d8c2e4f1b3'
+down_revision = 'e9f3a7c1d2b8'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('auditlog', sa.Column('hits', sa.Integer, nullable=False, server_default='1'))
+    op.alter_column('auditlog', 'hits', server_default=None)
+    op.add_column('auditlog', sa.Column('last_datetime', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('auditlog', 'last_datetime')
+    op.drop_column('auditlog', 'hits')
@@ -0,0 +1,31 @@
+"""Add the blind index of the (encrypted) resource notes.
+
+The index is built with (a key derived from) the master key, so it cannot be populated
+here; run `paver rebuild_notes_index` after upgrading.  (Until then the searches decrypt
+all of the notes, as before.)
+
+Revision ID: b7d2e4f19a60
+Revises: 8a4f2c6e1d37
+Create Date: 2026-10-17 20:30:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4f19a60'
+down_revision = '8a4f2c6e1d37'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('resource_note_tokens',
+                    sa.Column('token', sa.BigInteger, primary_key=True, autoincrement=False),
+                    sa.Column('resource_id', sa.Integer, sa.ForeignKey('resources.id', ondelete="CASCADE"), primary_key=True))
+    op.create_index('ix_resource_note_tokens_resource_id', 'resource_note_tokens', ['resource_id'])
+    op.add_column('key_metadata', sa.Column('index_check', sa.LargeBinary, nullable=True))
+
+
+def downgrade():
+    op.drop_column('key_metadata', 'index_check')
+    op.drop_table('resource_note_tokens')
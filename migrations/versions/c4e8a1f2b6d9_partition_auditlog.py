@@ -0,0 +1,95 @@
+"""Partition the audit log by month (on PostgreSQL 11+), and consolidate its indexes.
+
+The single-column datetime, object_type and object_id indexes are replaced by the
+(datetime, id) pagination index and an (object_type, object_id) index.  On PostgreSQL the
+table is recreated as a partitioned table and the rows are copied into it, which may take
+a while for a large audit log.
+
+Revision ID: c4e8a1f2b6d9
+Revises: 5d3b9e1c7a42
+Create Date: 2026-10-17 23:20:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1f2b6d9'
+down_revision = '5d3b9e1c7a42'
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# The indexes of the audit log (as of this revision).
+INDEXES = (('ix_auditlog_code', 'code'),
+           ('ix_auditlog_operator_id', 'operator_id'),
+           ('ix_auditlog_operator_username', 'operator_username'),
+           ('ix_auditlog_datetime_id', 'datetime, id'),
+           ('ix_auditlog_object', 'object_type, object_id'))
+
+# The number of months after the current month to create the partitions for.
+MONTHS_AHEAD = 2
+
+def _partitioned(bind):
+    return (bind.dialect.name == 'postgresql' and bind.dialect.server_version_info >= (11,))
+
+def _months(first):
+    now = datetime.utcnow()
+    (year, month) = (first.year, first.month) if first is not None else (now.year, now.month)
+    last = now.year * 12 + now.month - 1 + MONTHS_AHEAD
+    while year * 12 + month - 1 <= last:
+        yield (year, month)
+        (year, month) = (year + month // 12, month % 12 + 1)
+
+def _recreate(bind, partitioned):
+    """ Recreates the auditlog table (partitioned or not), with its rows. """
+    sequence = bind.execute(sa.text("SELECT pg_get_serial_sequence('auditlog', 'id')")).scalar()
+    first = bind.execute(sa.text("SELECT min(datetime) FROM auditlog")).scalar()
+    op.execute("ALTER TABLE auditlog RENAME TO auditlog_old")
+    op.execute("ALTER SEQUENCE {0} OWNED BY NONE".format(sequence))
+    for (name,) in bind.execute(sa.text("SELECT conname FROM pg_constraint WHERE conrelid = 'auditlog_old'::regclass "
+                                        "AND contype IN ('p', 'f', 'u')")).fetchall():
+        op.execute("ALTER TABLE auditlog_old DROP CONSTRAINT {0}".format(name))
+    for (name,) in bind.execute(sa.text("SELECT indexname FROM pg_indexes WHERE tablename = 'auditlog_old'")).fetchall():
+        op.execute("DROP INDEX {0}".format(name))
+
+    if partitioned:
+        op.execute("CREATE TABLE auditlog (LIKE auditlog_old INCLUDING DEFAULTS) PARTITION BY RANGE (datetime)")
+        op.execute("ALTER TABLE auditlog ADD PRIMARY KEY (id, datetime)")
+    else:
+        op.execute("CREATE TABLE auditlog (LIKE auditlog_old INCLUDING DEFAULTS)")
+        op.execute("ALTER TABLE auditlog ADD PRIMARY KEY (id)")
+    op.execute("ALTER SEQUENCE {0} OWNED BY auditlog.id".format(sequence))
+    op.execute("ALTER TABLE auditlog ADD FOREIGN KEY (operator_id) REFERENCES operators (id) ON DELETE SET NULL")
+    for (name, columns) in INDEXES:
+        op.execute("CREATE INDEX {0} ON auditlog ({1})".format(name, columns))
+
+    if partitioned:
+        op.execute("CREATE TABLE auditlog_pdefault PARTITION OF auditlog DEFAULT")
+        for (year, month) in _months(first):
+            (next_year, next_month) = (year + month // 12, month % 12 + 1)
+            op.execute("CREATE TABLE auditlog_p{0:04d}{1:02d} PARTITION OF auditlog "
+                       "FOR VALUES FROM ('{0:04d}-{1:02d}-01 00:00:00+00') TO ('{2:04d}-{3:02d}-01 00:00:00+00')".format(
+                       year, month, next_year, next_month))
+    op.execute("INSERT INTO auditlog SELECT * FROM auditlog_old")
+    op.execute("DROP TABLE auditlog_old")
+
+def upgrade():
+    bind = op.get_bind()
+    if _partitioned(bind):
+        _recreate(bind, partitioned=True)
+    else:
+        op.drop_index('ix_auditlog_datetime')
+        op.drop_index('ix_auditlog_object_type')
+        op.drop_index('ix_auditlog_object_id')
+        op.create_index('ix_auditlog_object', 'auditlog', ['object_type', 'object_id'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    if _partitioned(bind):
+        _recreate(bind, partitioned=False)
+    op.drop_index('ix_auditlog_object')
+    op.create_index('ix_auditlog_datetime', 'auditlog', ['datetime'])
+    op.create_index('ix_auditlog_object_type', 'auditlog', ['object_type'])
+    op.create_index('ix_auditlog_object_id', 'auditlog', ['object_id'])
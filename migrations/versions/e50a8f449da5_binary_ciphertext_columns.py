@@ -0,0 +1,55 @@
+"""Store encrypted values in native binary columns (rather than hex-encoded text).
+
+On PostgreSQL and MySQL the (hex) values are decoded in place, with one conversion
+statement per table (not in batches, since alembic runs the migration in one
+transaction), so the tables are locked while they are converted.  On the other databases
+the values are left hex-encoded (the application reads both encodings) and are stored in
+binary when they are re-encrypted.
+
+Revision ID: e50a8f449da5
+Revises: fb8658a34d79
+Create Date: 2026-10-17 14:20:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e50a8f449da5'
+down_revision = 'fb8658a34d79'
+
+from alembic import op
+import sqlalchemy as sa
+
+# The (table, column, nullable) of the encrypted columns.
+COLUMNS = (('passwords', 'password', True),
+           ('password_history', 'password', True),
+           ('resources', 'notes', True),
+           ('key_metadata', 'validation', False),
+           ('data_keys', 'wrapped_key', False))
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for (table, column, nullable) in COLUMNS:
+        params = dict(table=table, column=column, null='NULL' if nullable else 'NOT NULL')
+        if dialect == 'postgresql':
+            op.execute("ALTER TABLE {table} ALTER COLUMN {column} TYPE bytea USING "
+                       "CASE WHEN {column} ~ '^([0-9a-f]{{2}})*$' THEN decode({column}, 'hex') "
+                       "ELSE convert_to({column}, 'UTF8') END".format(**params))
+        elif dialect == 'mysql':
+            op.execute("ALTER TABLE {table} MODIFY {column} LONGBLOB {null}".format(**params))
+            op.execute("UPDATE {table} SET {column} = UNHEX({column}) WHERE {column} REGEXP '^([0-9a-f]{{2}})*$'".format(**params))
+        else:
+            # The values will still be readable as hex; they will be stored in binary when re-encrypted.
+            op.alter_column(table, column, type_=sa.LargeBinary)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for (table, column, nullable) in COLUMNS:
+        params = dict(table=table, column=column, null='NULL' if nullable else 'NOT NULL')
+        if dialect == 'postgresql':
+            op.execute("ALTER TABLE {table} ALTER COLUMN {column} TYPE text USING encode({column}, 'hex')".format(**params))
+        elif dialect == 'mysql':
+            op.execute("UPDATE {table} SET {column} = LOWER(HEX({column}))".format(**params))
+            op.execute("ALTER TABLE {table} MODIFY {column} LONGTEXT {null}".format(**params))
+        else:
+            op.alter_column(table, column, type_=sa.Text)
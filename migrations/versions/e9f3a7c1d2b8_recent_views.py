@@ -0,0 +1,31 @@
+"""Add the recent_views table (the latest audit log entry of each operator, object and code).
+
+The table is only filled as new audit log entries are written; run 
+`paver backfill_recent_views` after upgrading to build it from the existing audit log.
+
+Revision ID: e9f3a7c1d2b8
+Revises: c4e8a1f2b6d9
+Create Date: 2026-10-18 01:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e9f3a7c1d2b8'
+down_revision = 'c4e8a1f2b6d9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('recent_views',
+                    sa.Column('operator_id', sa.Integer, sa.ForeignKey('operators.id', ondelete="CASCADE"), primary_key=True),
+                    sa.Column('object_type', sa.String(255), primary_key=True),
+                    sa.Column('object_id', sa.BigInteger, primary_key=True, autoincrement=False),
+                    sa.Column('code', sa.String(255), primary_key=True),
+                    sa.Column('datetime', sa.DateTime(timezone=True), nullable=False))
+    op.create_index('ix_recent_views_operator_datetime', 'recent_views', ['operator_id', 'object_type', 'datetime'])
+
+
+def downgrade():
+    op.drop_table('recent_views')
@@ -0,0 +1,25 @@
+"""Add checkpoints table (resumable batch operations).
+
+Revision ID: fb8658a34d79
+Revises: 4894f6bf9829
+Create Date: 2026-10-17 11:05:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'fb8658a34d79'
+down_revision = '4894f6bf9829'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('checkpoints',
+                    sa.Column('name', sa.String(255), primary_key=True),
+                    sa.Column('position', sa.Integer, nullable=False),
+                    sa.Column('modified', sa.DateTime(timezone=True), nullable=False))
+
+
+def downgrade():
+    op.drop_table('checkpoints')
@@ -1,5 +1,6 @@
 import glob
 import re
+import time
 import os
 import os.path
 import hashlib
@@ -26,7 +27,13 @@ from ensconce import model
 from ensconce.model import init_model, meta
 from ensconce.model import migrationsutil
 from ensconce.dao import groups as groups_dao
-from ensconce.crypto import util as crypto_util
+from ensconce.crypto import engine, CombinedMasterKey, util as crypto_util
+from ensconce.crypto.padding import padding_policy
+from ensconce.crypto.backends import backend_selector, available_backends
+from ensconce.textsearch import search_backend
+from ensconce.cya import recent
+from ensconce.cya.store import audit_store
+from ensconce.cya.archive import audit_archive
 from ensconce.export import GpgYamlImporter, GpgYamlExporter
 
 from tests.data import populate
@@ -36,6 +43,16 @@ def setup_app(options):
     """ Dependency task to initialize runtime configuration. """
     init_config()
     init_logging()
+    padding_policy.configure(config['crypto.padding_buckets'])
+    backend_selector.configure(config['crypto.backend'])
+    search_backend.configure(config['search.backend'])
+    audit_archive.configure(path=config['audit.archive.path'])
+    audit_store.configure(config['audit.store'],
+                          url=config['audit.sqlalchemy.url'],
+                          pool_size=config['audit.sqlalchemy.pool_size'],
+                          max_overflow=config['audit.sqlalchemy.max_overflow'],
+                          path=config['audit.segments.path'],
+                          segment_size=config['audit.segments.size_mb'] * 1024 * 1024)
 
 @task
 @cmdopts([('drop', 'D', 'Drop the existing database before initializing')])
@@ -260,9 +277,13 @@ def import_data(options):
 
 @task
 @needs(['setup_app', 'init_db'])
+@cmdopts([('rotate-data-key', 'r', 'Instead of changing the passphrase, create a new data key and re-encrypt the database (online).'),
+          ('resume', 'R', 'Resume an interrupted data key rotation.'),
+          ('batch-size=', 'b', 'Number of rows to re-encrypt per transaction for data key rotation (default 500).'),
+          ('processes=', 'p', 'Number of worker processes for data key rotation (default 1).')])
 def rekey(options):
     """
-    Interactive target to change the passphrase for the database.
+    Interactive target to change the passphrase for the database (or rotate the data key).
     """
     info("This is an EXTREMELY DANGEROUS activity.")
     info("Backup your database first.")
@@ -271,6 +292,23 @@ def rekey(options):
     
     crypto_util.configure_crypto_state(curr_passphrase)
     
+    rotate = getattr(options.rekey, 'rotate_data_key', False)
+    resume = getattr(options.rekey, 'resume', False)
+    if rotate or resume:
+        batch_size = int(getattr(options.rekey, 'batch_size', 500))
+        processes = int(getattr(options.rekey, 'processes', 1))
+        
+        def progress(p):
+            info("{0}: {1}/{2} rows ({3:.1f} rows/sec)".format(p.table, p.rows, p.total, p.rate))
+        
+        if resume:
+            count = crypto_util.reencrypt_data(batch_size=batch_size, progress=progress, processes=processes)
+        else:
+            count = crypto_util.rotate_data_key(batch_size=batch_size, progress=progress, processes=processes)
+        
+        info("Data key rotation completed successfully ({0} values re-encrypted).".format(count))
+        return
+    
     new_passphrase = raw_input("New passphrase: ")
     confirm = raw_input("MD5 of passphrase is %s (type \"YES\" to confirm): " % hashlib.md5(new_passphrase).hexdigest())
     if confirm != 'YES':
@@ -286,7 +324,354 @@ def rekey(options):
     
     crypto_util.replace_key(new_key=new_key, force=True)
     
-    info("Re-encryption completed successfully.")
+    info("Key replacement completed successfully.")
     
     if config.get('debug'):
         print "The new key is: %s%s" % (binascii.hexlify(new_key.encryption_key), binascii.hexlify(new_key.signing_key))
+
+
+@task
+@needs(['setup_app', 'init_db', 'setup_crypto_state'])
+@cmdopts([('batch-size=', 'b', 'Number of rows to re-encrypt per transaction (default 500).'),
+          ('processes=', 'p', 'Number of worker processes (default 1).')])
+def repad_data(options):
+    """
+    Rewrite the encrypted database contents with the configured padding policy (crypto.padding_buckets),
+    and report the bytes saved.  This can be resumed if it is interrupted.
+    """
+    batch_size = int(getattr(options.repad_data, 'batch_size', 500))
+    processes = int(getattr(options.repad_data, 'processes', 1))
+    
+    info("Padding values to buckets: {0}".format(', '.join(str(b) for b in padding_policy.buckets)))
+    
+    tables = {}
+    def progress(p):
+        tables[p.table] = p
+        info("{0}: {1}/{2} rows ({3:.1f} rows/sec)".format(p.table, p.rows, p.total, p.rate))
+    
+    count = crypto_util.reencrypt_data(batch_size=batch_size, progress=progress, processes=processes, repad=True)
+    
+    info("Rewrote {0} values.".format(count))
+    for p in sorted(tables.values()):
+        info("{0:<20} {1:>8} rows {2:>14,} -> {3:>14,} bytes (saved {4:,} bytes, {5:.1f}%)".format(
+                p.table, p.rows, p.bytes_before, p.bytes_after, p.bytes_saved,
+                (100.0 * p.bytes_saved / p.bytes_before) if p.bytes_before else 0.0))
+
+@task
+@needs(['setup_app', 'init_db', 'setup_crypto_state'])
+@cmdopts([('legacy-key-file=', 'k', 'File containing the (hex-encoded) legacy encryption key (default is the current encryption key).'),
+          ('batch-size=', 'b', 'Number of rows to convert (or verify) per batch (default 500).'),
+          ('verify', 'V', 'Only verify that all encrypted values decrypt and authenticate with the current keys.')])
+def migrate_legacy(options):
+    """
+    Convert database contents that were encrypted with the legacy engine to the current format,
+    or (with --verify) check that all values decrypt.  This can be resumed if it is interrupted.
+    """
+    from ensconce.crypto import state
+    
+    batch_size = int(getattr(options.migrate_legacy, 'batch_size', 500))
+    
+    def progress(p):
+        info("{0}: {1}/{2} rows ({3:.1f} rows/sec)".format(p.table, p.rows, p.total, p.rate))
+    
+    if getattr(options.migrate_legacy, 'verify', False):
+        failures = crypto_util.verify_encrypted_data(batch_size=batch_size, progress=progress)
+        for (table, row_id) in failures:
+            error("{0} id {1} failed to decrypt.".format(table, row_id))
+        if failures:
+            raise BuildFailure("{0} values failed to decrypt.".format(len(failures)))
+        info("All values decrypted and authenticated.")
+        return
+    
+    legacy_key_file = getattr(options.migrate_legacy, 'legacy_key_file', None)
+    if legacy_key_file:
+        with open(legacy_key_file) as fp:
+            legacy_key = binascii.unhexlify(fp.read().strip())
+    else:
+        legacy_key = state.encryption_key
+    
+    start = time.time()
+    count = crypto_util.migrate_legacy_data(legacy_key, batch_size=batch_size, progress=progress)
+    info("Converted {0} legacy values in {1:.1f}s; run with --verify to check the results.".format(count, time.time() - start))
+
+@task
+@needs(['setup_app', 'init_db', 'setup_crypto_state'])
+@cmdopts([('batch-size=', 'b', 'Number of resources to index per transaction (default 500).')])
+def rebuild_notes_index(options):
+    """
+    Rebuild the blind index of the encrypted resource notes (e.g. after upgrading the database).
+    This can be resumed if it is interrupted.
+    """
+    batch_size = int(getattr(options.rebuild_notes_index, 'batch_size', 500))
+    
+    def progress(p):
+        info("{0}: {1}/{2} rows ({3:.1f} rows/sec)".format(p.table, p.rows, p.total, p.rate))
+    
+    start = time.time()
+    count = crypto_util.rebuild_notes_index(batch_size=batch_size, progress=progress)
+    info("Indexed the notes of {0} resources in {1:.1f}s.".format(count, time.time() - start))
+
+@task
+@needs(['setup_app', 'init_db'])
+@cmdopts([('retention-months=', 'm', 'Number of months (before the current month) to keep in the database (default is audit.archive.retention_months).')])
+def archive_auditlog(options):
+    """
+    Archive the months of the audit log that are older than the retention period to 
+    (compressed) files in the audit.archive.path directory, and remove them from the database.
+    """
+    retention_months = int(getattr(options.archive_auditlog, 'retention_months', config['audit.archive.retention_months']))
+    months = audit_archive.archive(retention_months)
+    for month in months:
+        info("Archived {0:%Y-%m}".format(month))
+    if not months:
+        info("There are no audit log months to archive.")
+
+@task
+@needs(['setup_app', 'init_db'])
+def backfill_recent_views():
+    """
+    Build the table of the recently viewed objects (for the home page) from the audit log
+    (e.g. after upgrading the database).
+    """
+    start = time.time()
+    conn = audit_store.current.engine.connect()
+    try:
+        trans = conn.begin()
+        try:
+            count = recent.rebuild(conn)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+    info("Built {0} recent views in {1:.1f}s.".format(count, time.time() - start))
+
+@task
+@needs(['setup_app'])
+@cmdopts([('count=', 'n', 'Number of values to encrypt/decrypt (default 10000).')])
+def bench_crypto(options):
+    """
+    Micro-benchmark comparing the per-value and batch crypto engine functions, the
+    envelope formats for typical password and notes sizes, and the available backends.
+    
+    This uses a random key, so it does not need (or touch) the database.
+    """
+    count = int(getattr(options.bench_crypto, 'count', 10000))
+    key = CombinedMasterKey(get_random_bytes(64))
+    values = [get_random_bytes(12) for _ in range(count)]
+    
+    def timed(label, func):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        info("{0:<20} {1:>8.3f}s {2:>10.1f} usec/value".format(label, elapsed, (elapsed * 1e6) / count))
+        return result
+    
+    info("Benchmarking {0} values.".format(count))
+    ciphertexts = timed("encrypt", lambda: [engine.encrypt(v, key=key) for v in values])
+    timed("encrypt_many", lambda: list(engine.encrypt_many(values, key=key)))
+    timed("decrypt", lambda: [engine.decrypt(c, key=key) for c in ciphertexts])
+    timed("decrypt_many", lambda: list(engine.decrypt_many(ciphertexts, key=key)))
+    
+    formats = (('cbc+hmac', engine.ENVELOPE_CBC_HMAC), ('ctr+hmac', engine.ENVELOPE_CTR_HMAC))
+    for size in (12, 500, 4000):
+        info("Envelope formats, {0}-byte values:".format(size))
+        values = [get_random_bytes(size) for _ in range(count)]
+        for (label, version) in formats:
+            ciphertexts = timed("  {0} encrypt".format(label), 
+                                lambda: list(engine.encrypt_many(values, key=key, key_id=1, version=version)))
+            timed("  {0} decrypt".format(label), lambda: list(engine.decrypt_many(ciphertexts, key=key)))
+    
+    selected = backend_selector.current
+    try:
+        for backend in available_backends():
+            backend_selector.current = backend
+            info("Backend {0}, 4000-byte values ({1:.1f} usec/value AES):".format(backend.name, backend.benchmark() * 1e6))
+            ciphertexts = timed("  encrypt_many", lambda: list(engine.encrypt_many(values, key=key, key_id=1)))
+            timed("  decrypt_many", lambda: list(engine.decrypt_many(ciphertexts, key=key)))
+    finally:
+        backend_selector.current = selected
+
+@task
+@needs(['setup_app', 'init_db', 'setup_crypto_state'])
+@cmdopts([('threads=', 't', 'Number of concurrent threads (default 50).'),
+          ('count=', 'n', 'Number of values to encrypt/decrypt per thread (default 1000).')])
+def bench_key_contention(options):
+    """
+    Multi-threaded benchmark of the crypto hot path, comparing the lock-free key snapshot
+    with (an emulation of) the previous approach of reading the keys under the key lock and 
+    preparing the key (HMAC pads and AES key schedule) for every value.
+    """
+    import threading
+    from ensconce.crypto import state
+    
+    threads = int(getattr(options.bench_key_contention, 'threads', 50))
+    count = int(getattr(options.bench_key_contention, 'count', 1000))
+    
+    def locked_roundtrip(value):
+        with state.key_lock:
+            (key_id, key) = state.active_data_key or (None, state.secret_key)
+        return engine.decrypt(engine.encrypt(value, key=key, key_id=key_id), key=key)
+    
+    def snapshot_roundtrip(value):
+        return engine.decrypt(engine.encrypt(value))
+    
+    def timed(label, roundtrip):
+        values = [get_random_bytes(12) for _ in range(count)]
+        def worker():
+            for v in values:
+                roundtrip(v)
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+        info("{0:<20} {1:>8.3f}s {2:>10.1f} usec/value".format(label, elapsed, (elapsed * 1e6) / (threads * count)))
+    
+    info("Benchmarking {0} threads x {1} encrypt+decrypt round trips.".format(threads, count))
+    timed("locked", locked_roundtrip)
+    timed("snapshot", snapshot_roundtrip)
+
+@task
+@needs(['setup_app', 'init_db', 'setup_crypto_state'])
+@cmdopts([('repeat=', 'n', 'Number of times to run each query (default 20).'),
+          ('searchstr=', 's', 'The search string for the search benchmarks (default "a").')])
+def bench_rows(options):
+    """
+    Benchmark comparing the ORM list/search DAO functions with their read-only row
+    variants (latency and the number of Python objects created per result row).
+    
+    This only reads from the database, so run it against a copy of a (large) production database.
+    """
+    import gc
+    from ensconce.dao import resources as resources_dao
+    from ensconce.cya import auditlog
+    from ensconce import search
+    
+    repeat = int(getattr(options.bench_rows, 'repeat', 20))
+    searchstr = getattr(options.bench_rows, 'searchstr', 'a')
+    
+    def count_rows(result):
+        if isinstance(result, list):
+            return len(result)
+        return sum(len(r) for r in result if isinstance(r, list))
+    
+    def timed(label, func):
+        elapsed = 0
+        for _ in range(repeat):
+            meta.Session.remove() # (So that the ORM entities are not already in the identity map.)
+            start = time.time()
+            result = func()
+            elapsed += time.time() - start
+            del result
+        meta.Session.remove()
+        gc.collect()
+        before = len(gc.get_objects())
+        result = func()
+        created = len(gc.get_objects()) - before
+        rows = count_rows(result)
+        info("{0:<30} {1:>6} rows {2:>10.2f} ms/query {3:>8.1f} objects/row".format(label, rows, (elapsed * 1e3) / repeat,
+                                                                                      float(created) / max(rows, 1)))
+    
+    info("Benchmarking {0} runs of each query.".format(repeat))
+    timed("resources.list", resources_dao.list)
+    timed("resources.list_rows", resources_dao.list_rows)
+    timed("groups.list", groups_dao.list)
+    timed("groups.list_rows", groups_dao.list_rows)
+    timed("search.search", lambda: search.search(searchstr))
+    timed("search.search_rows", lambda: search.search_rows(searchstr))
+    timed("auditlog.search", lambda: auditlog.search(limit=1000).entries)
+    timed("auditlog.search_rows", lambda: auditlog.search_rows(limit=1000).entries)
+
+@task
+@needs(['setup_app', 'init_db'])
+@cmdopts([('count=', 'n', 'Number of synthetic resources to search (default 100000).'),
+          ('repeat=', 'r', 'Number of times to run each search (default 10).')])
+def bench_search(options):
+    """
+    Benchmark of the search backends, on synthetic resources.
+    
+    The resources are added (and the table statistics updated) in a transaction that 
+    is rolled back at the end, so this does not change the database.
+    """
+    from sqlalchemy import select, func
+    from ensconce import textsearch
+    
+    count = int(getattr(options.bench_search, 'count', 100000))
+    repeat = int(getattr(options.bench_search, 'repeat', 10))
+    
+    r_t = model.resources_table
+    words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+    conn = meta.engine.connect()
+    trans = conn.begin()
+    try:
+        info("Adding {0} resources.".format(count))
+        for start in xrange(0, count, 10000):
+            conn.execute(r_t.insert(), [dict(name='{0}-{1}.bench.example.com'.format(words[i % 10], i),
+                                             addr='10.{0}.{1}.{2}'.format(i // 65536, (i // 256) % 256, i % 256),
+                                             description='{0} {1} server'.format(words[(i // 10) % 10], words[(i // 100) % 10]),
+                                             tags='bench {0}'.format(words[(i // 1000) % 10]))
+                                        for i in xrange(start, min(start + 10000, count))])
+        if meta.engine.dialect.name == 'postgresql':
+            conn.execute("ANALYZE resources")
+        
+        for backend in [cls() for cls in textsearch.BACKENDS if cls.available(meta.engine.dialect)]:
+            info("Backend {0}:".format(backend.name))
+            for searchstr in ('juliet-12349', 'golf hotel', 'golf-1', '10.1.2', 'nomatch'):
+                q = select([r_t.c.id], backend.match(r_t, searchstr))
+                q = q.order_by(backend.rank(r_t, searchstr).desc(), r_t.c.name).limit(100)
+                start = time.time()
+                for _ in range(repeat):
+                    matches = conn.execute(q).fetchall()
+                elapsed = time.time() - start
+                total = conn.execute(select([func.count()], backend.match(r_t, searchstr))).scalar()
+                info("  {0:<20} {1:>7} matches {2:>10.2f} ms/search".format(repr(searchstr), total, (elapsed * 1e3) / repeat))
+    finally:
+        trans.rollback()
+        conn.close()
+
+@task
+@needs(['setup_app'])
+@cmdopts([('count=', 'n', 'Number of synthetic resources to index (default 10000).'),
+          ('repeat=', 'r', 'Number of times to run each search (default 100).')])
+def bench_index(options):
+    """
+    Benchmark of the in-memory search index (build time, memory and search times), on 
+    synthetic resources (with notes and 2 passwords each).
+    
+    The index is built directly, so this does not need (or touch) the database.
+    """
+    from ensconce.searchindex import InvertedIndex
+    from ensconce.textsearch import split_terms
+    
+    count = int(getattr(options.bench_index, 'count', 10000))
+    repeat = int(getattr(options.bench_index, 'repeat', 100))
+    
+    words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+    resources = InvertedIndex()
+    passwords = InvertedIndex()
+    start = time.time()
+    for i in xrange(count):
+        resources.put(i, ['{0}-{1}.bench.example.com'.format(words[i % 10], i),
+                          '10.{0}.{1}.{2}'.format(i // 65536, (i // 256) % 256, i % 256),
+                          '{0} {1} server'.format(words[(i // 10) % 10], words[(i // 100) % 10]),
+                          'bench {0}'.format(words[(i // 1000) % 10])],
+                      ['Rack {0}, console port {1}; vault{2}'.format(i % 40, i % 48, i)])
+        for j in (0, 1):
+            passwords.put(i * 2 + j, ['user{0}'.format(i * 2 + j), 'Account {0}'.format(words[j])])
+    elapsed = time.time() - start
+    size = resources.memory_usage() + passwords.memory_usage()
+    info("Indexed {0} resources ({1} passwords) in {2:.2f}s.".format(count, count * 2, elapsed))
+    info("Memory: {0:,} bytes ({1:,} bytes per 10k resources)".format(size, size * 10000 // max(count, 1)))
+    
+    for (searchstr, include_encrypted) in (('juliet-1239', False), ('golf hotel', False), ('golf-1', False), 
+                                          ('10.0.2', False), ('vault123', True), ('nomatch', False)):
+        terms = split_terms(searchstr)
+        start = time.time()
+        for _ in range(repeat):
+            matches = resources.search(terms, include_encrypted)
+        elapsed = time.time() - start
+        info("  {0:<20} {1:>7} matches {2:>10.1f} usec/search".format(repr(searchstr), len(matches), (elapsed * 1e6) / repeat))
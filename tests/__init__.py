@@ -3,6 +3,8 @@ import hashlib
 import unittest2
 import binascii
 
+from sqlalchemy import event
+
 from ensconce.model import meta
 from ensconce.crypto import CombinedMasterKey, state, util as crypto_util
 from ensconce.config import init_config, init_model, init_logging, config
@@ -12,6 +14,45 @@ from tests.data import populate
 TEST_INI = os.path.join(os.path.dirname(__file__), 'test.ini')
 LOGGING_INI = os.path.join(os.path.dirname(__file__), 'logging.cfg')
 
+class QueryCounter(object):
+    """
+    Context manager that records the SQL statements executed (on the model engine) within it.
+    
+    Usage::
+    
+        with QueryCounter() as queries:
+            group.to_dict(include_resources=True)
+        self.assertEquals(2, queries.count)
+    """
+    _active = []
+    
+    def __init__(self):
+        self.statements = []
+    
+    @property
+    def count(self):
+        return len(self.statements)
+    
+    @classmethod
+    def install(cls, engine):
+        """
+        Adds the listener to the engine; this must be done before any connections are made, 
+        since existing connections do not pick up new listeners.
+        """
+        event.listen(engine, 'before_cursor_execute', cls._before_cursor_execute)
+    
+    @classmethod
+    def _before_cursor_execute(cls, conn, cursor, statement, parameters, context, executemany):
+        for counter in cls._active:
+            counter.statements.append(statement)
+    
+    def __enter__(self):
+        QueryCounter._active.append(self)
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        QueryCounter._active.remove(self)
+
 class BaseTest(unittest2.TestCase):
     
     @classmethod
@@ -34,6 +75,7 @@ class BaseModelTest(BaseTest):
         """
         super(BaseModelTest, cls).setUpClass()
         init_model(config)
+        QueryCounter.install(meta.engine)
         if not  config.get('debug.secret_key'):
             raise Exception("Tests only work with debug.secret_key set to a valid key.")
 
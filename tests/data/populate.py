@@ -147,6 +147,7 @@ class TestDataPopulator(object):
             session.execute(model.resources_table.delete())
             session.execute(model.groups_table.delete())
             session.execute(model.operators_table.delete())
+            session.execute(model.tags_table.delete())
             session.commit()
         except:
             session.rollback()
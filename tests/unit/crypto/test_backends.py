@@ -0,0 +1,93 @@
+"""
+Test the crypto backends.
+"""
+import os
+
+from ensconce.crypto import engine, legacy_engine, MasterKey
+from ensconce.crypto.backends import BackendSelector, PyCryptoBackend, OpenSSLBackend, available_backends, backend_selector
+from ensconce import exc
+
+from tests import BaseTest
+
+class CryptoBackendTest(BaseTest):
+
+    def tearDown(self):
+        backend_selector.current = PyCryptoBackend()
+        super(CryptoBackendTest, self).tearDown()
+
+    def test_self_test(self):
+        """ Test that the available backends pass their known-answer tests. """
+        backends = available_backends()
+        self.assertIn('pycrypto', [b.name for b in backends])
+        for backend in backends:
+            backend.self_test()
+            self.assertTrue(backend.benchmark(sizes=[32, 4096], count=10) > 0)
+
+    def test_compatible(self):
+        """ Test that values encrypted with any backend can be decrypted with any other. """
+        backends = available_backends()
+        if len(backends) < 2:
+            self.skipTest("Only one crypto backend is available.")
+
+        key = MasterKey(os.urandom(32), os.urandom(32))
+        values = ['', 'password', os.urandom(5000)]
+        for writer in backends:
+            backend_selector.current = writer
+            ciphertexts = [engine.encrypt(v, key=key, key_id=1, version=version)
+                           for v in values for version in (engine.ENVELOPE_CBC_HMAC, engine.ENVELOPE_CTR_HMAC)]
+            ciphertexts.append(engine.encrypt('headerless', key=key))
+            legacy = legacy_engine.encrypt('legacy', key.encryption_key)
+            for reader in backends:
+                backend_selector.current = reader
+                self.assertEquals([v for v in values for _ in (1, 2)] + ['headerless'],
+                                  list(engine.decrypt_many(ciphertexts, key=key)))
+                self.assertEquals('legacy', legacy_engine.decrypt(legacy, key.encryption_key))
+
+    def test_configure(self):
+        """ Test selecting the backend. """
+        selector = BackendSelector()
+        self.assertEquals('pycrypto', selector.current.name)
+
+        selector.configure('auto')
+        self.assertIn(selector.current.name, [b.name for b in available_backends()])
+
+        selector.configure('pycrypto')
+        self.assertEquals('pycrypto', selector.current.name)
+
+        if OpenSSLBackend.available():
+            selector.configure('openssl')
+            self.assertEquals('openssl', selector.current.name)
+        else:
+            with self.assertRaises(exc.ConfigurationError):
+                selector.configure('openssl')
+
+        with self.assertRaises(exc.ConfigurationError):
+            selector.configure('no-such-backend')
+
+    def test_failed_self_test(self):
+        """ Test that a backend with a broken RNG fails its self-test. """
+        class BrokenBackend(PyCryptoBackend):
+            name = 'broken'
+            def random_bytes(self, n):
+                return '\0' * n
+
+        with self.assertRaises(exc.CryptoError):
+            BrokenBackend().self_test()
+
+    def test_padding_random_bytes(self):
+        """ Test that the (CTR) padding is read from the selected backend's RNG. """
+        requested = []
+        class RecordingBackend(PyCryptoBackend):
+            name = 'recording'
+            def random_bytes(self, n):
+                requested.append(n)
+                return '\x5a' * n
+
+        backend_selector.current = RecordingBackend()
+        key = MasterKey(os.urandom(32), os.urandom(32))
+        ciphertext = engine.encrypt('password', key=key, key_id=1, chunksize=256, version=engine.ENVELOPE_CTR_HMAC)
+        (iv_size, padlen) = requested
+        self.assertEquals(engine.AES_BLOCK_SIZE, iv_size)
+        self.assertTrue(padlen > 0)
+        self.assertEquals('\x5a' * padlen, ciphertext[-engine.SIGNATURE_SIZE - padlen:-engine.SIGNATURE_SIZE])
+        self.assertEquals('password', engine.decrypt(ciphertext, key=key))
@@ -0,0 +1,91 @@
+"""
+Test the blind index of the resource notes.
+"""
+import os
+import hashlib
+
+from sqlalchemy import select
+
+from ensconce import model, search
+from ensconce.dao import resources
+from ensconce.crypto import blindindex, util, MasterKey
+from ensconce.model import meta
+
+from tests import BaseModelTest
+
+class BlindIndexTest(BaseModelTest):
+
+    def _tokens(self, resource_id):
+        t_t = model.resource_note_tokens_table
+        return set(t for (t,) in meta.Session().execute(select([t_t.c.token], t_t.c.resource_id == resource_id)))
+
+    def _candidates(self, searchstr):
+        q = blindindex.candidates(meta.Session(), searchstr)
+        return None if q is None else set(r for (r,) in meta.Session().execute(q))
+
+    def test_grams(self):
+        self.assertEquals(set([u'enc', u'ncr', u'cry', u'ryp', u'ypt', u'pte', u'ted', u'not', u'ote', u'tes']),
+                          blindindex.grams('Encrypted  NOTES'))
+        self.assertEquals(set(), blindindex.grams(u'a be'))
+
+    def test_tokens(self):
+        """ Test that the tokens depend on the master key. """
+        key = blindindex.index_key()
+        self.assertEquals(len(blindindex.grams('encrypted notes')), len(key.tokens('encrypted notes')))
+        self.assertEquals(key.tokens('notes'), key.tokens('NOTES'))
+
+        other = blindindex.index_key(MasterKey(encryption_key=hashlib.sha256('new-encrypt').digest(),
+                                               signing_key=hashlib.sha256('new-sign').digest()))
+        self.assertFalse(key.tokens('notes') & other.tokens('notes'))
+        self.assertNotEqual(key.check, other.check)
+
+    def test_update(self):
+        """ Test that the index follows the notes. """
+        r = resources.create(name='blind.example.com', group_ids=[self.data.groups['First Group'].id], notes=u'Secret words')
+        self.assertEquals(blindindex.index_key().tokens(u'secret words'), self._tokens(r.id))
+
+        resources.modify(r.id, notes=u'Other')
+        self.assertEquals(blindindex.index_key().tokens(u'other'), self._tokens(r.id))
+
+        resources.modify(r.id, notes=None)
+        self.assertEquals(set(), self._tokens(r.id))
+
+    def test_search(self):
+        """ Test that only the candidates are decrypted once the index is built. """
+        self.assertIs(None, self._candidates('encrypted'))
+
+        with_notes = [r for r in self.data.resources.values() if r.notes_decrypted]
+        self.assertEquals(len(with_notes), util.rebuild_notes_index())
+        host1 = self.data.resources['host1.example.com']
+        self.assertEquals(set([host1.id]), self._candidates('encrypted'))
+        self.assertEquals(set([host1.id]), self._candidates('crypt NOTES'))
+        self.assertEquals(set(), self._candidates('encrypted other'))
+        self.assertIs(None, self._candidates('en'))
+
+        results = search.search(u'crypt', search_groups=False, search_passwords=False, include_encrypted=True)
+        self.assertEquals([host1], results.resource_matches)
+        results = search.search_rows(u'notes no', search_groups=False, search_passwords=False, include_encrypted=True)
+        self.assertEquals([host1.id], [r.id for r in results.resource_matches])
+
+    def test_replace_key(self):
+        """ Test that the index stays current (without a rebuild) when the master key is replaced. """
+        util.rebuild_notes_index()
+        host1 = self.data.resources['host1.example.com']
+        tokens = self._tokens(host1.id)
+
+        new_key = MasterKey(encryption_key=hashlib.sha256('new-encrypt').digest(),
+                            signing_key=hashlib.sha256('new-sign').digest())
+        rebuild_notes_index = util.rebuild_notes_index
+        util.rebuild_notes_index = lambda *args, **kwargs: self.fail("The index was rebuilt.")
+        try:
+            util.replace_key(new_key, force=True)
+        finally:
+            util.rebuild_notes_index = rebuild_notes_index
+
+        self.assertTrue(blindindex.is_current(meta.Session()))
+        self.assertEquals(tokens, self._tokens(host1.id))
+        self.assertEquals(set([host1.id]), self._candidates('encrypted'))
+
+    def tearDown(self):
+        super(BlindIndexTest, self).tearDown()
+        util.initialize_key_metadata(key=self.SECRET_KEY, salt=os.urandom(8), force_overwrite=True)
@@ -0,0 +1,73 @@
+"""
+Test the decrypted-value cache.
+"""
+from ensconce.crypto import engine, state
+from ensconce.crypto.cache import DecryptedValueCache, decrypted_cache
+
+from tests import BaseModelTest
+
+class DecryptedValueCacheTest(BaseModelTest):
+
+    def setUp(self):
+        super(DecryptedValueCacheTest, self).setUp()
+        decrypted_cache.configure(enabled=True, ttl=300, max_entries=100)
+        decrypted_cache.reset_stats()
+
+    def tearDown(self):
+        decrypted_cache.configure(enabled=False, ttl=300, max_entries=10000)
+        super(DecryptedValueCacheTest, self).tearDown()
+
+    def test_disabled(self):
+        """ Test that a disabled cache does not store anything. """
+        cache = DecryptedValueCache(enabled=False)
+        cache.put("ciphertext", "cleartext")
+        self.assertEquals((False, None), cache.get("ciphertext"))
+        self.assertEquals(0, cache.stats['size'])
+
+    def test_get_put(self):
+        """ Test basic cache hits and misses. """
+        cache = DecryptedValueCache(enabled=True)
+        self.assertEquals((False, None), cache.get("ciphertext"))
+        cache.put("ciphertext", "cleartext")
+        self.assertEquals((True, "cleartext"), cache.get("ciphertext"))
+        self.assertEquals(dict(size=1, hits=1, misses=1, evictions=0), cache.stats)
+
+    def test_ttl(self):
+        """ Test that expired entries are not returned. """
+        cache = DecryptedValueCache(enabled=True, ttl=0)
+        cache.put("ciphertext", "cleartext")
+        self.assertEquals((False, None), cache.get("ciphertext"))
+
+    def test_max_entries(self):
+        """ Test that least-recently-used entries are evicted. """
+        cache = DecryptedValueCache(enabled=True, max_entries=2)
+        cache.put("one", "1")
+        cache.put("two", "2")
+        cache.get("one") # Now "two" is the least-recently-used
+        cache.put("three", "3")
+        self.assertEquals((True, "1"), cache.get("one"))
+        self.assertEquals((False, None), cache.get("two"))
+        self.assertEquals((True, "3"), cache.get("three"))
+        self.assertEquals(1, cache.stats['evictions'])
+
+    def test_engine_decrypt(self):
+        """ Test that engine decryption uses the cache. """
+        pw = self.data.resources['host1.example.com'].passwords.order_by('username').first()
+        self.assertEquals('password0', pw.password_decrypted)
+        self.assertEquals('password0', pw.password_decrypted)
+        self.assertEquals(['password0'], list(engine.decrypt_many([pw.password])))
+        self.assertEquals(2, decrypted_cache.stats['hits'])
+
+        # Explicit keys bypass the cache.
+        (key_id, data_key) = state.active_data_key
+        engine.decrypt(pw.password, key=data_key)
+        self.assertEquals(2, decrypted_cache.stats['hits'])
+
+    def test_key_change(self):
+        """ Test that the cache is cleared when the key changes. """
+        pw = self.data.resources['host1.example.com'].passwords.order_by('username').first()
+        pw.password_decrypted
+        self.assertEquals(1, decrypted_cache.stats['size'])
+
+        state.secret_key = None
+        self.assertEquals(0, decrypted_cache.stats['size'])
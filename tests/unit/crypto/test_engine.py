@@ -1,7 +1,9 @@
 import os
+import hmac
+import hashlib
 import binascii
 
-from ensconce.crypto import engine
+from ensconce.crypto import engine, state, MasterKey
 from ensconce import exc
 
 from tests import BaseModelTest
@@ -57,4 +59,97 @@ class EngineTest(BaseModelTest):
         # And finally we'll even add a pad string, but we still expect
         # an error like "Input strings must be a multiple of 16 in length."
         with self.assertRaises(exc.CryptoAuthenticationFailed):
-            engine.decrypt(binascii.hexlify(("%02d" % 10) + data))
\ No newline at end of file
+            engine.decrypt(binascii.hexlify(("%02d" % 10) + data))
+        
+    def test_encrypt_many(self):
+        """ Test batch encryption is compatible with single-value decryption. """
+        values = ["The slow dog jumped over.", u"fa\xdf.de", os.urandom(100), "", None]
+        ciphertexts = list(engine.encrypt_many(values))
+        self.assertEquals(len(values), len(ciphertexts))
+        self.assertIs(None, ciphertexts[-1])
+        
+        for (value, ciphertext) in zip(values[:-2], ciphertexts):
+            self.assertIsInstance(ciphertext, str)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            self.assertEquals(value, engine.decrypt(ciphertext))
+        
+        # IVs must still be unique within a batch
+        self.assertEquals(2, len(set(engine.encrypt_many(["same", "same"]))))
+        
+    def test_decrypt_many(self):
+        """ Test batch decryption of single-value encrypted data. """
+        values = ["The slow dog jumped over.", "x" * 5000, os.urandom(100), None]
+        ciphertexts = [engine.encrypt(v) for v in values] + [""]
+        self.assertEquals(values + [None], list(engine.decrypt_many(ciphertexts)))
+        
+    def test_decrypt_many_garbage(self):
+        """ Test that batch decryption raises exception for unauthenticated data. """
+        ciphertexts = [engine.encrypt("good"), os.urandom(100)]
+        results = engine.decrypt_many(ciphertexts)
+        self.assertEquals("good", next(results))
+        with self.assertRaises(exc.CryptoAuthenticationFailed):
+            next(results)
+
+    def test_envelope(self):
+        """ Test that values are tagged with the data key that encrypted them. """
+        (key_id, data_key) = state.active_data_key
+        ciphertext = engine.encrypt("secret")
+        self.assertEquals(key_id, engine.parse_key_id(ciphertext))
+        self.assertEquals("secret", engine.decrypt(ciphertext))
+        self.assertEquals("secret", engine.decrypt(ciphertext, key=data_key))
+        
+        # The master key cannot decrypt the data.
+        with self.assertRaises(exc.CryptoAuthenticationFailed):
+            engine.decrypt(ciphertext, key=self.SECRET_KEY)
+        
+        # Values encrypted directly with the master key have no envelope header,
+        # but are still readable.
+        ciphertext = engine.encrypt("secret", key=self.SECRET_KEY)
+        self.assertIs(None, engine.parse_key_id(ciphertext))
+        self.assertEquals("secret", engine.decrypt(ciphertext))
+        
+        # Tampering with the key id should fail authentication.
+        ciphertext = engine.encrypt("secret", key=data_key, key_id=key_id + 1)
+        with self.assertRaises(exc.CryptoAuthenticationFailed):
+            engine.decrypt(ciphertext)
+    
+    def test_envelope_versions(self):
+        """ Test that both envelope formats can be written and read. """
+        (key_id, data_key) = state.active_data_key
+        values = ["", "pw", "x" * 5000, os.urandom(20000)]
+        for version in (engine.ENVELOPE_CBC_HMAC, engine.ENVELOPE_CTR_HMAC):
+            ciphertexts = list(engine.encrypt_many(values, version=version))
+            for (value, ciphertext) in zip(values, ciphertexts):
+                self.assertEquals((version, key_id), engine.parse_envelope(ciphertext))
+                self.assertEquals(value, engine.decrypt(ciphertext))
+            self.assertEquals(values, list(engine.decrypt_many(ciphertexts)))
+        
+        # New values use the CTR format, which is still padded.
+        ciphertext = engine.encrypt("pw")
+        self.assertEquals(engine.ENVELOPE_CTR_HMAC, engine.parse_envelope(ciphertext)[0])
+        self.assertEquals(len(ciphertext), len(engine.encrypt("password12")))
+        
+        # Any changes to the data (including the padding) should fail authentication.
+        for i in (0, 10, len(ciphertext) - 100, len(ciphertext) - 1):
+            tampered = ciphertext[:i] + chr(ord(ciphertext[i]) ^ 1) + ciphertext[i + 1:]
+            with self.assertRaises(exc.CryptoAuthenticationFailed):
+                engine.decrypt(tampered)
+    
+    def test_padding(self):
+        """ Test that values are padded to the policy bucket sizes. """
+        overhead = len(engine.encrypt("")) - 32
+        for (value, size) in (("pw", 32), ("x" * 28, 32), ("x" * 29, 128), ("x" * 500, 512), ("x" * 5000, 6144)):
+            ciphertext = engine.encrypt(value)
+            self.assertEquals(size + overhead, len(ciphertext))
+            self.assertEquals(value, engine.decrypt(ciphertext))
+        
+        # An explicit chunksize still pads to a multiple of that size.
+        self.assertEquals(2048 + overhead, len(engine.encrypt("pw", chunksize=2048)))
+    
+    def test_key_context_sign(self):
+        """ Test that the precomputed key pads produce standard HMAC-SHA256 signatures. """
+        for signing_key in (os.urandom(32), os.urandom(64), os.urandom(100)):
+            ctx = engine.KeyContext(MasterKey(os.urandom(32), signing_key))
+            for data in ('', 'data', os.urandom(1000)):
+                self.assertEquals(hmac.new(signing_key, data, hashlib.sha256).digest(), ctx.sign(data))
@@ -1,7 +1,8 @@
 import os
 import hashlib
+import threading
 
-from ensconce.crypto import MasterKey, state, util as crypto_util
+from ensconce.crypto import MasterKey, state, engine, util as crypto_util
 from ensconce import exc
 
 from tests import BaseModelTest
@@ -81,4 +82,36 @@ class EphemeralStateTest(BaseModelTest):
     def test_set_incorrect_type(self):
         """ Test setting with incorrect type. """
         with self.assertRaises(TypeError):
-            state.secret_key = hashlib.sha1()
\ No newline at end of file
+            state.secret_key = hashlib.sha1()
+    
+    def test_snapshot(self):
+        """ Test that setting the key publishes a new snapshot, re-using the prepared contexts. """
+        with self.assertRaises(exc.CryptoNotInitialized):
+            state.snapshot
+        self._set_key(hashlib.sha256('secret').digest(), hashlib.sha256('sign').digest())
+        snapshot = state.snapshot
+        self.assertEquals(state.secret_key, snapshot.master_key)
+        self.assertEquals(state.data_keys, snapshot.data_keys)
+        self.assertEquals(set([snapshot.master_key] + snapshot.data_keys.values()), set(snapshot.contexts))
+        
+        state.secret_key = snapshot.master_key
+        self.assertIsNot(snapshot, state.snapshot)
+        self.assertIs(snapshot.contexts[snapshot.master_key], state.snapshot.contexts[snapshot.master_key])
+    
+    def test_lock_free_reads(self):
+        """ Test that encrypting and decrypting do not wait for the key lock. """
+        self._set_key(hashlib.sha256('secret').digest(), hashlib.sha256('sign').digest())
+        locked = threading.Event()
+        release = threading.Event()
+        def hold_lock():
+            with state.key_lock:
+                locked.set()
+                release.wait(10)
+        t = threading.Thread(target=hold_lock)
+        t.start()
+        try:
+            locked.wait(10)
+            self.assertEquals('cleartext', engine.decrypt(engine.encrypt('cleartext')))
+        finally:
+            release.set()
+            t.join()
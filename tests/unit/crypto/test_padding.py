@@ -0,0 +1,27 @@
+"""
+Test the padding policy.
+"""
+from ensconce.crypto.padding import PaddingPolicy
+
+from tests import BaseTest
+
+class PaddingPolicyTest(BaseTest):
+    
+    def test_padded_size(self):
+        """ Test that values are padded up to the smallest bucket that fits. """
+        policy = PaddingPolicy(buckets=[512, 32, 128, 2048])
+        self.assertEquals((32, 128, 512, 2048), policy.buckets)
+        self.assertEquals(32, policy.padded_size(0))
+        self.assertEquals(32, policy.padded_size(32))
+        self.assertEquals(128, policy.padded_size(33))
+        self.assertEquals(2048, policy.padded_size(2048))
+        
+        # Larger values are padded to a multiple of the largest bucket.
+        self.assertEquals(4096, policy.padded_size(2049))
+        self.assertEquals(6144, policy.padded_size(5000))
+    
+    def test_invalid_buckets(self):
+        """ Test that bucket sizes must be (non-empty) multiples of the block size. """
+        for buckets in ([], [0], [32, 100], [-16]):
+            with self.assertRaises(ValueError):
+                PaddingPolicy(buckets=buckets)
@@ -5,7 +5,10 @@ import os
 import binascii
 import hashlib
 
-from ensconce.crypto import util, state, engine, MasterKey
+from sqlalchemy import select, func, LargeBinary
+from sqlalchemy.sql.expression import type_coerce
+
+from ensconce.crypto import util, state, engine, legacy_engine, blindindex, MasterKey
 from ensconce import exc, model
 from ensconce.model import meta
 
@@ -133,4 +136,216 @@ class KeyValidationTest(BaseModelTest):
             with self.assertRaises(exc.CryptoAuthenticationFailed):
                 engine.decrypt(pw.password, key=self.SECRET_KEY)
             
-        
\ No newline at end of file
+        
+    
+    def test_replace_key_data_keys(self):
+        """ Test that replacing the key only re-wraps the data keys. """
+        session = meta.Session()
+        ciphertexts = [pw.password for pw in session.query(model.Password).order_by(model.Password.id)]
+        (key_id, data_key) = state.active_data_key
+        
+        new_key = MasterKey(encryption_key=hashlib.sha256('new-encrypt').digest(),
+                            signing_key=hashlib.sha256('new-sign').digest())
+        util.replace_key(new_key, force=True)
+        
+        self.assertEquals(ciphertexts, [pw.password for pw in session.query(model.Password).order_by(model.Password.id)])
+        self.assertEquals((key_id, data_key), state.active_data_key)
+        self.assertEquals({key_id: data_key}, util.load_data_keys(new_key))
+        
+        with self.assertRaises(exc.CryptoAuthenticationFailed):
+            util.load_data_keys(self.SECRET_KEY)
+    
+    def test_replace_key_legacy(self):
+        """ Test replacing the key for data that is encrypted with the master key. """
+        # Set up the database as it was before there were data keys.
+        session = meta.Session()
+        self.data.depopulate()
+        session.execute(model.data_keys_table.delete())
+        state.secret_key = self.SECRET_KEY
+        self.assertIs(None, state.active_data_key)
+        self.data.populate()
+        
+        for pw in self.data.resources['host1.example.com'].passwords:
+            self.assertIs(None, engine.parse_key_id(pw.password))
+        
+        new_key = MasterKey(encryption_key=hashlib.sha256('new-encrypt').digest(),
+                            signing_key=hashlib.sha256('new-sign').digest())
+        util.replace_key(new_key, force=True)
+        
+        (key_id, data_key) = state.active_data_key
+        for (i,pw) in enumerate(self.data.resources['host1.example.com'].passwords.order_by('username')):
+            self.assertEquals(key_id, engine.parse_key_id(pw.password))
+            self.assertEquals('password{0}'.format(i), pw.password_decrypted)
+        
+        # The notes index was rebuilt with the (key derived from the) new data key.
+        self.assertTrue(blindindex.is_current(session))
+        self.assertEquals(blindindex.index_key(data_key).check, blindindex.index_key().check)
+    
+    def test_rotate_data_key(self):
+        """ Test online rotation of the data key. """
+        (old_key_id, old_data_key) = state.active_data_key
+        progress = []
+        
+        count = util.rotate_data_key(batch_size=3, progress=progress.append)
+        
+        (key_id, data_key) = state.active_data_key
+        self.assertNotEquals(old_key_id, key_id)
+        self.assertEquals(count, sum(p.rows for p in progress if p.rows == p.total))
+        self.assertEquals(10, max(p.total for p in progress if p.table == 'passwords'))
+        
+        for (i,pw) in enumerate(self.data.resources['host1.example.com'].passwords.order_by('username')):
+            self.assertEquals(key_id, engine.parse_key_id(pw.password))
+            self.assertEquals('password{0}'.format(i), pw.password_decrypted)
+        
+        self.assertEquals(0, meta.Session().query(model.Checkpoint).count())
+    
+    def test_reencrypt_resume(self):
+        """ Test resuming an interrupted re-encryption from the checkpoint. """
+        session = meta.Session()
+        (old_key_id, old_data_key) = state.active_data_key
+        (key_id, data_key) = util.create_data_key(self.SECRET_KEY)
+        
+        pw_ids = [pw.id for pw in session.query(model.Password).order_by(model.Password.id)]
+        checkpoint = model.Checkpoint()
+        checkpoint.name = 'reencrypt:{0}:passwords'.format(key_id)
+        checkpoint.position = pw_ids[4]
+        session.add(checkpoint)
+        session.commit()
+        
+        progress = []
+        util.reencrypt_data(batch_size=2, progress=progress.append)
+        
+        # The rows after the checkpoint are done first, then the rest in the final sweep.
+        passwords = [p for p in progress if p.table == 'passwords']
+        self.assertEquals(len(pw_ids) - 5, passwords[0].total)
+        self.assertEquals(len(pw_ids), passwords[-1].total)
+        
+        session.expire_all()
+        for pw in session.query(model.Password).order_by(model.Password.id):
+            self.assertEquals(key_id, engine.parse_key_id(pw.password))
+            self.assertIsNotNone(pw.password_decrypted)
+        self.assertEquals(0, session.query(model.Checkpoint).count())
+    
+    def _stale_writer(self, key_id, data_key, times):
+        """ Gets a progress callback that writes a password with an (older) data key, like a server that has not loaded the new key. """
+        session = meta.Session()
+        pw_id = session.query(func.min(model.Password.id)).scalar()
+        writes = []
+        def progress(p):
+            if p.table == 'passwords' and len(writes) < times:
+                t = model.passwords_table
+                session.execute(t.update().where(t.c.id == pw_id).values(password=engine.encrypt('stale', key=data_key, key_id=key_id)))
+                session.commit()
+                writes.append(p)
+        return progress
+    
+    def test_reencrypt_stale_writes(self):
+        """ Test that values written with an older data key behind the checkpoint are swept up. """
+        (old_key_id, old_data_key) = state.active_data_key
+        util.rotate_data_key(batch_size=3, progress=self._stale_writer(old_key_id, old_data_key, times=2))
+        
+        (key_id, data_key) = state.active_data_key
+        session = meta.Session()
+        session.expire_all()
+        for pw in session.query(model.Password):
+            self.assertEquals(key_id, engine.parse_key_id(pw.password))
+        self.assertEquals(0, session.query(model.Checkpoint).count())
+    
+    def test_reencrypt_stale_writes_continue(self):
+        """ Test that the re-encryption fails (and can be resumed) if values keep being written with an older data key. """
+        (old_key_id, old_data_key) = state.active_data_key
+        with self.assertRaises(exc.CryptoError):
+            util.rotate_data_key(batch_size=3, progress=self._stale_writer(old_key_id, old_data_key, times=100))
+        self.assertTrue(meta.Session().query(model.Checkpoint).count() > 0)
+        
+        util.reencrypt_data()
+        (key_id, data_key) = state.active_data_key
+        session = meta.Session()
+        session.expire_all()
+        for pw in session.query(model.Password):
+            self.assertEquals(key_id, engine.parse_key_id(pw.password))
+        self.assertEquals(0, session.query(model.Checkpoint).count())
+    
+    def test_data_key_reload(self):
+        """ Test that data keys created (elsewhere) after initialization can be read. """
+        (key_id, data_key) = util.create_data_key(self.SECRET_KEY)
+        ciphertext = engine.encrypt("secret", key=data_key, key_id=key_id)
+        self.assertEquals("secret", engine.decrypt(ciphertext))
+        self.assertEquals((key_id, data_key), state.active_data_key)
+    
+    def test_rotate_data_key_parallel(self):
+        """ Test data key rotation using worker processes. """
+        count = util.rotate_data_key(batch_size=4, processes=2)
+        self.assertTrue(count > 0)
+        
+        (key_id, data_key) = state.active_data_key
+        meta.Session().expire_all()
+        for (i,pw) in enumerate(self.data.resources['host1.example.com'].passwords.order_by('username')):
+            self.assertEquals(key_id, engine.parse_key_id(pw.password))
+            self.assertEquals('password{0}'.format(i), pw.password_decrypted)
+    
+    def test_repad(self):
+        """ Test rewriting values that were padded to the fixed chunk size. """
+        session = meta.Session()
+        for pw in session.query(model.Password):
+            pw.password = engine.encrypt(pw.password_decrypted, chunksize=2048)
+        session.commit()
+        
+        progress = []
+        count = util.reencrypt_data(repad=True, progress=progress.append)
+        self.assertTrue(count > 0)
+        
+        passwords = [p for p in progress if p.table == 'passwords'][-1]
+        self.assertTrue(passwords.bytes_after < passwords.bytes_before / 2)
+        
+        session.expire_all()
+        for (i,pw) in enumerate(self.data.resources['host1.example.com'].passwords.order_by('username')):
+            self.assertTrue(len(pw.password) < 128)
+            self.assertEquals('password{0}'.format(i), pw.password_decrypted)
+        
+        # Nothing is rewritten if the sizes are already right.
+        self.assertEquals(0, util.reencrypt_data(repad=True))
+    
+    def test_reencrypt_hex_values(self):
+        """ Test that values still stored hex-encoded are read and re-written in binary. """
+        session = meta.Session()
+        pw = self.data.resources['host1.example.com'].passwords.order_by('username').first()
+        t = model.passwords_table
+        stored = session.execute(t.select(t.c.id == pw.id)).fetchone()['password']
+        session.execute(t.update().where(t.c.id == pw.id).values(password=binascii.hexlify(stored)))
+        session.commit()
+        
+        session.expire_all()
+        self.assertEquals('password0', pw.password_decrypted)
+        
+        self.assertEquals(1, util.reencrypt_data())
+        raw = session.execute(select([type_coerce(t.c.password, LargeBinary)], t.c.id == pw.id)).scalar()
+        self.assertEquals(engine.ENVELOPE_HEADER.pack(engine.ENVELOPE_VERSION, state.active_data_key[0]), raw[:engine.ENVELOPE_HEADER.size])
+        session.expire_all()
+        self.assertEquals('password0', pw.password_decrypted)
+    
+    def test_migrate_legacy(self):
+        """ Test converting legacy values (stored as hex strings or binary) and verifying the result. """
+        session = meta.Session()
+        t = model.passwords_table
+        pws = self.data.resources['host1.example.com'].passwords.order_by('username').all()
+        legacy = [legacy_engine.encrypt(pw.password_decrypted, state.encryption_key) for pw in pws[:2]]
+        session.execute(t.update().where(t.c.id == pws[0].id).values(password=legacy[0]))
+        session.execute(t.update().where(t.c.id == pws[1].id).values(password=binascii.unhexlify(legacy[1])))
+        session.commit()
+        
+        self.assertEquals([('passwords', pws[0].id), ('passwords', pws[1].id)], util.verify_encrypted_data())
+        
+        progress = []
+        self.assertEquals(2, util.migrate_legacy_data(state.encryption_key, batch_size=2, progress=progress.append))
+        self.assertTrue(len([p for p in progress if p.table == 'passwords']) > 1)
+        self.assertEquals(0, session.query(model.Checkpoint).count())
+        
+        session.expire_all()
+        for (i, pw) in enumerate(pws):
+            self.assertEquals('password{0}'.format(i), pw.password_decrypted)
+        self.assertEquals([], util.verify_encrypted_data())
+        
+        # Converted values are left alone.
+        self.assertEquals(0, util.migrate_legacy_data(state.encryption_key))
+
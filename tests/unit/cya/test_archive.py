@@ -0,0 +1,159 @@
+"""
+Test the audit log partitions and archives.
+"""
+import os
+import gzip
+import uuid
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import select
+
+from ensconce import model, exc
+from ensconce.model import meta, rows
+from ensconce.cya import auditlog, partitions, archive
+from ensconce.cya.archive import audit_archive
+
+from tests import BaseTest, BaseModelTest
+
+class MonthsTest(BaseTest):
+
+    def test_month_start(self):
+        """ Test the (UTC) start of the month. """
+        self.assertEquals(datetime(2026, 10, 1, tzinfo=pytz.utc), partitions.month_start(datetime(2026, 10, 31, 23, 59)))
+        eastern = pytz.timezone('US/Eastern')
+        dt = eastern.localize(datetime(2026, 10, 31, 23, 0))
+        self.assertEquals(datetime(2026, 11, 1, tzinfo=pytz.utc), partitions.month_start(dt))
+
+    def test_add_months(self):
+        """ Test adding months, across years. """
+        start = datetime(2026, 11, 1, tzinfo=pytz.utc)
+        self.assertEquals(datetime(2027, 2, 1, tzinfo=pytz.utc), partitions.add_months(start, 3))
+        self.assertEquals(datetime(2025, 12, 1, tzinfo=pytz.utc), partitions.add_months(start, -11))
+        self.assertEquals('auditlog_p202611', partitions.partition_name(start))
+
+class ArchiveFileTest(BaseTest):
+
+    def setUp(self):
+        super(ArchiveFileTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, archive.filename(datetime(2026, 1, 1)))
+        self.rows = [rows.AuditlogRow(id=i, datetime=datetime(2026, 1, 1, 12, i, tzinfo=pytz.utc), code='content.view',
+                                      operator_id=1, operator_username='op', object_type='Resource', object_id=i,
+                                      object_label=u'host{0}'.format(i), attributes_modified=None, comment=None,
+                                      hits=i + 1, last_datetime=datetime(2026, 1, 1, 12, i, 30, tzinfo=pytz.utc) if i else None)
+                     for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ArchiveFileTest, self).tearDown()
+
+    def test_round_trip(self):
+        """ Test that the rows read back from an archive match the rows written. """
+        self.assertEquals('auditlog-2026-01.json.gz', os.path.basename(self.path))
+        self.assertEquals(5, archive.write(self.path, datetime(2026, 1, 1), [self.rows[:3], self.rows[3:]]))
+        self.assertEquals(self.rows, list(archive.read(self.path)))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_checksum(self):
+        """ Test that a modified archive is detected. """
+        archive.write(self.path, datetime(2026, 1, 1), [self.rows])
+        with gzip.open(self.path, 'rb') as fp:
+            data = fp.read()
+        with gzip.open(self.path, 'wb') as fp:
+            fp.write(data.replace('host3', 'host9'))
+        with self.assertRaises(exc.DataIntegrityError):
+            list(archive.read(self.path))
+
+class AuditArchiveTest(BaseModelTest):
+
+    def setUp(self):
+        super(AuditArchiveTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.object_type = 'ArchiveTest-{0}'.format(uuid.uuid4())
+        self.current = partitions.month_start(datetime.now(pytz.utc))
+
+    def tearDown(self):
+        audit_archive.configure()
+        shutil.rmtree(self.tmpdir)
+        super(AuditArchiveTest, self).tearDown()
+
+    def _insert(self, *dates):
+        values = [dict(datetime=dt, code=auditlog.CODE_CONTENT_VIEW, object_type=self.object_type, object_id=i)
+                  for (i, dt) in enumerate(dates)]
+        meta.engine.execute(model.auditlog_table.insert(), values)
+        a_t = model.auditlog_table
+        return [r.id for r in meta.engine.execute(select([a_t.c.id], a_t.c.object_type == self.object_type)
+                                                  .order_by(a_t.c.datetime.desc()))]
+
+    def test_partitioned(self):
+        """ Test that the audit log is partitioned (on PostgreSQL), with partitions ahead of time. """
+        conn = meta.engine.connect()
+        try:
+            if not partitions.supported(conn):
+                self.skipTest("Database does not support partitioning.")
+            self.assertTrue(partitions.is_partitioned(conn))
+            months = partitions.partitions(conn)
+            self.assertIn(self.current, months)
+            self.assertIn(partitions.add_months(self.current, partitions.MONTHS_AHEAD), months)
+            self.assertEquals([], partitions.create_partitions(conn))
+        finally:
+            conn.close()
+
+    def test_archive(self):
+        """ Test that the old months are archived, removed from the database and still searchable. """
+        old = partitions.add_months(self.current, -6)
+        ids = self._insert(old + timedelta(days=1), old + timedelta(days=2),
+                           partitions.add_months(old, 1) + timedelta(hours=1), datetime.now(pytz.utc))
+
+        audit_archive.configure(path=os.path.join(self.tmpdir, 'archive'))
+        archived = audit_archive.archive(retention_months=3)
+        self.assertIn(old, archived)
+        self.assertIn(partitions.add_months(old, 1), archived)
+        self.assertNotIn(self.current, archived)
+        self.assertEquals(archived, audit_archive.months())
+
+        # Only the live entry is left in the database ...
+        audit_archive.configure()
+        results = auditlog.search_rows(start=old, object_type=self.object_type)
+        self.assertEquals(ids[:1], [r.id for r in results.entries])
+
+        # ... but the archived entries are found by the searches that start before the live months.
+        audit_archive.configure(path=os.path.join(self.tmpdir, 'archive'))
+        self.assertEquals(1, auditlog.search_rows(object_type=self.object_type).count)
+        for search in (auditlog.search, auditlog.search_rows):
+            results = search(start=old.date(), object_type=self.object_type)
+            self.assertEquals(4, results.count)
+            self.assertEquals(ids, [e.id for e in results.entries])
+            self.assertEquals([3, 2, 1, 0], [e.object_id for e in results.entries])
+
+            first = search(start=old.date(), object_type=self.object_type, limit=2)
+            second = search(start=old.date(), object_type=self.object_type, limit=2, cursor=first.next_cursor)
+            self.assertIs(None, second.next_cursor)
+            self.assertEquals([e.id for e in results.entries], [e.id for e in first.entries + second.entries])
+
+        results = auditlog.search_rows(start=old, end=old + timedelta(days=1, hours=1), object_type=self.object_type)
+        self.assertEquals([0], [r.object_id for r in results.entries])
+
+    def test_archive_late_rows(self):
+        """ Test that the rows written for a month after it was archived are merged into its archive. """
+        old = partitions.add_months(self.current, -6)
+        first = self._insert(old + timedelta(days=1), old + timedelta(days=3))
+        audit_archive.configure(path=os.path.join(self.tmpdir, 'archive'))
+        self.assertIn(old, audit_archive.archive(retention_months=3))
+
+        meta.engine.execute(model.auditlog_table.insert(), [dict(datetime=old + timedelta(days=2), code=auditlog.CODE_CONTENT_VIEW,
+                                                                 object_type=self.object_type, object_id=2)])
+        self.assertIn(old, audit_archive.archive(retention_months=3))
+
+        results = auditlog.search_rows(start=old.date(), end=partitions.add_months(old, 1), object_type=self.object_type)
+        self.assertEquals([1, 2, 0], [r.object_id for r in results.entries])
+        self.assertEquals(set(first), set(r.id for r in results.entries) & set(first))
+        self.assertEquals(3, len(list(archive.read(os.path.join(self.tmpdir, 'archive', archive.filename(old))))))
+
+    def test_archive_not_configured(self):
+        """ Test that archiving requires a path. """
+        with self.assertRaises(exc.ConfigurationError):
+            audit_archive.archive(retention_months=3)
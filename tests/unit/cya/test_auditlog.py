@@ -0,0 +1,151 @@
+"""
+Test the audit log searches.
+"""
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import select, func
+
+from ensconce import model
+from ensconce.model import meta
+from ensconce.cya import auditlog
+from ensconce.cya.writer import audit_writer
+from ensconce.webapp.util import operator_info
+
+from tests import BaseModelTest
+
+class AuditlogTest(BaseModelTest):
+    
+    def test_search_rows(self):
+        """ Test that the read-only rows match the entities. """
+        resource = self.data.resources['host1.example.com']
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource)
+        auditlog.log(auditlog.CODE_CONTENT_MOD, target=resource, attributes_modified=['name', 'addr'])
+        auditlog.log(auditlog.CODE_SEARCH, comment='host')
+        
+        for kwargs in (dict(), dict(code='content.%'), dict(object_type='Resource', object_id=resource.id),
+                       dict(limit=2), dict(offset=1, limit=1)):
+            results = auditlog.search(**kwargs)
+            rows = auditlog.search_rows(**kwargs)
+            self.assertEquals(results.count, rows.count)
+            self.assertEquals([e.to_dict() for e in results.entries], [r.to_dict() for r in rows.entries])
+        
+        rows = auditlog.search_rows(code=auditlog.CODE_CONTENT_MOD)
+        self.assertEquals(1, rows.count)
+        self.assertEquals(['name', 'addr'], rows.entries[0].attributes_modified)
+        self.assertEquals(resource.label, rows.entries[0].object_label)
+    
+    def test_search_cursor(self):
+        """ Test the keyset pagination (newest first, including entries with the same datetime). """
+        resource = self.data.resources['host1.example.com']
+        for _ in range(5):
+            auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource)
+        
+        criteria = dict(code=auditlog.CODE_CONTENT_VIEW, object_type='Resource', object_id=resource.id)
+        expected = auditlog.search_rows(**criteria).entries
+        self.assertEquals(5, len(expected))
+        self.assertEquals(sorted(expected, key=lambda r: (r.datetime, r.id), reverse=True), expected)
+        
+        for search in (auditlog.search, auditlog.search_rows):
+            first = search(limit=3, **criteria)
+            self.assertEquals(5, first.count)
+            second = search(limit=3, cursor=first.next_cursor, skip_count=True, **criteria)
+            self.assertIs(None, second.next_cursor)
+            self.assertEquals([r.id for r in expected], [e.id for e in first.entries + second.entries])
+    
+    def test_async_writer(self):
+        """ Test that the asynchronous codes are queued and written in batches. """
+        resource = self.data.resources['host1.example.com']
+        audit_writer.configure(async_codes=[auditlog.CODE_CONTENT_VIEW], batch_size=2, max_queued=3, queue_timeout=0)
+        audit_writer.reset_stats()
+        try:
+            comment = 'async-{0}'.format(uuid.uuid4())
+            for _ in range(4):
+                auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource, comment=comment)
+            auditlog.log(auditlog.CODE_CONTENT_MOD, target=resource, comment=comment)
+            
+            # The 4th view did not fit in the queue, so it was written synchronously (like the modification).
+            self.assertEquals(3, audit_writer.stats['queued'])
+            self.assertEquals(1, audit_writer.stats['overflows'])
+            self.assertEquals(2, self._count(comment))
+            
+            self.assertEquals(3, audit_writer.flush())
+            stats = audit_writer.stats
+            self.assertEquals((0, 3, 2, 2), (stats['queued'], stats['written'], stats['batches'], stats['max_batch']))
+            self.assertTrue(stats['max_lag'] >= stats['last_lag'] > 0)
+            self.assertEquals(5, self._count(comment))
+            
+            rows = auditlog.search_rows(code=auditlog.CODE_CONTENT_VIEW, object_id=resource.id).entries
+            self.assertEquals([(comment, resource.label, operator_info().username)] * 4,
+                              [(r.comment, r.object_label, r.operator_username) for r in rows])
+        finally:
+            audit_writer.configure()
+    
+    def test_async_writer_bad_entry(self):
+        """ Test that an entry that cannot be written does not hold up the others. """
+        resource = self.data.resources['host1.example.com']
+        audit_writer.configure(async_codes=[auditlog.CODE_CONTENT_VIEW], batch_size=10)
+        audit_writer.reset_stats()
+        try:
+            comment = 'bad-{0}'.format(uuid.uuid4())
+            values = dict(datetime=datetime.now(), code=auditlog.CODE_CONTENT_VIEW, comment=comment,
+                          operator_id=None, operator_username=None, object_type='Resource', object_id=resource.id,
+                          object_label=resource.label, attributes_modified=None, hits=1, last_datetime=None)
+            # (An operator that does not exist, e.g. that was deleted while the entry was queued.)
+            self.assertTrue(audit_writer.put(dict(values, operator_id=-1)))
+            
+            # If none of the entries can be written, they are retried.
+            self.assertEquals(0, audit_writer.flush())
+            self.assertEquals((1, 1, 0), (audit_writer.stats['queued'], audit_writer.stats['errors'], audit_writer.stats['dropped']))
+            
+            for _ in range(2):
+                auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource, comment=comment)
+            self.assertEquals(2, audit_writer.flush())
+            stats = audit_writer.stats
+            self.assertEquals((0, 2, 2, 1), (stats['queued'], stats['written'], stats['errors'], stats['dropped']))
+            self.assertEquals(2, self._count(comment))
+        finally:
+            audit_writer.configure()
+    
+    def test_coalesce(self):
+        """ Test that the repeated entries for an object are coalesced into one entry (per window). """
+        (r1, r2) = (self.data.resources['host1.example.com'], self.data.resources['host2.example'])
+        audit_writer.configure(coalesce_codes=[auditlog.CODE_CONTENT_VIEW], coalesce_window=60)
+        audit_writer.reset_stats()
+        try:
+            comment = 'coalesce-{0}'.format(uuid.uuid4())
+            for _ in range(3):
+                auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r1, comment=comment)
+            auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r2, comment=comment)
+            auditlog.log(auditlog.CODE_CONTENT_MOD, target=r1, comment=comment)
+            
+            # The views are written when their window closes (or the writer is closed).
+            self.assertEquals((2, 2), (audit_writer.stats['open'], audit_writer.stats['coalesced']))
+            self.assertEquals(0, audit_writer.flush())
+            self.assertEquals(1, self._count(comment))
+            self.assertEquals(2, audit_writer.close())
+            self.assertEquals(3, self._count(comment))
+            
+            for search in (auditlog.search, auditlog.search_rows):
+                entries = search(code=auditlog.CODE_CONTENT_VIEW, object_type='Resource', object_id=r1.id).entries
+                self.assertEquals([3], [e.hits for e in entries])
+                self.assertTrue(entries[0].last_datetime > entries[0].datetime)
+                self.assertEquals(3, entries[0].to_dict()['hits'])
+            entries = auditlog.search_rows(code=auditlog.CODE_CONTENT_MOD, object_id=r1.id).entries
+            self.assertEquals([(1, None)], [(e.hits, e.last_datetime) for e in entries])
+            
+            # After the window closes, the next entry starts a new one.
+            audit_writer.configure(coalesce_codes=[auditlog.CODE_CONTENT_VIEW], coalesce_window=0.05)
+            auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r2, comment=comment)
+            time.sleep(0.1)
+            auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r2, comment=comment)
+            self.assertEquals((1, 1), (audit_writer.stats['queued'], audit_writer.stats['open']))
+            self.assertEquals(2, audit_writer.close())
+            self.assertEquals(5, self._count(comment))
+        finally:
+            audit_writer.configure()
+    
+    def _count(self, comment):
+        a_t = model.auditlog_table
+        return meta.Session().execute(select([func.count()], a_t.c.comment == comment)).scalar()
@@ -0,0 +1,69 @@
+"""
+Test the (incrementally maintained) recent views.
+"""
+import cherrypy
+
+from ensconce import model
+from ensconce.model import meta
+from ensconce.cya import auditlog, recent
+from ensconce.cya.writer import audit_writer
+
+from tests import BaseModelTest
+
+class RecentViewsTest(BaseModelTest):
+
+    def setUp(self):
+        super(RecentViewsTest, self).setUp()
+        self.operator = self.data.operators['op1']
+        cherrypy.session = dict(user_id=self.operator.id, username=self.operator.username)
+
+    def tearDown(self):
+        del cherrypy.session
+        audit_writer.configure()
+        super(RecentViewsTest, self).tearDown()
+
+    def _recent(self, **kwargs):
+        results = auditlog.recent_content_views(operator_id=self.operator.id, object_type='Resource', **kwargs)
+        return [(r.lookup_entity(), r.code) for r in results.entries]
+
+    def test_recent_content_views(self):
+        """ Test that the latest entry of each object and code is listed, newest first. """
+        (r1, r2) = (self.data.resources['host1.example.com'], self.data.resources['host2.example'])
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r1)
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r2)
+        auditlog.log(auditlog.CODE_CONTENT_MOD, target=r2)
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r1)
+        auditlog.log(auditlog.CODE_SEARCH, comment='host')
+
+        self.assertEquals([(r1, auditlog.CODE_CONTENT_VIEW), (r2, auditlog.CODE_CONTENT_MOD), (r2, auditlog.CODE_CONTENT_VIEW)],
+                          self._recent())
+        self.assertEquals([r1, r2], [e for (e, _) in self._recent(code=auditlog.CODE_CONTENT_VIEW)])
+        self.assertEquals([r1], [e for (e, _) in self._recent(code=auditlog.CODE_CONTENT_VIEW, limit=1)])
+        self.assertEquals([(r2, auditlog.CODE_CONTENT_MOD), (r2, auditlog.CODE_CONTENT_VIEW)], self._recent(object_id=r2.id))
+        self.assertEquals(3, auditlog.recent_content_views(operator_id=self.operator.id, object_type='Resource').count)
+        self.assertEquals([], auditlog.recent_content_views(operator_id=self.data.operators['op2'].id, object_type='Resource').entries)
+
+    def test_async(self):
+        """ Test that the asynchronous entries update the recent views when they are written. """
+        resource = self.data.resources['host1.example.com']
+        audit_writer.configure(async_codes=[auditlog.CODE_CONTENT_VIEW])
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource)
+        self.assertEquals([], self._recent())
+
+        audit_writer.flush()
+        self.assertEquals([(resource, auditlog.CODE_CONTENT_VIEW)], self._recent())
+
+    def test_rebuild(self):
+        """ Test that the recent views can be rebuilt from the audit log. """
+        (r1, r2) = (self.data.resources['host1.example.com'], self.data.resources['host2.example'])
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r2)
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r1)
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=r2)
+        expected = self._recent()
+        self.assertEquals([r2, r1], [e for (e, _) in expected])
+
+        session = meta.Session()
+        session.execute(model.recent_views_table.delete())
+        self.assertEquals([], self._recent())
+        recent.rebuild(session.connection())
+        self.assertEquals(expected, self._recent())
@@ -0,0 +1,163 @@
+"""
+Test the (dedicated) audit log stores.
+"""
+import os
+import uuid
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+
+from dateutil.tz import tzlocal
+from sqlalchemy import select, func
+
+from ensconce import model
+from ensconce.model import meta
+from ensconce.cya import auditlog
+from ensconce.cya import store
+from ensconce.cya.store import audit_store, read_segment
+
+from tests import BaseModelTest
+
+class AuditStoreTest(BaseModelTest):
+
+    def setUp(self):
+        super(AuditStoreTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.comment = 'store-{0}'.format(uuid.uuid4())
+
+    def tearDown(self):
+        audit_store.configure()
+        shutil.rmtree(self.tmpdir)
+        # (The entries are committed outside of the test transaction.)
+        meta.engine.execute(model.auditlog_table.delete().where(model.auditlog_table.c.comment == self.comment))
+        super(AuditStoreTest, self).tearDown()
+
+    def _count(self):
+        a_t = model.auditlog_table
+        return meta.engine.execute(select([func.count()], a_t.c.comment == self.comment)).scalar()
+
+    def test_engine(self):
+        """ Test that the entries are written (and committed) outside of the request transaction. """
+        resource = self.data.resources['host1.example.com']
+        audit_store.configure('engine')
+        auditlog.log(auditlog.CODE_CONTENT_MOD, target=resource, comment=self.comment)
+        meta.Session().rollback()
+        self.assertEquals(1, self._count())
+
+        results = auditlog.search_rows(code=auditlog.CODE_CONTENT_MOD, object_id=resource.id)
+        self.assertEquals([self.comment], [r.comment for r in results.entries])
+
+        # The reading session is removed at the end of the request, returning its connection.
+        audit_store.current.remove_session()
+        self.assertEquals(0, audit_store.current.engine.pool.checkedout())
+
+    def test_segments(self):
+        """ Test that the entries are appended to the segment files and found by the searches. """
+        resource = self.data.resources['host1.example.com']
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource, comment=self.comment)
+        meta.Session().commit()
+
+        path = os.path.join(self.tmpdir, 'segments')
+        audit_store.configure('segments', path=path, segment_size=512)
+        for _ in range(5):
+            auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource, comment=self.comment)
+        self.assertEquals(1, self._count())
+
+        segments = audit_store.current.segments()
+        self.assertTrue(len(segments) > 1)
+
+        criteria = dict(code=auditlog.CODE_CONTENT_VIEW, object_type='Resource', object_id=resource.id)
+        results = auditlog.search_rows(**criteria)
+        self.assertEquals(6, results.count)
+        ids = [r.id for r in results.entries]
+        self.assertEquals(sorted(ids, reverse=True), ids)
+        self.assertEquals(range(ids[-1], ids[-1] + 6), sorted(ids))
+        self.assertEquals(resource.label, results.entries[0].object_label)
+
+        first = auditlog.search(limit=4, **criteria)
+        second = auditlog.search(limit=4, cursor=first.next_cursor, **criteria)
+        self.assertEquals(ids, [e.id for e in first.entries + second.entries])
+
+        # An interrupted write is skipped, and the next entries go to a new segment.
+        with open(os.path.join(path, segments[-1][1]), 'ab') as fp:
+            fp.write('{"id": 12')
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource, comment=self.comment)
+        self.assertEquals(len(segments) + 1, len(audit_store.current.segments()))
+        self.assertEquals(7, auditlog.search_rows(**criteria).count)
+
+        # The ids were reserved from the sequence, so they are not used again by the database stores.
+        segment_ids = [r.id for (_, name) in audit_store.current.segments() for r in read_segment(os.path.join(path, name))]
+        audit_store.configure()
+        auditlog.log(auditlog.CODE_CONTENT_VIEW, target=resource, comment=self.comment)
+        meta.Session().commit()
+        a_t = model.auditlog_table
+        self.assertTrue(meta.engine.execute(select([func.max(a_t.c.id)], a_t.c.comment == self.comment)).scalar() > max(segment_ids))
+
+    def test_segment_indexes(self):
+        """ Test that the searches only read the segments in the range (and after the cursor). """
+        path = os.path.join(self.tmpdir, 'segments')
+        audit_store.configure('segments', path=path, segment_size=1)
+        entry = dict(code=auditlog.CODE_SEARCH, comment=self.comment, operator_id=None, operator_username=None,
+                     object_type=None, object_id=None, object_label=None, attributes_modified=[],
+                     hits=1, last_datetime=None)
+        for i in range(10):
+            audit_store.current.write([dict(entry, datetime=datetime(2026, 1, 1, 12, i))])
+        self.assertEquals(10, len(audit_store.current.segments()))
+
+        reads = []
+        def counting_read(path):
+            reads.append(path)
+            return read_segment(path)
+        store.read_segment = counting_read
+        try:
+            first = auditlog.search_rows(code=auditlog.CODE_SEARCH, limit=3, skip_count=True)
+            self.assertEquals(4, len(reads))
+            self.assertEquals([datetime(2026, 1, 1, 12, i) for i in (9, 8, 7)],
+                              [e.datetime.astimezone(tzlocal()).replace(tzinfo=None) for e in first.entries])
+
+            del reads[:]
+            second = auditlog.search_rows(code=auditlog.CODE_SEARCH, limit=3, cursor=first.next_cursor, skip_count=True)
+            self.assertEquals(4, len(reads))
+            self.assertEquals(first.entries[-1].id - 1, second.entries[0].id)
+
+            # The estimate only reads the indexes.
+            del reads[:]
+            code_matches = lambda code: code == auditlog.CODE_SEARCH
+            self.assertEquals(10, audit_store.current.count(code_matches=code_matches, estimate=True))
+            self.assertEquals(0, len(reads))
+            self.assertEquals(10, audit_store.current.count(matches=lambda r: r.comment == self.comment))
+        finally:
+            store.read_segment = read_segment
+
+        # A missing index is rebuilt from its segment.
+        name = audit_store.current.segments()[0][1]
+        os.remove(os.path.join(path, name.replace('.log', '.idx')))
+        index = store.segment_index(os.path.join(path, name))
+        self.assertEquals((1, auditlog.CODE_SEARCH), (index['count'], index['codes'].keys()[0]))
+
+    def test_group_commit(self):
+        """ Test that the concurrent writes are appended in batches. """
+        audit_store.configure('segments', path=os.path.join(self.tmpdir, 'segments'))
+        appends = []
+        append = audit_store.current._append
+        def counting_append(entries):
+            appends.append(len(entries))
+            append(entries)
+        audit_store.current._append = counting_append
+
+        entry = dict(code=auditlog.CODE_SEARCH, comment=self.comment, operator_id=None, operator_username=None,
+                     object_type=None, object_id=None, object_label=None, attributes_modified=[],
+                     hits=1, last_datetime=None)
+        def write():
+            for _ in range(10):
+                audit_store.current.write([dict(entry, datetime=datetime.now())])
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEquals(80, sum(appends))
+        results = auditlog.search_rows(code=auditlog.CODE_SEARCH, limit=100)
+        self.assertEquals(80, len(set(r.id for r in results.entries if r.comment == self.comment)))
@@ -35,4 +35,13 @@ class TestGroupsDao(BaseModelTest):
         print sorted(gnames, key=unicode.lower)
         self.assertEquals(sorted(gnames, key=unicode.lower), gnames)
         
-        
\ No newline at end of file
+        
+    
+    def test_list_rows(self):
+        rows = groups.list_rows()
+        self.assertEquals([(g.id, g.name) for g in groups.list()], [(r.id, r.label) for r in rows])
+        for r in rows:
+            self.assertEquals(self.data.groups[r.name].resources.count(), r.resource_count)
+        self.assertTrue(any(r.resource_count == 0 for r in rows))
+        with self.assertRaises(AttributeError):
+            rows[0].name = 'Renamed Group'
@@ -1,6 +1,6 @@
 import random
 
-from ensconce.dao import groups
+from ensconce.dao import groups, resources
 from ensconce import exc
 
 from tests import BaseModelTest
@@ -35,4 +35,32 @@ class TestGroupsDao(BaseModelTest):
         print sorted(gnames, key=unicode.lower)
         self.assertEquals(sorted(gnames, key=unicode.lower), gnames)
         
-        
\ No newline at end of file
+        
+    
+    def test_list_rows(self):
+        rows = resources.list_rows()
+        self.assertEquals([(r.id, r.name, r.addr, r.description, r.tags) for r in resources.list()],
+                          [tuple(r) for r in rows])
+    
+    def test_search_cursor(self):
+        """ Test that the cursor pages match the offset pages. """
+        expected = [r.id for r in resources.search().entries]
+        self.assertTrue(len(expected) > 2)
+        
+        cursor = None
+        pages = []
+        while True:
+            results = resources.search(limit=2, cursor=cursor, skip_count=(cursor is not None))
+            pages.append([r.id for r in results.entries])
+            if results.next_cursor is None:
+                break
+            cursor = results.next_cursor
+        self.assertEquals(expected, sum(pages, []))
+        self.assertEquals([r.id for r in resources.search(limit=2, offset=2).entries], pages[1])
+        self.assertEquals(len(expected), resources.search(limit=2).count)
+        self.assertTrue(resources.search(limit=2, estimate_count=True).count >= 0)
+        
+        with self.assertRaises(ValueError):
+            resources.search(limit=2, cursor='not-a-cursor')
+        with self.assertRaises(ValueError):
+            resources.search(limit=2, cursor=cursor, order_by='addr')
@@ -0,0 +1,140 @@
+"""
+Test the bulk serialization of the model entities.
+"""
+from sqlalchemy import orm
+
+from ensconce import model
+from ensconce.model import meta, serialize
+
+from tests import BaseModelTest, QueryCounter
+
+class SerializeTest(BaseModelTest):
+    
+    def _add_history(self, pw, count):
+        session = meta.Session()
+        for i in range(count):
+            h = model.PasswordHistory()
+            h.password_decrypted = 'old{0}'.format(i)
+            pw.history.append(h)
+        session.flush()
+        session.expire_all()
+    
+    def test_resource_to_dict(self):
+        """ Test the shape of resource dicts. """
+        r = self.data.resources['host1.example.com']
+        d = r.to_dict(include_passwords=True, decrypt_passwords=True)
+        self.assertEquals(sorted(['id', 'group_ids', 'name', 'addr', 'description', 'tags', 'notes', 'passwords']), sorted(d))
+        self.assertEquals(sorted([self.data.groups['First Group'].id, self.data.groups['Second Group'].id]), sorted(d['group_ids']))
+        self.assertEquals(u'Encrypted notes', d['notes'])
+        self.assertEquals(['user{0}'.format(i) for i in range(5)], [p['username'] for p in d['passwords']])
+        self.assertEquals(['password{0}'.format(i) for i in range(5)], [p['password'] for p in d['passwords']])
+        
+        d = r.to_dict(decrypt=False)
+        self.assertFalse('notes' in d)
+        self.assertFalse('passwords' in d)
+    
+    def test_resource_to_dict_pending(self):
+        """ Test that the (unflushed) group membership changes are included. """
+        r = self.data.resources['host1.example.com']
+        g = self.data.groups['Third Group']
+        r.groups.append(g)
+        self.assertIn(g.id, r.to_dict(decrypt=False)['group_ids'])
+    
+    def test_group_to_dict(self):
+        """ Test the shape of group dicts. """
+        g = self.data.groups['First Group']
+        d = g.to_dict(include_resources=True)
+        expected = sorted((r.name for r in self.data.resources.values() if g in r.groups), key=lambda n: n.lower())
+        self.assertEquals(expected, sorted((r['name'] for r in d['resources']), key=lambda n: n.lower()))
+        self.assertEquals([r.name for r in g.resources.order_by('name')], [r['name'] for r in d['resources']])
+        self.assertFalse('notes' in d['resources'][0])
+        self.assertEquals(dict(id=g.id, name=g.name), g.to_dict())
+    
+    def test_password_to_dict(self):
+        """ Test the shape of password dicts. """
+        pw = self.data.resources['host1.example.com'].passwords.order_by('username').first()
+        self._add_history(pw, 3)
+        d = pw.to_dict(include_resource=True, include_history=True)
+        self.assertEquals('password0', d['password'])
+        self.assertEquals('host1.example.com', d['resource']['name'])
+        self.assertEquals(u'Encrypted notes', d['resource']['notes'])
+        self.assertEquals(3, len(d['history']))
+        self.assertEquals(set(['old0', 'old1', 'old2']), set(h['password'] for h in d['history']))
+        self.assertTrue(all(isinstance(h['password'], unicode) for h in d['history']))
+        self.assertEquals(sorted(['id', 'password_id', 'password']), sorted(d['history'][0]))
+    
+    def test_group_query_count(self):
+        """ Test that serializing a group with its resources is a constant number of queries. """
+        session = meta.Session()
+        g = session.query(model.Group).get(self.data.groups['First Group'].id)
+        with QueryCounter() as queries:
+            d = g.to_dict(include_resources=True, decrypt_resources=True)
+        self.assertTrue(len(d['resources']) > 3)
+        self.assertEquals(2, queries.count, queries.statements)
+        
+        groups = session.query(model.Group).all()
+        with QueryCounter() as queries:
+            serialize.groups_to_dicts(groups, include_resources=True)
+        self.assertEquals(2, queries.count, queries.statements)
+    
+    def test_resources_query_count(self):
+        """ Test that serializing resources with their passwords is a constant number of queries. """
+        resources = meta.Session().query(model.Resource).options(orm.undefer('notes')).all()
+        with QueryCounter() as queries:
+            dicts = serialize.resources_to_dicts(resources, include_passwords=True, decrypt_passwords=True)
+        self.assertEquals(len(resources), len(dicts))
+        self.assertEquals(2, queries.count, queries.statements)
+    
+    def test_passwords_query_count(self):
+        """ Test that serializing passwords with their history and resource is a constant number of queries. """
+        passwords = meta.Session().query(model.Password).all()
+        for pw in passwords[:3]:
+            self._add_history(pw, 2)
+        passwords = meta.Session().query(model.Password).options(orm.undefer('password')).all()
+        with QueryCounter() as queries:
+            dicts = serialize.passwords_to_dicts(passwords, include_history=True, include_resource=True)
+        self.assertEquals(6, sum(len(d['history']) for d in dicts))
+        # (history, resources, resource group memberships)
+        self.assertEquals(3, queries.count, queries.statements)
+    
+    def test_in_batches(self):
+        """ Test that large lists are loaded in batches. """
+        orig = serialize.IN_BATCH_SIZE
+        serialize.IN_BATCH_SIZE = 2
+        try:
+            resources = meta.Session().query(model.Resource).options(orm.undefer('notes')).order_by(model.resources_table.c.id).all()
+            with QueryCounter() as queries:
+                dicts = serialize.resources_to_dicts(resources, include_passwords=True)
+            self.assertEquals([r.to_dict(include_passwords=True) for r in resources], dicts)
+            self.assertEquals(8, queries.count)
+        finally:
+            serialize.IN_BATCH_SIZE = orig
+    
+    def test_deferred_columns(self):
+        """ Test that the encrypted columns are only loaded when needed. """
+        session = meta.Session()
+        with QueryCounter() as queries:
+            resources = session.query(model.Resource).all()
+            passwords = session.query(model.Password).all()
+        self.assertFalse('notes' in resources[0].__dict__)
+        self.assertFalse('password' in passwords[0].__dict__)
+        for statement in queries.statements:
+            self.assertFalse('notes' in statement or 'passwords.password' in statement, statement)
+        
+        # The deferred values are loaded for the whole list with one more query.
+        with QueryCounter() as queries:
+            dicts = serialize.passwords_to_dicts(passwords)
+        self.assertEquals(1, queries.count, queries.statements)
+        self.assertEquals(sorted(pw.password_decrypted for pw in passwords), sorted(d['password'] for d in dicts))
+        
+        with QueryCounter() as queries:
+            dicts = serialize.resources_to_dicts(resources)
+        self.assertEquals(2, queries.count, queries.statements)
+        self.assertEquals(u'Encrypted notes', [d for d in dicts if d['name'] == 'host1.example.com'][0]['notes'])
+    
+    def test_undefer(self):
+        """ Test that undeferred entities do not need another query. """
+        passwords = meta.Session().query(model.Password).options(orm.undefer('password')).all()
+        with QueryCounter() as queries:
+            serialize.passwords_to_dicts(passwords)
+        self.assertEquals(0, queries.count, queries.statements)
@@ -0,0 +1,50 @@
+"""
+Test the parsing and storage of the tags fields.
+"""
+from ensconce.model import meta, tags
+from ensconce import search
+
+from tests import BaseTest, BaseModelTest
+
+class TagsTest(BaseTest):
+    
+    def test_parse_tags(self):
+        self.assertEquals([], tags.parse_tags(None))
+        self.assertEquals(['tagone', 'tagtwo'], tags.parse_tags('tagone tagtwo'))
+        self.assertEquals(['os:linux', 'web-server', 'a_b|c'], tags.parse_tags(' OS:Linux, web-server;a_b|c os:linux '))
+        self.assertEquals(['prefix', 'suffix'], tags.parse_tags(':prefix suffix: ::'))
+        self.assertEquals([u'fa\xdf'], tags.parse_tags(u'Fa\xdf'))
+        self.assertEquals([], tags.parse_tags('x' * (tags.MAX_TAG_LENGTH + 1)))
+
+class SyncTagsTest(BaseModelTest):
+    
+    def _concurrent_sync(self):
+        """ Syncs the tags as if another transaction had added 'tagone' after they were selected. """
+        selects = []
+        def stale_tag_ids(connection, names):
+            selects.append(names)
+            if len(selects) == 1:
+                return {}
+            return tag_ids(connection, names)
+        tag_ids = tags._tag_ids
+        tags._tag_ids = stale_tag_ids
+        try:
+            r = self.data.resources['host1.example.com']
+            r.tags = 'tagone newtag'
+            meta.Session().flush()
+        finally:
+            tags._tag_ids = tag_ids
+        self.assertEquals(2, len(selects))
+        self.assertIn(r, search.tagsearch(['tagone']).resource_matches)
+        self.assertEquals([r], search.tagsearch(['newtag']).resource_matches)
+    
+    def test_sync_concurrent_insert(self):
+        self._concurrent_sync()
+    
+    def test_sync_concurrent_insert_savepoint(self):
+        on_conflict_supported = tags._on_conflict_supported
+        tags._on_conflict_supported = lambda connection: False
+        try:
+            self._concurrent_sync()
+        finally:
+            tags._on_conflict_supported = on_conflict_supported
@@ -0,0 +1,100 @@
+"""
+Test the (request-scoped) access checks.
+"""
+import cherrypy
+from cherrypy import _cprequest
+from cherrypy.lib import httputil
+
+from ensconce import acl, exc, model
+from ensconce.model import meta
+
+from tests import BaseModelTest, QueryCounter
+
+@acl.require_access([acl.GROUP_R, acl.PASS_R, acl.RESOURCE_R, acl.USER_R])
+def search():
+    return 'results'
+
+@acl.require_access(acl.AUDIT)
+def auditlog():
+    return 'entries'
+
+class AclTest(BaseModelTest):
+
+    def setUp(self):
+        super(AclTest, self).setUp()
+        self.operator = self.data.operators['op1']
+        cherrypy.session = dict(user_id=self.operator.id, username=self.operator.username)
+
+    def tearDown(self):
+        cherrypy.serving.clear()
+        del cherrypy.session
+        super(AclTest, self).tearDown()
+
+    def _start_request(self):
+        """ Sets up a new (current) request, like the server does. """
+        request = _cprequest.Request(httputil.Host('127.0.0.1', 8080), httputil.Host('127.0.0.1', 50000))
+        request.app = cherrypy.Application(None)
+        cherrypy.serving.load(request, _cprequest.Response())
+
+    def _set_level(self, level):
+        access = model.Access()
+        access.level = level
+        meta.Session().add(access)
+        self.operator.access = access
+        meta.Session().flush()
+
+    def test_compile_perms(self):
+        """ Test that the perms are compiled into one mask. """
+        self.assertEquals(acl.PASS_R, acl.compile_perms(acl.PASS_R))
+        self.assertEquals(acl.GROUP_R | acl.PASS_R, acl.compile_perms([acl.GROUP_R, acl.PASS_R]))
+        self.assertEquals(0, acl.compile_perms([]))
+
+    def test_single_lookup(self):
+        """ Test that the access level is looked up once per request. """
+        self._set_level(acl.ALL_ACCESS)
+        self._start_request()
+        with QueryCounter() as queries:
+            self.assertEquals('results', search())
+            self.assertEquals('entries', auditlog())
+            self.assertTrue(acl.has_access([acl.PASS_W, acl.RESOURCE_W]))
+        self.assertEquals(1, queries.count)
+
+        self._start_request()
+        with QueryCounter() as queries:
+            search()
+            search()
+        self.assertEquals(1, queries.count)
+
+    def test_denied(self):
+        """ Test that all of the perms are required. """
+        self._set_level(acl.GROUP_R | acl.PASS_R | acl.RESOURCE_R)
+        self._start_request()
+        with self.assertRaises(exc.PermissionDenied):
+            search()
+        with self.assertRaises(exc.PermissionDenied):
+            auditlog()
+        self.assertTrue(acl.has_access([acl.GROUP_R, acl.PASS_R]))
+        self.assertFalse(acl.has_access([acl.GROUP_R, acl.USER_R]))
+
+    def test_operator_change(self):
+        """ Test that the level is looked up again if the operator changes (e.g. at login). """
+        self._set_level(acl.ALL_ACCESS)
+        self._start_request()
+        self.assertTrue(acl.has_access(acl.AUDIT))
+
+        other = self.data.operators['op2']
+        access = model.Access()
+        access.level = acl.PASS_R
+        meta.Session().add(access)
+        other.access = access
+        meta.Session().flush()
+        cherrypy.session = dict(user_id=other.id, username=other.username)
+        self.assertFalse(acl.has_access(acl.AUDIT))
+        self.assertTrue(acl.has_access(acl.PASS_R))
+
+    def test_outside_request(self):
+        """ Test that the level is not memoized outside of a request. """
+        self._set_level(acl.ALL_ACCESS)
+        self.assertTrue(acl.has_access(acl.AUDIT))
+        self._set_level(acl.PASS_R)
+        self.assertFalse(acl.has_access(acl.AUDIT))
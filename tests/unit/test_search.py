@@ -2,6 +2,7 @@ import random
 
 from ensconce.dao import groups
 from ensconce import exc, search
+from ensconce.model import meta
 
 from tests import BaseModelTest
 
@@ -38,4 +39,41 @@ class TestSearch(BaseModelTest):
         
         results = search.tagsearch([':tagone'])
         self.assertEquals(1, len(results.resource_matches))
-        self.assertEquals(2, len(results.password_matches))
\ No newline at end of file
+        self.assertEquals(2, len(results.password_matches))
+    
+    def test_search_rows(self):
+        for include_encrypted in (False, True):
+            for searchstr in ('host', 'group', 'user1', 'encrypted'):
+                results = search.search(searchstr, include_encrypted=include_encrypted)
+                rows = search.search_rows(searchstr, include_encrypted=include_encrypted)
+                for (entities, matches) in zip(results, rows):
+                    self.assertEquals([(e.id, e.label) for e in entities], [(m.id, m.label) for m in matches])
+        
+        rows = search.search_rows('encrypted notes', include_encrypted=True)
+        self.assertEquals(['host1.example.com'], [r.name for r in rows.resource_matches])
+    
+    def test_tagsearch_case(self):
+        self.assertEquals(search.tagsearch(['tagone']), search.tagsearch(['TagOne']))
+        self.assertEquals(([], []), search.tagsearch(['tag%']))
+    
+    def test_tagsearch_updated(self):
+        r = self.data.resources['host1.example.com']
+        r.tags = 'new:tag tagone'
+        meta.Session().flush()
+        self.assertEquals([r], search.tagsearch([':tag']).resource_matches)
+        self.assertIn(r, search.tagsearch(['tagone']).resource_matches)
+        
+        r.tags = None
+        meta.Session().flush()
+        self.assertEquals([], search.tagsearch(['new:']).resource_matches)
+    
+    def test_tagfacets(self):
+        facets = dict((f.name, f) for f in search.tagfacets())
+        self.assertEquals((0, 1), (facets['tagprefix'].resource_count, facets['tagprefix'].password_count))
+        self.assertEquals((2, 0), (facets['tagone'].resource_count, facets['tagone'].password_count))
+        self.assertEquals((2, 2), (facets['tagtwo'].resource_count, facets['tagtwo'].password_count))
+        self.assertEquals(['tagtwo'], [f.name for f in search.tagfacets(limit=1)])
+        
+        facets = dict((f.name, f) for f in search.tagfacets(['tagprefix:']))
+        self.assertEquals(['tagprefix:tagone', 'tagtwo'], sorted(facets))
+        self.assertEquals((0, 1), (facets['tagtwo'].resource_count, facets['tagtwo'].password_count))
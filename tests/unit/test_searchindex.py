@@ -0,0 +1,105 @@
+"""
+Test the in-memory search index.
+"""
+from ensconce import search
+from ensconce.dao import resources, passwords
+from ensconce.model import meta
+from ensconce.searchindex import InvertedIndex, vault_index
+
+from tests import BaseTest, BaseModelTest
+
+class InvertedIndexTest(BaseTest):
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.put(1, [u'host1.example.com', u'Web server'], [u'Rack 12'])
+        self.index.put(2, [u'host2.example.com', u'Database'], [u'Rack 14'])
+        self.index.put(3, [u'example', None], [None])
+
+    def test_search(self):
+        """ Test the substring matching (all of the words). """
+        self.assertEquals(set([1, 2, 3]), set(self.index.search([u'exam'])))
+        self.assertEquals(set([1, 2]), set(self.index.search([u'.com'])))
+        self.assertEquals(set([2]), set(self.index.search([u'base', u'host'])))
+        self.assertEquals(set([1]), set(self.index.search([u't1'])))
+        self.assertEquals({}, self.index.search([u'host1', u'database']))
+        self.assertEquals({}, self.index.search([u'nomatch']))
+
+    def test_ranking(self):
+        """ Test that equal words rank before prefixes, and prefixes before substrings. """
+        ranks = self.index.search([u'example'])
+        self.assertTrue(ranks[3] > ranks[1])
+        ranks = self.index.search([u'serv'])
+        self.assertEquals({1: 2}, ranks)
+        self.assertEquals({1: 1}, self.index.search([u'erve']))
+
+    def test_encrypted(self):
+        """ Test that the encrypted fields are only searched on request. """
+        self.assertEquals({}, self.index.search([u'rack']))
+        self.assertEquals({1: 0, 2: 0}, self.index.search([u'rack'], include_encrypted=True))
+        self.assertEquals({1: 3}, self.index.search([u'rack', u'web'], include_encrypted=True))
+
+    def test_update(self):
+        """ Test replacing and removing entities. """
+        self.index.put(1, [u'renamed'], [])
+        self.assertEquals(set([2, 3]), set(self.index.search([u'exam'])))
+        self.assertEquals({1: 3}, self.index.search([u'renamed']))
+        self.assertEquals({}, self.index.search([u'12'], include_encrypted=True))
+
+        self.index.remove(2)
+        self.assertEquals(set([3]), set(self.index.search([u'exam'])))
+        self.index.remove(2)
+
+class VaultIndexTest(BaseModelTest):
+
+    def setUp(self):
+        super(VaultIndexTest, self).setUp()
+        vault_index.configure(enabled=True)
+        vault_index.build()
+
+    def tearDown(self):
+        vault_index.configure(enabled=False)
+        super(VaultIndexTest, self).tearDown()
+
+    def _names(self, searchstr, **kwargs):
+        return [r.name for r in search.search(searchstr, search_groups=False, search_passwords=False, **kwargs).resource_matches]
+
+    def test_search(self):
+        """ Test that the searches use the index. """
+        self.assertTrue(vault_index.ready)
+        results = search.search(u'example')
+        self.assertEquals(['host1.example.com', 'host2.example'], sorted(r.name for r in results.resource_matches))
+        self.assertEquals([], results.password_matches)
+
+        self.assertEquals(['host1.example.com'], self._names(u'crypted', include_encrypted=True))
+        self.assertEquals([], self._names(u'crypted'))
+        self.assertEquals(['bankus3r'], [p.username for p in search.search_rows(u'3r').password_matches])
+
+    def test_dao_changes(self):
+        """ Test that the DAO changes are applied when they are committed. """
+        group_id = self.data.groups['First Group'].id
+        r = resources.create(name=u'indexed.example.org', group_ids=[group_id], notes=u'Cabinet 7')
+        self.assertEquals([], self._names(u'example.org'))
+        meta.Session().commit()
+        self.assertEquals([u'indexed.example.org'], self._names(u'example.org'))
+        self.assertEquals([u'indexed.example.org'], self._names(u'cabinet', include_encrypted=True))
+
+        pw = passwords.create(u'indexeduser', r.id, password=u'secret')
+        meta.Session().commit()
+        self.assertEquals([pw.id], [p.id for p in search.search(u'indexeduser').password_matches])
+
+        resources.modify(r.id, name=u'renamed.example.org')
+        meta.Session().rollback()
+        self.assertEquals([u'indexed.example.org'], self._names(u'example.org'))
+
+        resources.modify(r.id, name=u'renamed.example.org')
+        meta.Session().commit()
+        self.assertEquals([u'renamed.example.org'], self._names(u'example.org'))
+
+        passwords.delete(pw.id)
+        meta.Session().commit()
+        self.assertEquals([], search.search(u'indexeduser').password_matches)
+
+        resources.delete(r.id)
+        meta.Session().commit()
+        self.assertEquals([], self._names(u'example.org'))
@@ -0,0 +1,72 @@
+"""
+Test the search backends.
+"""
+from ensconce import model, exc, search
+from ensconce.model import meta
+from ensconce.textsearch import search_backend, LikeBackend, TsvectorBackend
+
+from tests import BaseModelTest
+
+class TextSearchTest(BaseModelTest):
+    
+    def tearDown(self):
+        search_backend.configure('auto')
+        super(TextSearchTest, self).tearDown()
+    
+    def _names(self, searchstr):
+        return [r.name for r in search.search(searchstr, search_groups=False, search_passwords=False).resource_matches]
+    
+    def test_configure(self):
+        search_backend.configure('auto')
+        self.assertIsInstance(search_backend.current, LikeBackend)
+        search_backend.configure('tsvector')
+        self.assertIsInstance(search_backend.current, TsvectorBackend)
+        search_backend.configure('like')
+        self.assertIsInstance(search_backend.current, LikeBackend)
+        with self.assertRaises(exc.ConfigurationError):
+            search_backend.configure('no-such-backend')
+    
+    def test_multiple_words(self):
+        """ Test that all of the words must match (in any of the columns). """
+        for backend in (LikeBackend(), TsvectorBackend()):
+            search_backend.current = backend
+            self.assertEquals(['host1.example.com', 'host2.example'], sorted(self._names('Example')), backend)
+            self.assertEquals(['host1.example.com'], self._names('host1 example'), backend)
+            self.assertEquals(['host2.example'], self._names('example 192.168.1.2'), backend)
+            self.assertEquals(['BoA'], self._names('bank tagtwo'), backend)
+            self.assertEquals([], self._names('host1 bank'), backend)
+            self.assertEquals([], self._names('   '), backend)
+    
+    def test_substring(self):
+        """ Test the differences between the backends. """
+        search_backend.current = LikeBackend()
+        self.assertEquals(['host1.example.com'], self._names('ost1'))
+        self.assertEquals([], self._names('host%'))
+        
+        search_backend.current = TsvectorBackend()
+        self.assertEquals([], self._names('ost1'))
+        self.assertEquals(['host1.example.com'], self._names('host1.exam'))
+    
+    def test_ranking(self):
+        """ Test that the matches on the start of a value come first. """
+        r = model.Resource()
+        r.name = 'aaa'
+        r.description = 'Near the bikeshed'
+        r.groups.append(self.data.groups['First Group'])
+        meta.Session().add(r)
+        meta.Session().flush()
+        
+        search_backend.current = LikeBackend()
+        self.assertEquals(['Bikeshed PIN', 'aaa'], self._names('bikeshed'))
+        
+        search_backend.current = TsvectorBackend()
+        self.assertEquals(['aaa', 'Bikeshed PIN'], sorted(self._names('bikeshed'), key=lambda n: n.lower()))
+    
+    def test_updated(self):
+        """ Test that the (tsvector) documents follow the changes to the columns. """
+        search_backend.current = TsvectorBackend()
+        r = meta.Session().query(model.Resource).filter_by(name='host1.example.com').one()
+        r.addr = '10.20.30.40'
+        meta.Session().flush()
+        self.assertEquals(['host1.example.com'], self._names('10.20.30'))
+        self.assertEquals([], self._names('host1 192.168'))